@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Compare ways of timestamping a tx found in a block
+
+A synthetic block of about --block-size bytes is made, with a timestamp tx in
+the middle. The block timestamp is then built as the stamper used to: every
+txid computed again, wrapped in a Timestamp, and the whole merkle tree built
+out of Timestamps. Then as it does now: reusing the txids it already computed
+to find the tx in the block, and hashing the tree from raw digests, with
+Timestamps only along the tx's branch.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from bitcoin.core import CBlock, COutPoint, CTransaction, CTxIn, CTxOut
+from bitcoin.core.script import CScript, OP_RETURN
+from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpPrepend
+from opentimestamps.core.timestamp import Timestamp, cat_sha256d
+
+from otsserver.stamper import UnconfirmedTimestampTx, make_btc_block_merkle_tree, make_timestamp_from_block_tx
+
+parser = argparse.ArgumentParser(description="Block timestamp construction benchmark")
+parser.add_argument("--block-size", type=int, default=4000000,
+                    help="Approximate size of the synthetic block in bytes (default: %(default)d)")
+parser.add_argument("--tx-outputs", type=int, default=10,
+                    help="Outputs per synthetic tx; fewer makes more, smaller, txs (default: %(default)d)")
+parser.add_argument("--runs", type=int, default=5,
+                    help="Number of times each method is run (default: %(default)d)")
+args = parser.parse_args()
+
+
+def make_block(digest):
+    """Make a block of random txs with a timestamp tx for digest in the middle"""
+    txs = []
+    size = 0
+    while size < args.block_size:
+        tx = CTransaction([CTxIn(COutPoint(os.urandom(32), 0), CScript([os.urandom(72), os.urandom(33)]))],
+                          [CTxOut(1000, CScript([os.urandom(20)])) for i in range(args.tx_outputs)])
+        txs.append(tx)
+        size += len(tx.serialize())
+
+    commitment_tx = CTransaction([CTxIn(COutPoint(os.urandom(32), 0))],
+                                 [CTxOut(0, CScript([OP_RETURN, digest]))])
+    txs.insert(len(txs) // 2, commitment_tx)
+
+    block = CBlock(vtx=txs)
+    return commitment_tx, CBlock(hashMerkleRoot=block.calc_merkle_root(), vtx=txs)
+
+
+def whole_tree(confirmed_tx, block, blockheight):
+    """How the stamper used to find the tx and build the block timestamp"""
+    assert confirmed_tx.tx.GetTxid() in set(tx.GetTxid() for tx in block.vtx)
+
+    commitment_tx = confirmed_tx.tx
+    serialized_tx = commitment_tx.serialize(params={'include_witness': False})
+    digest = confirmed_tx.tip_timestamp.msg
+    i = serialized_tx.index(digest)
+
+    digest_timestamp = Timestamp(digest)
+    prefix_stamp = digest_timestamp.ops.add(OpPrepend(serialized_tx[0:i]))
+    txid_stamp = cat_sha256d(prefix_stamp, serialized_tx[i + len(digest):])
+
+    block_txid_stamps = []
+    for tx in block.vtx:
+        if tx.GetTxid() != txid_stamp.msg:
+            block_txid_stamps.append(Timestamp(tx.GetTxid()))
+        else:
+            block_txid_stamps.append(txid_stamp)
+
+    merkleroot_stamp = make_btc_block_merkle_tree(block_txid_stamps)
+    assert merkleroot_stamp.msg == block.hashMerkleRoot
+    merkleroot_stamp.attestations.add(BitcoinBlockHeaderAttestation(blockheight))
+
+    return digest_timestamp
+
+
+def branch_only(confirmed_tx, block, blockheight):
+    """As the stamper does now, txids being computed once per block"""
+    block_txids = [tx.GetTxid() for tx in block.vtx]
+    assert confirmed_tx.tx.GetTxid() in set(block_txids)
+    return make_timestamp_from_block_tx(confirmed_tx, block, blockheight, block_txids)
+
+
+def fresh_block(block):
+    """Copy of block, as if just received from bitcoind"""
+    return CBlock.deserialize(block.serialize())
+
+
+digest = os.urandom(32)
+commitment_tx, block = make_block(digest)
+confirmed_tx = UnconfirmedTimestampTx(commitment_tx, Timestamp(digest), 1)
+print('block: %d bytes, %d txs' % (len(block.serialize()), len(block.vtx)))
+
+expected = None
+for name, f in (('whole tree', whole_tree), ('branch only', branch_only)):
+    elapsed = 0
+    for run in range(args.runs):
+        run_block = fresh_block(block)
+        start = time.time()
+        timestamp = f(confirmed_tx, run_block, 500000)
+        elapsed += time.time() - start
+
+    if expected is None:
+        expected = timestamp
+    assert timestamp == expected
+
+    print('%-12s %10.1f ms/block' % (name, elapsed / args.runs * 1000))
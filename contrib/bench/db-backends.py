@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Compare calendar storage backends
+
+By default a synthetic calendar is built: a number of Bitcoin transactions,
+each timestamping a merkle tree of random commitments, just like the stamper
+does. With --calendar, an existing calendar's database is copied into each
+backend instead, and commitments are sampled from its journal.
+
+Node caching is disabled, so reads measure the backends themselves.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpAppend, OpPrepend, OpSHA256
+from opentimestamps.core.timestamp import Timestamp, cat_sha256d, make_merkle_tree
+
+import otsserver.calendar
+import otsserver.storage
+
+parser = argparse.ArgumentParser(description="Calendar storage backend benchmark")
+parser.add_argument("--backend", action='append', dest='backends',
+                    choices=sorted(otsserver.storage.BACKENDS),
+                    help="Backend to benchmark; may be given more than once (default: all)")
+parser.add_argument("--txs", type=int, default=10,
+                    help="Number of synthetic timestamp transactions (default: %(default)d)")
+parser.add_argument("--commitments", type=int, default=10000,
+                    help="Commitments per synthetic transaction (default: %(default)d)")
+parser.add_argument("--reads", type=int, default=10000,
+                    help="Number of timestamps to read (default: %(default)d)")
+parser.add_argument("--calendar", type=str, default=None,
+                    help="Copy the LevelDB database of an existing calendar rather than building a synthetic one")
+args = parser.parse_args()
+
+
+def make_confirmed_tx(n, height):
+    """Make commitment timestamps for a synthetic, confirmed, timestamp tx"""
+    commitment_timestamps = [Timestamp(os.urandom(otsserver.calendar.Journal.COMMITMENT_SIZE)) for i in range(n)]
+    tip = make_merkle_tree([stamp.ops.add(OpSHA256()) for stamp in commitment_timestamps])
+
+    # A typical timestamp tx, then a branch of a ~2000 tx block
+    stamp = tip.ops.add(OpPrepend(os.urandom(90))).ops.add(OpAppend(os.urandom(40)))
+    stamp = stamp.ops.add(OpSHA256()).ops.add(OpSHA256())
+    for i in range(11):
+        if random.getrandbits(1):
+            stamp = cat_sha256d(stamp, os.urandom(32))
+        else:
+            stamp = cat_sha256d(os.urandom(32), stamp)
+    stamp.attestations.add(BitcoinBlockHeaderAttestation(height))
+
+    return commitment_timestamps
+
+
+def timed(f):
+    start = time.time()
+    r = f()
+    return time.time() - start, r
+
+
+def bench(backend, path, source):
+    results = {}
+    db = otsserver.calendar.DbCalendar(otsserver.storage.open_store(backend, path + '/db'), cache_size=0)
+
+    if source is None:
+        commitments = []
+        elapsed = 0
+        for height in range(args.txs):
+            commitment_timestamps = make_confirmed_tx(args.commitments, height)
+            commitments.extend(stamp.msg for stamp in commitment_timestamps)
+            elapsed += timed(lambda: db.add_timestamps(commitment_timestamps))[0]
+        results['write stamps/s'] = len(commitments) / elapsed
+
+    else:
+        source_store, commitments = source
+        batch = []
+        elapsed = 0
+        for key, value in source_store.range():
+            batch.append((key, value))
+            if len(batch) >= 10000:
+                elapsed += timed(lambda: db.store.write_batch(batch, sync=False))[0]
+                batch = []
+        elapsed += timed(lambda: db.store.write_batch(batch, sync=True))[0]
+        results['write stamps/s'] = len(commitments) / elapsed
+
+    sample = [random.choice(commitments) for i in range(args.reads)]
+    elapsed = timed(lambda: [db[commitment] for commitment in sample])[0]
+    results['read stamps/s'] = len(sample) / elapsed
+
+    misses = [os.urandom(otsserver.calendar.Journal.COMMITMENT_SIZE) for i in range(args.reads)]
+    elapsed = timed(lambda: [commitment in db for commitment in misses])[0]
+    results['miss checks/s'] = len(misses) / elapsed
+
+    elapsed, n = timed(lambda: sum(1 for item in db.store.range()))
+    results['scan keys/s'] = n / elapsed
+
+    db.store.close()
+    return results
+
+
+source = None
+if args.calendar is not None:
+    calendar_path = os.path.expanduser(args.calendar)
+    journal = otsserver.calendar.Journal(calendar_path + '/journal')
+    source_store = otsserver.storage.open_store('leveldb', calendar_path + '/db')
+    commitments = [commitment for commitment in journal.iter_commitments(0) if commitment in source_store]
+    source = (source_store, commitments)
+
+columns = ('write stamps/s', 'read stamps/s', 'miss checks/s', 'scan keys/s')
+print('%-10s' % 'backend' + ''.join('%16s' % column for column in columns))
+for backend in args.backends or sorted(otsserver.storage.BACKENDS):
+    with tempfile.TemporaryDirectory() as path:
+        try:
+            results = bench(backend, path, source)
+        except ImportError as exp:
+            print('%-10s skipped: %s' % (backend, exp))
+            continue
+        print('%-10s' % backend + ''.join('%16.0f' % results[column] for column in columns))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Stand-alone aggregation server
+
+Accepts digests like a calendar does, but rather than keeping a calendar of
+its own, submits the merkle root of each batch of digests to an upstream
+calendar.
+"""
+
+import argparse
+import logging
+import sys
+import threading
+
+import otsserver.calendar
+import otsserver.ratelimit
+import otsserver.remote
+import otsserver.rpc
+import otsserver.web
+
+parser = argparse.ArgumentParser(description="OpenTimestamps Aggregation Server")
+
+parser.add_argument("-q", "--quiet", action="count", default=0,
+                    help="Be more quiet.")
+parser.add_argument("-v", "--verbose", action="count", default=0,
+                    help="Be more verbose. Both -v and -q may be used multiple times.")
+
+parser.add_argument("-u", "--upstream", type=str, required=True,
+                    help="URL of the calendar to submit aggregated digests to")
+parser.add_argument("--upstream-timeout", metavar='SECONDS', type=float,
+                    default=otsserver.remote.UpstreamCalendar.DEFAULT_TIMEOUT,
+                    help="Timeout for requests to the upstream calendar (default: %(default)s seconds)")
+parser.add_argument("--upstream-retries", metavar='N', type=int,
+                    default=otsserver.remote.UpstreamCalendar.DEFAULT_RETRIES,
+                    help="Number of times to retry failed requests to the upstream calendar (default: %(default)d)")
+
+parser.add_argument("--rpc-port", type=int,
+                    default=14788,
+                    help="RPC port (default: %(default)d)")
+parser.add_argument("--rpc-address", type=str,
+                    default='localhost',
+                    help="RPC address (default: %(default)s)")
+
+parser.add_argument("--rpc-max-threads", metavar='N', type=int,
+                    default=0,
+                    help="Maximum number of open connections, each with its own thread unless --rpc-asyncio is "
+                         "used; connections beyond that are refused with a 503, though without --rpc-asyncio "
+                         "idle keep-alive connections are closed to make room first; 0 for no limit "
+                         "(default: %(default)d)")
+parser.add_argument("--rpc-asyncio", action="store_true",
+                    default=False,
+                    help="Serve RPC requests with asyncio rather than a thread per connection")
+parser.add_argument("--rpc-max-workers", metavar='N', type=int,
+                    default=otsserver.web.AsyncServer.DEFAULT_MAX_WORKERS,
+                    help="With --rpc-asyncio, number of threads for handling requests (default: %(default)d)")
+parser.add_argument("--max-in-flight-digests", metavar='N', type=int,
+                    default=1000000,
+                    help="Maximum number of submitted digests waiting to be timestamped; submissions beyond that "
+                         "are refused with a 503; 0 for no limit (default: %(default)d)")
+parser.add_argument("--rate-limit", metavar='RATE', type=float,
+                    default=0,
+                    help="Maximum digests per second each client IP can submit; 0 for no limit (default: %(default)s)")
+parser.add_argument("--rate-limit-burst", metavar='N', type=int,
+                    default=10,
+                    help="Number of digests a client IP can submit at once before --rate-limit applies; a /digests "
+                         "POST of more digests than that needs a full allowance, and leaves the client in debt for "
+                         "the excess (default: %(default)d)")
+parser.add_argument("--client-ip-header", metavar='HEADER', type=str,
+                    default=None,
+                    help="Take the client IP from this header, as set by a reverse proxy, e.g. X-Real-IP")
+
+parser.add_argument("--aggregator-max-latency", metavar='SECONDS', type=float,
+                    default=1,
+                    help="Longest a submitted digest waits to be submitted upstream (default: %(default)s seconds)")
+parser.add_argument("--aggregator-max-batch-size", metavar='N', type=int,
+                    default=otsserver.calendar.Aggregator.DEFAULT_MAX_BATCH_SIZE,
+                    help="Submit upstream as soon as N digests are waiting (default: %(default)d)")
+parser.add_argument("--aggregator-min-interval", metavar='SECONDS', type=float,
+                    default=0,
+                    help="Minimum interval between upstream submissions (default: %(default)s seconds)")
+
+args = parser.parse_args()
+
+args.verbosity = args.verbose - args.quiet
+
+logging.basicConfig(format="%(asctime)-15s %(message)s", stream=sys.stdout)
+if args.verbosity == 0:
+    logging.root.setLevel(logging.INFO)
+elif args.verbosity > 0:
+    logging.root.setLevel(logging.DEBUG)
+elif args.verbosity == -1:
+    logging.root.setLevel(logging.WARNING)
+elif args.verbosity < -1:
+    logging.root.setLevel(logging.ERROR)
+
+exit_event = threading.Event()
+
+upstream = otsserver.remote.UpstreamCalendar(args.upstream,
+                                             timeout=args.upstream_timeout,
+                                             retries=args.upstream_retries)
+aggregator = otsserver.calendar.Aggregator(upstream, exit_event,
+                                           max_latency=args.aggregator_max_latency,
+                                           max_batch_size=args.aggregator_max_batch_size,
+                                           min_commitment_interval=args.aggregator_min_interval,
+                                           max_in_flight=args.max_in_flight_digests or None)
+
+rate_limiter = None
+if args.rate_limit:
+    rate_limiter = otsserver.ratelimit.RateLimiter(args.rate_limit, args.rate_limit_burst)
+
+if args.rpc_asyncio:
+    server = otsserver.rpc.AsyncAggregationServer((args.rpc_address, args.rpc_port), aggregator,
+                                                  max_workers=args.rpc_max_workers,
+                                                  max_connections=args.rpc_max_threads or None,
+                                                  rate_limiter=rate_limiter,
+                                                  client_ip_header=args.client_ip_header)
+else:
+    server = otsserver.rpc.AggregationServer((args.rpc_address, args.rpc_port), aggregator,
+                                             max_threads=args.rpc_max_threads or None,
+                                             rate_limiter=rate_limiter,
+                                             client_ip_header=args.client_ip_header)
+logging.info("Aggregating digests for %s on %s:%d" % (args.upstream, args.rpc_address, args.rpc_port))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    exit_event.set()
+    sys.exit(0)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Materialize proofs for commitments confirmed before --materialize-proofs was enabled
+
+LevelDB databases can only be opened by one process at a time, so otsd must
+not be running while this is. Commitments that aren't confirmed yet are
+skipped; unless otsd is then run with --materialize-proofs, which materializes
+them as they're confirmed, run this again later to pick them up.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+from bitcoin.core import b2x
+
+import otsserver.calendar
+import otsserver.storage
+
+parser = argparse.ArgumentParser(description="OpenTimestamps Server proof backfill")
+
+parser.add_argument("-q", "--quiet", action="count", default=0,
+                    help="Be more quiet.")
+parser.add_argument("-v", "--verbose", action="count", default=0,
+                    help="Be more verbose. Both -v and -q may be used multiple times.")
+parser.add_argument("-c", "--calendar", type=str,
+                    dest='calendar_path',
+                    default='~/.otsd/calendar',
+                    help="Location of the calendar (default: '%(default)s')")
+parser.add_argument("--db-backend", type=str,
+                    choices=sorted(otsserver.storage.BACKENDS),
+                    default=otsserver.storage.DEFAULT_BACKEND,
+                    help="Calendar database backend (default: %(default)s)")
+parser.add_argument("--start", metavar='IDX', type=int,
+                    default=0,
+                    help="Journal index to start from (default: %(default)d)")
+parser.add_argument("--batch-size", metavar='N', type=int,
+                    default=1000,
+                    help="Number of proofs to write at a time (default: %(default)d)")
+
+args = parser.parse_args()
+
+args.verbosity = args.verbose - args.quiet
+
+logging.basicConfig(format="%(asctime)-15s %(message)s", stream=sys.stdout)
+if args.verbosity == 0:
+    logging.root.setLevel(logging.INFO)
+elif args.verbosity > 0:
+    logging.root.setLevel(logging.DEBUG)
+elif args.verbosity == -1:
+    logging.root.setLevel(logging.WARNING)
+elif args.verbosity < -1:
+    logging.root.setLevel(logging.ERROR)
+
+calendar_path = os.path.normpath(os.path.expanduser(args.calendar_path))
+
+journal = otsserver.calendar.Journal(calendar_path + '/journal')
+db = otsserver.calendar.DbCalendar(otsserver.storage.open_store(args.db_backend, calendar_path + '/db'), cache_size=0)
+proofs = otsserver.calendar.ProofStore(otsserver.storage.open_store(args.db_backend, calendar_path + '/proofs'),
+                                      batch_size=args.batch_size)
+
+logging.info("Backfilling proofs for %d journal entries" % (len(journal) - args.start))
+
+batch = []
+n_added = 0
+n_pending = 0
+for idx, commitment in enumerate(journal.iter_commitments(args.start), args.start):
+    if commitment in proofs:
+        pass
+
+    elif commitment in db:
+        batch.append(db[commitment])
+
+    else:
+        # Not confirmed yet. If otsd is run with --materialize-proofs the
+        # stamper materializes it once it is; otherwise it's left for the
+        # next run of this script.
+        logging.debug("Commitment %s (idx %d) not in calendar" % (b2x(commitment), idx))
+        n_pending += 1
+
+    if len(batch) >= args.batch_size:
+        n_added += proofs.add(batch)
+        batch = []
+        logging.info("Up to idx %d, %d proofs added" % (idx, n_added))
+
+n_added += proofs.add(batch)
+logging.info("Done, %d proofs added; %d commitments not yet confirmed" % (n_added, n_pending))
@@ -16,6 +16,7 @@ import os
 import sys
 import otsserver.calendar
 import otsserver.backup
+import otsserver.storage
 
 parser = argparse.ArgumentParser(description="OpenTimestamps Backup Server")
 
@@ -40,6 +41,11 @@ parser.add_argument("--debug-file-max-size", type=int,
                     default=10000000,
                     help="Max size of the debug log (default: %(default)d bytes) ")
 
+parser.add_argument("--db-backend", type=str,
+                    choices=sorted(otsserver.storage.BACKENDS),
+                    default=otsserver.storage.DEFAULT_BACKEND,
+                    help="Database backend (default: %(default)s)")
+
 parser.add_argument("--rpc-port", type=int,
                     default=14799,
                     help="RPC port (default: %(default)d)")
@@ -83,7 +89,7 @@ elif args.verbosity == -1:
 elif args.verbosity < -1:
     logging.root.setLevel(logging.ERROR)
 
-db = otsserver.calendar.LevelDbCalendar(db_dir)
+db = otsserver.calendar.DbCalendar(otsserver.storage.open_store(args.db_backend, db_dir))
 calendar = otsserver.backup.BackupCalendar(db)
 server = otsserver.backup.BackupServer((args.rpc_address, args.rpc_port), calendar)
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Copy a calendar's databases from one storage backend to another
+
+otsd must not be running while this is. Once done, start otsd with
+--db-backend set to the new backend.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import otsserver.storage
+
+parser = argparse.ArgumentParser(description="OpenTimestamps Server database migration")
+
+parser.add_argument("-q", "--quiet", action="count", default=0,
+                    help="Be more quiet.")
+parser.add_argument("-v", "--verbose", action="count", default=0,
+                    help="Be more verbose. Both -v and -q may be used multiple times.")
+parser.add_argument("-c", "--calendar", type=str,
+                    dest='calendar_path',
+                    default='~/.otsd/calendar',
+                    help="Location of the calendar (default: '%(default)s')")
+parser.add_argument("--from", type=str, dest='from_backend',
+                    choices=sorted(otsserver.storage.BACKENDS),
+                    default=otsserver.storage.DEFAULT_BACKEND,
+                    help="Backend to copy from (default: %(default)s)")
+parser.add_argument("--to", type=str, dest='to_backend',
+                    choices=sorted(otsserver.storage.BACKENDS),
+                    required=True,
+                    help="Backend to copy to")
+parser.add_argument("--batch-size", metavar='N', type=int,
+                    default=10000,
+                    help="Number of keys to write at a time (default: %(default)d)")
+
+args = parser.parse_args()
+
+args.verbosity = args.verbose - args.quiet
+
+logging.basicConfig(format="%(asctime)-15s %(message)s", stream=sys.stdout)
+if args.verbosity == 0:
+    logging.root.setLevel(logging.INFO)
+elif args.verbosity > 0:
+    logging.root.setLevel(logging.DEBUG)
+elif args.verbosity == -1:
+    logging.root.setLevel(logging.WARNING)
+elif args.verbosity < -1:
+    logging.root.setLevel(logging.ERROR)
+
+if args.from_backend == args.to_backend:
+    parser.error("--from and --to must be different backends")
+
+calendar_path = os.path.normpath(os.path.expanduser(args.calendar_path))
+
+
+def migrate(name):
+    from_class = otsserver.storage.BACKENDS[args.from_backend]
+    if not os.path.exists(calendar_path + '/' + name + from_class.PATH_SUFFIX):
+        logging.info("No %s database to migrate" % name)
+        return
+
+    from_store = otsserver.storage.open_store(args.from_backend, calendar_path + '/' + name)
+    to_store = otsserver.storage.open_store(args.to_backend, calendar_path + '/' + name)
+
+    batch = []
+    n = 0
+    for key, value in from_store.range():
+        batch.append((key, value))
+        if len(batch) >= args.batch_size:
+            to_store.write_batch(batch, sync=False)
+            n += len(batch)
+            batch = []
+            logging.debug("%s: copied %d keys" % (name, n))
+
+    to_store.write_batch(batch, sync=True)
+    n += len(batch)
+    logging.info("%s: copied %d keys from %s to %s" % (name, n, args.from_backend, args.to_backend))
+
+    from_store.close()
+    to_store.close()
+
+
+migrate('db')
+migrate('proofs')
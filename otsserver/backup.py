@@ -12,13 +12,9 @@
 from bitcoin.core import b2x
 from opentimestamps.core.notary import TimeAttestation, BitcoinBlockHeaderAttestation
 from opentimestamps.core.op import Op
-from opentimestamps.core.serialize import BytesSerializationContext, BytesDeserializationContext, TruncationError, \
-    StreamSerializationContext
+from opentimestamps.core.serialize import BytesSerializationContext, BytesDeserializationContext, TruncationError
 import bitcoin.rpc
-import leveldb
 import logging
-import socketserver
-import http.server
 import os
 import threading
 import binascii
@@ -27,6 +23,8 @@ from tempfile import NamedTemporaryFile
 import time
 from urllib.parse import urlparse, urljoin
 
+from otsserver.web import Response, Service, ThreadedServer
+
 PAGING = 1000  # Number of commitments per chunk
 SLEEP_SECS = 60  # Once the backup is synced this is the polling interval to check for new chunks
 
@@ -54,11 +52,16 @@ class Backup:
         start = chunk*PAGING
         end = start+PAGING
 
+        # Read the whole chunk from the journal in one go; if the journal doesn't have all of it yet the chunk
+        # can't be complete either
+        commitments = list(self.journal.iter_commitments(start, end))
+        if len(commitments) != PAGING:
+            raise IndexError
+
         # Iterate in reverse to fail fast if this chunk is not complete, a chunk is considered complete if all relative
         # 1000 commitments are complete. Which means a tx with more of 6 confirmations timestamp them
-        for i in range(start, end)[::-1]:
+        for i, current in reversed(list(enumerate(commitments, start))):
             try:
-                current = self.journal[i]
                 current_el = self.calendar[current]
                 self.__create_kv_map(current_el, current_el.msg, backup_map)
             except KeyError:
@@ -66,7 +69,7 @@ class Backup:
                 # appropriate exception for this case
                 raise IndexError
             if i % 100 == 0:
-                logging.debug("Got commitment " + str(i) + ":" + b2x(self.journal[i]))
+                logging.debug("Got commitment " + str(i) + ":" + b2x(current))
 
         logging.debug("map len " + str(len(backup_map)) + " start:" + str(start) + " end:" + str(end))
         kv_bytes = self.__kv_map_to_bytes(backup_map)
@@ -147,56 +150,48 @@ class Backup:
 
 # The following is a shrinked version of the standard calendar http server, it only support the '/timestamp' endpoint
 # This way the backup server could serve request in place of the calendar serve which is backupping
-class RPCRequestHandler(http.server.BaseHTTPRequestHandler):
+class BackupService(Service):
+    def __init__(self, calendar):
+        self.calendar = calendar
 
-    def do_GET(self):
-        if self.path.startswith('/timestamp/'):
-            self.get_timestamp()
+    def handle(self, request):
+        if request.method == 'GET' and request.path.startswith('/timestamp/'):
+            return self.get_timestamp(request)
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-
-            # a 404 is only going to become not a 404 if the server is upgraded
-            self.send_header('Cache-Control', 'public, max-age=3600')
+            return Response(404,
+                            [('Content-type', 'text/plain'),
+                             # a 404 is only going to become not a 404 if the server is upgraded
+                             ('Cache-Control', 'public, max-age=3600')],
+                            b'Not found')
 
-            self.end_headers()
-            self.wfile.write(b'Not found')
-
-    def get_timestamp(self):
-        commitment = self.path[len('/timestamp/'):]
+    def get_timestamp(self, request):
+        commitment = request.path[len('/timestamp/'):]
 
         try:
             commitment = binascii.unhexlify(commitment)
         except binascii.Error:
-            self.send_response(400)
-            self.send_header('Content-type', 'text/plain')
-            self.send_header('Cache-Control', 'public, max-age=31536000') # this will never not be an error!
-            self.end_headers()
-            self.wfile.write(b'commitment must be hex-encoded bytes')
-            return
+            return Response(400,
+                            [('Content-type', 'text/plain'),
+                             ('Cache-Control', 'public, max-age=31536000')], # this will never not be an error!
+                            b'commitment must be hex-encoded bytes')
 
         try:
             timestamp = self.calendar[commitment]
         except KeyError:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.send_header('Cache-Control', 'public, max-age=60')
-            reason = b'Not found'
-
-            self.end_headers()
-            self.wfile.write(reason)
-            return
+            return Response(404,
+                            [('Content-type', 'text/plain'),
+                             ('Cache-Control', 'public, max-age=60')],
+                            b'Not found')
 
-        self.send_response(200)
+        ctx = BytesSerializationContext()
+        timestamp.serialize(ctx)
 
         # Since only Bitcoin attestations are currently made, once a commitment
         # is timestamped by Bitcoin this response will never change.
-        self.send_header('Cache-Control', 'public, max-age=3600')
-
-        self.send_header('Content-type', 'application/octet-stream')
-        self.end_headers()
-
-        timestamp.serialize(StreamSerializationContext(self.wfile))
+        return Response(200,
+                        [('Cache-Control', 'public, max-age=3600'),
+                         ('Content-type', 'application/octet-stream')],
+                        ctx.getbytes())
 
 
 class BackupCalendar:
@@ -211,16 +206,9 @@ class BackupCalendar:
         return self.db[commitment]
 
 
-class BackupServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    def __init__(self, server_address, calendar):
-        class rpc_request_handler(RPCRequestHandler):
-            pass
-        rpc_request_handler.calendar = calendar
-
-        super().__init__(server_address, rpc_request_handler)
-
-    def serve_forever(self):
-        super().serve_forever()
+class BackupServer(ThreadedServer):
+    def __init__(self, server_address, calendar, max_threads=None):
+        super().__init__(server_address, BackupService(calendar), max_threads=max_threads)
 
 
 # This is the thread responsible for asking the chunks to the running calendar and import them in the db.
@@ -235,6 +223,9 @@ class AskBackup(threading.Thread):
         self.up_to_path = os.path.join(base_path, calendar_url_parsed.netloc)
         self.btc_net = btc_net
 
+        # Reuses the connection to the calendar between chunks
+        self.session = requests.Session()
+
         super().__init__(target=self.loop)
 
     def loop(self):
@@ -258,7 +249,7 @@ class AskBackup(threading.Thread):
             backup_url = urljoin(self.calendar_url, "/experimental/backup/%d" % (last_known + 1))
             logging.debug("Asking " + str(backup_url))
             try:
-                r = requests.get(backup_url)
+                r = self.session.get(backup_url)
             except Exception as err:
                 logging.error("Exception asking %s error message %s, sleeping for %d seconds"
                               % (str(backup_url), str(err), SLEEP_SECS))
@@ -311,10 +302,7 @@ class AskBackup(threading.Thread):
                         break
                 assert next_key in attestations
 
-            batch = leveldb.WriteBatch()
-            for key, value in kv_map.items():
-                batch.Put(key, value)
-            self.db.db.Write(batch, sync=True)
+            self.db.write_nodes(kv_map.items())
 
             last_known = last_known + 1
             try:
@@ -0,0 +1,231 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import http.client
+import logging
+import threading
+import time
+
+import bitcoin.rpc
+from bitcoin.core import COIN, CTransaction, CTxOut, b2lx, lx, x
+from bitcoin.core.script import CScript
+
+from otsserver.stats import Histogram, LATENCY_BUCKETS, SIZE_BUCKETS
+
+CONNECTION_ERRORS = (OSError, http.client.HTTPException)
+"""Errors meaning the connection to bitcoind is unusable, rather than that a call failed"""
+
+
+class BitcoindClient:
+    """bitcoind RPC client, shared between threads
+
+    Calls are made over a pool of persistent connections, rather than a new
+    bitcoin.rpc.Proxy each time. A connection that fails, as when bitcoind
+    hangs up on an idle one, is thrown away and the call retried once on a new
+    connection.
+
+    Any bitcoin.rpc.Proxy method can be called on the client itself, e.g.
+    client.getblockcount(). batch() makes several calls in a single JSON-RPC
+    request, and getblockhashes(), gettxouts() and getrawtransactions() use it
+    for the calls the stamper makes many of at once.
+
+    The latency of every call is recorded per method; a batched call counts as
+    a share of its batch's latency.
+    """
+
+    DEFAULT_MAX_IDLE = 4
+    """Number of idle connections kept open"""
+
+    NOT_RETRIED = frozenset(['sendrawtransaction'])
+    """Methods that aren't retried on a new connection, as they may have gone through"""
+
+    def __init__(self, proxy_kwargs=None, max_idle=DEFAULT_MAX_IDLE, proxy_class=bitcoin.rpc.Proxy):
+        self.proxy_kwargs = dict(proxy_kwargs or {})
+        self.max_idle = max_idle
+        self.proxy_class = proxy_class
+
+        self.__lock = threading.Lock()
+        self.__idle = []
+        self.__latencies = {}
+        self.__errors = {}
+        self.batch_sizes = Histogram(SIZE_BUCKETS)
+        self.connects = 0
+        self.reconnects = 0
+
+    def __connect(self):
+        proxy = self.proxy_class(**self.proxy_kwargs)
+        with self.__lock:
+            self.connects += 1
+        return proxy
+
+    def __get_proxy(self):
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+        return self.__connect()
+
+    def __put_proxy(self, proxy):
+        with self.__lock:
+            if len(self.__idle) < self.max_idle:
+                self.__idle.append(proxy)
+                return
+        proxy.close()
+
+    def __record(self, method, latency, error=False):
+        with self.__lock:
+            latencies = self.__latencies.get(method)
+            if latencies is None:
+                latencies = self.__latencies[method] = Histogram(LATENCY_BUCKETS)
+                self.__errors[method] = 0
+            if error:
+                self.__errors[method] += 1
+        latencies.add(latency)
+
+    def __with_proxy(self, f, methods):
+        """Call f(proxy), reconnecting and retrying once if the connection fails
+
+        methods are the names of the RPC methods f calls, for the stats.
+        """
+        proxy = self.__get_proxy()
+        retried = False
+        while True:
+            start = time.time()
+            try:
+                r = f(proxy)
+            except CONNECTION_ERRORS as exp:
+                proxy.close()
+                for method in methods:
+                    self.__record(method, (time.time() - start) / len(methods), error=True)
+
+                if retried or not self.NOT_RETRIED.isdisjoint(methods):
+                    raise
+
+                logging.info("Connection to bitcoind failed, reconnecting: %r" % exp)
+                with self.__lock:
+                    self.reconnects += 1
+                proxy = self.__connect()
+                retried = True
+                continue
+
+            except Exception:
+                # bitcoind answered; the connection is fine
+                for method in methods:
+                    self.__record(method, (time.time() - start) / len(methods), error=True)
+                self.__put_proxy(proxy)
+                raise
+
+            for method in methods:
+                self.__record(method, (time.time() - start) / len(methods))
+            self.__put_proxy(proxy)
+            return r
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(self.proxy_class, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.__with_proxy(lambda proxy: getattr(proxy, name)(*args, **kwargs), (name,))
+        return call
+
+    def call(self, method, *args):
+        """Call an RPC method, returning the raw JSON result"""
+        return self.__with_proxy(lambda proxy: proxy._call(method, *args), (method,))
+
+    def batch(self, calls, return_errors=False):
+        """Make several calls in one request
+
+        calls is a list of (method, *args) tuples. Returns the raw JSON results,
+        in the same order. If a call fails its JSONRPCError is raised, or with
+        return_errors, returned in place of its result.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        self.batch_sizes.add(len(calls))
+
+        request = [{'version': '1.1', 'method': call[0], 'params': call[1:], 'id': i}
+                   for i, call in enumerate(calls)]
+        responses = self.__with_proxy(lambda proxy: proxy._batch(request), [call[0] for call in calls])
+        if not isinstance(responses, list):
+            # bitcoind answers a batch it can't parse with a single error
+            raise bitcoin.rpc.JSONRPCError(responses.get('error') or
+                                           {'code': -342, 'message': 'non-batch response to batch request'})
+
+        results = [None] * len(calls)
+        for response in responses:
+            err = response.get('error')
+            if err is not None:
+                if not isinstance(err, dict):
+                    err = {'code': -344, 'message': str(err)}
+                results[response['id']] = bitcoin.rpc.JSONRPCError(err)
+            else:
+                results[response['id']] = response.get('result')
+
+        if not return_errors:
+            for result in results:
+                if isinstance(result, bitcoin.rpc.JSONRPCError):
+                    raise result
+        return results
+
+    def __batch_not_found(self, calls, error_class):
+        """batch(), with None for the calls that fail with error_class"""
+        results = self.batch(calls, return_errors=True)
+        for i, result in enumerate(results):
+            if isinstance(result, error_class):
+                results[i] = None
+            elif isinstance(result, bitcoin.rpc.JSONRPCError):
+                raise result
+        return results
+
+    def getblockhashes(self, heights):
+        """Batched getblockhash()
+
+        Raises IndexError if any of the heights isn't in the best chain.
+        """
+        hashes = self.__batch_not_found([('getblockhash', height) for height in heights],
+                                        bitcoin.rpc.InvalidParameterError)
+        if None in hashes:
+            raise IndexError('getblockhashes(): height out of range')
+        return [lx(hash) for hash in hashes]
+
+    def gettxouts(self, outpoints, includemempool=True):
+        """Batched gettxout()
+
+        Returns a list of gettxout() results, with None for the outpoints that
+        weren't found or were spent.
+        """
+        results = self.batch([('gettxout', b2lx(outpoint.hash), outpoint.n, includemempool)
+                              for outpoint in outpoints])
+        for r in results:
+            if r is not None:
+                r['txout'] = CTxOut(int(r['value'] * COIN), CScript(x(r['scriptPubKey']['hex'])))
+                del r['value']
+                del r['scriptPubKey']
+                r['bestblock'] = lx(r['bestblock'])
+        return results
+
+    def getrawtransactions(self, txids):
+        """Batched getrawtransaction(), with None for the txs that weren't found"""
+        results = self.__batch_not_found([('getrawtransaction', b2lx(txid), 0) for txid in txids],
+                                         bitcoin.rpc.InvalidAddressOrKeyError)
+        return [None if r is None else CTransaction.deserialize(x(r)) for r in results]
+
+    def stats(self):
+        """Return a JSON-serializable snapshot of per-method call stats"""
+        with self.__lock:
+            methods = {method: {'errors': self.__errors[method],
+                                'latencies': latencies.to_dict()}
+                       for method, latencies in self.__latencies.items()}
+            return {'methods': methods,
+                    'batch_sizes': self.batch_sizes.to_dict(),
+                    'connects': self.connects,
+                    'reconnects': self.reconnects,
+                    'idle_connections': len(self.__idle)}
@@ -0,0 +1,169 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Block notifications pushed by bitcoind
+
+Rather than waiting for the stamper to next poll bitcoind, these listeners call
+back with the hash of each new block as soon as bitcoind announces it.
+"""
+
+import logging
+import os
+import socket
+import threading
+
+from bitcoin.core import b2lx, lx
+
+
+class BlockListener:
+    """Calls callback(block_hash), from its own thread, for each new block
+
+    Block hashes are in the same byte order as bitcoin.rpc.Proxy returns them.
+    The listener stops once exit_event is set.
+    """
+
+    POLL_TIMEOUT = 1
+    """How long the listener waits for a notification before checking exit_event"""
+
+    def __init__(self, callback, exit_event):
+        self.callback = callback
+        self.exit_event = exit_event
+        self.n_notifications = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__loop, daemon=True)
+        self.thread.start()
+
+    def notify(self, block_hash):
+        logging.debug("Notified of block %s" % b2lx(block_hash))
+        self.n_notifications += 1
+        try:
+            self.callback(block_hash)
+        except Exception as exp:
+            logging.error("Block notification callback failed: %r" % exp, exc_info=True)
+
+    def listen(self):
+        """Wait for notifications, calling notify() for each; returns after POLL_TIMEOUT without any"""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __loop(self):
+        try:
+            while not self.exit_event.is_set():
+                try:
+                    self.listen()
+                except Exception as exp:
+                    logging.error("Block notification listener failed: %r" % exp, exc_info=True)
+                    self.exit_event.wait(self.POLL_TIMEOUT)
+        finally:
+            self.close()
+
+
+class ZmqBlockListener(BlockListener):
+    """Subscribes to bitcoind's ZMQ hashblock notifications
+
+    bitcoind must be run with -zmqpubhashblock=<endpoint>; requires the pyzmq
+    package.
+    """
+
+    def __init__(self, endpoint, callback, exit_event):
+        import zmq
+
+        super().__init__(callback, exit_event)
+        self.endpoint = endpoint
+
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+        self.socket.connect(endpoint)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    def listen(self):
+        for sock, event in self.poller.poll(self.POLL_TIMEOUT * 1000):
+            # topic, body, sequence number
+            msg = self.socket.recv_multipart()
+            if len(msg) < 2 or msg[0] != b'hashblock' or len(msg[1]) != 32:
+                logging.warning("Ignoring malformed ZMQ notification: %r" % msg)
+                continue
+
+            # The hash is published in display byte order, as in RPC hex
+            self.notify(msg[1][::-1])
+
+    def close(self):
+        self.socket.close(linger=0)
+        self.context.term()
+
+
+class UnixSocketBlockListener(BlockListener):
+    """Accepts block hashes, in hex, on a unix socket
+
+    Meant to be written to by bitcoind's -blocknotify, e.g.:
+
+        -blocknotify='echo %s | nc -U /path/to/socket'
+
+    Each connection may send any number of hashes, one per line.
+    """
+
+    MAX_NOTIFICATION_SIZE = 65536
+
+    def __init__(self, path, callback, exit_event):
+        super().__init__(callback, exit_event)
+        self.path = path
+
+        # Left behind by a previous run
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(16)
+        self.socket.settimeout(self.POLL_TIMEOUT)
+
+    def listen(self):
+        try:
+            conn, addr = self.socket.accept()
+        except socket.timeout:
+            return
+
+        with conn:
+            conn.settimeout(self.POLL_TIMEOUT)
+            data = b''
+            try:
+                while len(data) < self.MAX_NOTIFICATION_SIZE:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+            except socket.timeout:
+                logging.warning("Timed out reading block notification")
+
+        for line in data.split():
+            try:
+                block_hash = lx(line.decode())
+                if len(block_hash) != 32:
+                    raise ValueError('not 32 bytes')
+            except (ValueError, UnicodeDecodeError) as exp:
+                logging.warning("Ignoring malformed block notification %r: %r" % (line, exp))
+                continue
+
+            self.notify(block_hash)
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,122 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import hashlib
+import math
+import os
+import struct
+import threading
+
+
+class BloomFilter:
+    """Bloom filter over byte strings
+
+    There are no false negatives: if a key was added, it's always in the
+    filter. Keys that weren't added are in the filter with a probability that
+    depends on how full it is; see false_positive_rate().
+    """
+
+    SNAPSHOT_MAGIC = b'OTSBLOOM'
+    SNAPSHOT_HEADER = struct.Struct('>8sQQQ')
+
+    def __init__(self, capacity, error_rate=0.001):
+        """Create an empty filter
+
+        The filter is sized to hold capacity keys with the given false
+        positive rate; more keys can be added, at a higher rate.
+        """
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        self.__init_state(num_bits, num_hashes, 0, bytearray((num_bits + 7) // 8))
+
+    def __init_state(self, num_bits, num_hashes, count, bits):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.bits = bits
+        self.__lock = threading.Lock()
+
+    def __indexes(self, key):
+        # Double hashing, as per Kirsch and Mitzenmacher
+        h = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(h[0:8], 'little')
+        h2 = int.from_bytes(h[8:16], 'little') | 1
+        return [(h1 + i*h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        indexes = self.__indexes(key)
+        with self.__lock:
+            for i in indexes:
+                self.bits[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for i in self.__indexes(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """Number of keys added, including duplicates"""
+        return self.count
+
+    def false_positive_rate(self):
+        """Estimated false positive rate, given the number of keys added"""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def memory_size(self):
+        """Size of the filter's bit array, in bytes"""
+        return len(self.bits)
+
+    def stats(self):
+        return {'keys': self.count,
+                'bits': self.num_bits,
+                'hashes': self.num_hashes,
+                'memory_size': self.memory_size(),
+                'false_positive_rate': self.false_positive_rate()}
+
+    def save(self, path):
+        """Atomically save a snapshot of the filter to path"""
+        with self.__lock:
+            header = self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.num_bits, self.num_hashes, self.count)
+            bits = bytes(self.bits)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(header)
+            fd.write(bits)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot saved by save()
+
+        Raises ValueError if the snapshot is corrupt.
+        """
+        with open(path, 'rb') as fd:
+            snapshot = fd.read()
+
+        try:
+            magic, num_bits, num_hashes, count = cls.SNAPSHOT_HEADER.unpack_from(snapshot)
+        except struct.error:
+            raise ValueError("Bloom filter snapshot truncated")
+
+        bits = bytearray(snapshot[cls.SNAPSHOT_HEADER.size:])
+        if magic != cls.SNAPSHOT_MAGIC or not num_bits or not num_hashes or len(bits) != (num_bits + 7) // 8:
+            raise ValueError("Bloom filter snapshot corrupt")
+
+        self = cls.__new__(cls)
+        self.__init_state(num_bits, num_hashes, count, bits)
+        return self
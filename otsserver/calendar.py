@@ -9,11 +9,13 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import collections
+import concurrent.futures
 import hashlib
-import leveldb
 import logging
+import mmap
 import os
-import queue
+import resource
 import struct
 import sys
 import threading
@@ -27,6 +29,10 @@ from opentimestamps.timestamp import nonce_timestamp
 
 from bitcoin.core import b2x, b2lx
 
+from otsserver.bloom import BloomFilter
+from otsserver.stats import Histogram, LATENCY_BUCKETS, SIZE_BUCKETS
+from otsserver.storage import DEFAULT_BACKEND, LevelDbStore, open_store
+
 # If you can make 64-bit hash collisions we'll let you add your junk to our
 # calendar.
 HMAC_SIZE = 8
@@ -48,28 +54,92 @@ class Journal:
     """Append-only commitment storage
 
     The journal exists simply to make sure we never lose a commitment.
+
+    Reads are served from a read-only memory mapping of the journal file,
+    which is grown as the file is appended to.
     """
     COMMITMENT_SIZE = 4 + 32 + HMAC_SIZE
 
     def __init__(self, path):
         self.read_fd = open(path, "rb")
+        self.__map = None
+        self.__map_lock = threading.Lock()
+
+    def __remap(self):
+        """Grow the mapping to cover every complete entry in the journal
+
+        Returns the current mapping, or None if the journal is empty.
+        """
+        with self.__map_lock:
+            size = os.fstat(self.read_fd.fileno()).st_size
+            size -= size % self.COMMITMENT_SIZE
+
+            if size and (self.__map is None or size > len(self.__map)):
+                # Slices handed out earlier keep a reference to the old
+                # mapping, so it's left for the garbage collector to unmap.
+                self.__map = mmap.mmap(self.read_fd.fileno(), size, access=mmap.ACCESS_READ)
+
+            return self.__map
+
+    def __len__(self):
+        m = self.__remap()
+        return len(m) // self.COMMITMENT_SIZE if m is not None else 0
+
+    def slice(self, start, end=None):
+        """Get the raw journal entries from start up to, but not including, end
+
+        Returns a zero-copy memoryview over the mapped journal. The view is
+        truncated to the entries actually present in the journal, so it may be
+        shorter than asked for; it's empty if start is past the end.
+        """
+        m = self.__map
+        if m is None or end is None or end * self.COMMITMENT_SIZE > len(m):
+            m = self.__remap()
+            if m is None:
+                return memoryview(b'')
+
+        start = max(start, 0) * self.COMMITMENT_SIZE
+        end = len(m) if end is None else min(end * self.COMMITMENT_SIZE, len(m))
+        return memoryview(m)[start:max(start, end)]
+
+    @staticmethod
+    def __strip_hmac(commitment):
+        # Strip off HMAC if not present
+        if commitment[-HMAC_SIZE:] == b'\x00'*HMAC_SIZE:
+            commitment = commitment[:-HMAC_SIZE]
+        return commitment
+
+    def iter_commitments(self, start, end=None):
+        """Iterate over the commitments from start up to, but not including, end
+
+        Iteration stops early at the last complete entry in the journal.
+        """
+        entries = self.slice(start, end)
+        for i in range(0, len(entries), self.COMMITMENT_SIZE):
+            yield self.__strip_hmac(bytes(entries[i:i + self.COMMITMENT_SIZE]))
 
     def __getitem__(self, idx):
-        self.read_fd.seek(idx * self.COMMITMENT_SIZE)
-        commitment = self.read_fd.read(self.COMMITMENT_SIZE)
+        if idx < 0:
+            raise KeyError()
+
+        commitment = self.slice(idx, idx + 1)
 
         if len(commitment) == self.COMMITMENT_SIZE:
-            # Strip off HMAC if not present
-            if commitment[-HMAC_SIZE:] == b'\x00'*HMAC_SIZE:
-                commitment = commitment[:-HMAC_SIZE]
-            return commitment
+            return self.__strip_hmac(bytes(commitment))
         else:
             raise KeyError()
 
 
 class JournalWriter(Journal):
-    """Writer for the journal"""
-    def __init__(self, path):
+    """Writer for the journal
+
+    With group commit enabled, commitments are handed off to a background
+    thread that writes every commitment submitted since its last fsync in one
+    go, so concurrent submitters share a single write and fsync. New
+    commitments queue up for the next batch while the current one is being
+    synced.
+    """
+    def __init__(self, path, group_commit=False):
         self.append_fd = open(path, "ab")
 
         # In case a previous write partially failed, seek to a multiple of the
@@ -83,10 +153,63 @@ class JournalWriter(Journal):
 
         logging.info("Journal has %d entries" % (self.append_fd.tell() // self.COMMITMENT_SIZE))
 
-    def submit(self, commitment):
-        """Add a new commitment to the journal
+        self.batch_sizes = Histogram(SIZE_BUCKETS)
+        self.fsync_latencies = Histogram(LATENCY_BUCKETS)
 
-        Returns only after the commitment is syncronized to disk.
+        self.group_commit = group_commit
+        if self.group_commit:
+            logging.info("Journal group commit enabled")
+            self.__queue = []
+            self.__queue_cond = threading.Condition()
+
+            # Unacknowledged commitments are safe to lose, so there's no need
+            # to hold up shutdown for this thread.
+            self.__thread = threading.Thread(target=self.__loop, daemon=True)
+            self.__thread.start()
+
+    def __write_batch(self, batch):
+        """Write a batch of commitments, resolving their futures once synced"""
+        start = time.time()
+        try:
+            assert (self.append_fd.tell() % self.COMMITMENT_SIZE) == 0
+            self.append_fd.write(b''.join(commitment for commitment, future in batch))
+            self.append_fd.flush()
+            os.fsync(self.append_fd.fileno())
+
+        except Exception as exp:
+            logging.error("Failed to write %d commitments to the journal: %r" % (len(batch), exp))
+            for commitment, future in batch:
+                future.set_exception(exp)
+            return
+
+        latency = time.time() - start
+        self.batch_sizes.add(len(batch))
+        self.fsync_latencies.add(latency)
+
+        for commitment, future in batch:
+            future.set_result(None)
+
+        return latency
+
+    def __loop(self):
+        while True:
+            with self.__queue_cond:
+                while not self.__queue:
+                    self.__queue_cond.wait()
+
+                batch = self.__queue
+                self.__queue = []
+
+            latency = self.__write_batch(batch)
+            if latency is not None:
+                logging.debug("Journal synced %d commitments in %.1fms" % (len(batch), latency * 1000))
+
+    def submit_async(self, commitment):
+        """Add a new commitment to the journal, without waiting for it
+
+        Returns a concurrent.futures.Future that completes once the commitment
+        is syncronized to disk. Without group commit, the commitment has
+        already been written by the time this returns.
         """
         # Pad with null HMAC if necessary
         if len(commitment) == self.COMMITMENT_SIZE - HMAC_SIZE:
@@ -95,123 +218,585 @@ class JournalWriter(Journal):
         elif len(commitment) != self.COMMITMENT_SIZE:
             raise ValueError("Journal commitments must be exactly %d bytes long" % self.COMMITMENT_SIZE)
 
-        assert (self.append_fd.tell() % self.COMMITMENT_SIZE) == 0
-        self.append_fd.write(commitment)
-        self.append_fd.flush()
-        os.fsync(self.append_fd.fileno())
+        future = concurrent.futures.Future()
+        if self.group_commit:
+            with self.__queue_cond:
+                self.__queue.append((commitment, future))
+                self.__queue_cond.notify()
 
-class LevelDbCalendar:
-    def __init__(self, path):
-        self.db = leveldb.LevelDB(path)
+        else:
+            self.__write_batch([(commitment, future)])
+
+        return future
+
+    def submit(self, commitment):
+        """Add a new commitment to the journal
+
+        Returns only after the commitment is syncronized to disk.
+        """
+        self.submit_async(commitment).result()
+
+    def stats(self):
+        """Return a JSON-serializable snapshot of batch size and fsync latency stats"""
+        return {'group_commit': self.group_commit,
+                'batch_sizes': self.batch_sizes.to_dict(),
+                'fsync_latencies': self.fsync_latencies.to_dict()}
+
+class LRUCache:
+    """Bounded, thread-safe, least-recently-used cache
+
+    Writers invalidate entries by key, which also bumps the cache generation;
+    values looked up before an invalidation are refused by put(), so a reader
+    racing a writer can't cache stale data.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key):
+        """Get a cached value, raising KeyError on a miss"""
+        with self.__lock:
+            try:
+                value = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        """Cache a value that was looked up when the cache was at generation"""
+        with self.__lock:
+            if not self.max_size or generation != self.generation:
+                return
+
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self.__lock:
+            self.generation += 1
+            for key in keys:
+                self.__entries.pop(key, None)
+
+    def stats(self):
+        return {'size': len(self.__entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in bytes
+
+    ru_maxrss is in kilobytes on Linux and the BSDs, but already in bytes on
+    macOS.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class DbCalendar:
+    """Timestamp graph storage
+
+    Each timestamp node is stored under its msg, with the node's attestations
+    and ops serialized non-recursively; the results of the ops are nodes of
+    their own. Any storage backend implementing otsserver.storage.Store can be
+    used.
+    """
+
+    DEFAULT_CACHE_SIZE = 100000
+    """Default number of decoded timestamp nodes to cache"""
+
+    DEFAULT_BATCH_SIZE = 10000
+    """Default number of nodes add_timestamps() writes per sub-batch"""
+
+    BLOOM_FILTER_KEY_SIZES = (Journal.COMMITMENT_SIZE, Journal.COMMITMENT_SIZE - HMAC_SIZE)
+    """Sizes of the keys tracked by the Bloom filter
+
+    The hot paths that look up keys that mostly don't exist only ever look up
+    commitments, and commitments are only a fraction of all keys.
+    """
+
+    def __init__(self, store, cache_size=DEFAULT_CACHE_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.store = store
+        self.cache = LRUCache(cache_size)
+        self.batch_size = batch_size
+
+        self.bloom_filter = None
+        self.bloom_filter_path = None
+        self.bloom_filter_misses = 0
+        self.__bloom_filter_saved = False
+        self.__write_lock = threading.Lock()
+
+    def enable_bloom_filter(self, capacity, error_rate, snapshot_path=None):
+        """Keep a Bloom filter of the commitments in the calendar
+
+        Lookups of commitments the filter rules out never reach the store. The
+        filter is loaded from snapshot_path if there's a usable snapshot there,
+        and otherwise rebuilt with a scan of every key.
+
+        The snapshot is only saved by save_bloom_filter(), as at shutdown, and
+        is removed by the first write after that, so a crash forces a rebuild
+        rather than leaving a snapshot that is missing keys.
+        """
+        bloom_filter = None
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            try:
+                bloom_filter = BloomFilter.load(snapshot_path)
+            except ValueError as exp:
+                logging.error("Ignoring Bloom filter snapshot %r: %s" % (snapshot_path, exp))
+
+        if bloom_filter is not None and bloom_filter.count > capacity:
+            logging.info("Rebuilding Bloom filter, as %d keys exceeds its capacity of %d" %
+                         (bloom_filter.count, capacity))
+            bloom_filter = None
+
+        if bloom_filter is None:
+            logging.info("Building Bloom filter...")
+            start = time.time()
+            bloom_filter = BloomFilter(capacity, error_rate)
+            for key, value in self.store.range():
+                if len(key) in self.BLOOM_FILTER_KEY_SIZES:
+                    bloom_filter.add(key)
+            logging.info("Built Bloom filter in %.1f seconds" % (time.time() - start))
+
+            if snapshot_path is not None:
+                bloom_filter.save(snapshot_path)
+
+        if bloom_filter.count > capacity:
+            logging.warning("Bloom filter holds %d keys, more than its capacity of %d; consider increasing it" %
+                            (bloom_filter.count, capacity))
+
+        self.bloom_filter = bloom_filter
+        self.bloom_filter_path = snapshot_path
+        self.__bloom_filter_saved = snapshot_path is not None
+        logging.info("Bloom filter has %d keys, using %d bytes; estimated false positive rate %f" %
+                     (bloom_filter.count, bloom_filter.memory_size(), bloom_filter.false_positive_rate()))
+
+    def __definitely_missing(self, msg):
+        """Return True if the Bloom filter rules msg out"""
+        if self.bloom_filter is not None and len(msg) in self.BLOOM_FILTER_KEY_SIZES \
+                and msg not in self.bloom_filter:
+            self.bloom_filter_misses += 1
+            return True
+        else:
+            return False
+
+    def __begin_write(self):
+        self.__write_lock.acquire()
+        if self.__bloom_filter_saved:
+            # The snapshot won't have the keys about to be written
+            if os.path.exists(self.bloom_filter_path):
+                os.unlink(self.bloom_filter_path)
+            self.__bloom_filter_saved = False
+
+    def __add_to_bloom_filter(self, msgs):
+        """Add keys to the Bloom filter, before they're written
+
+        Keys already in the calendar are skipped, so the filter's count is of
+        distinct keys. The cache and store are checked directly, rather than
+        with __contains__(), so that writes don't count as Bloom filter misses.
+        """
+        if self.bloom_filter is not None:
+            for msg in msgs:
+                if len(msg) not in self.BLOOM_FILTER_KEY_SIZES:
+                    continue
+                if msg in self.bloom_filter and (msg in self.cache or msg in self.store):
+                    continue
+                self.bloom_filter.add(msg)
+
+    def __end_write(self):
+        self.__write_lock.release()
+
+    def save_bloom_filter(self):
+        """Save a snapshot of the Bloom filter, if it has changed since the last one"""
+        with self.__write_lock:
+            if self.bloom_filter_path is not None and not self.__bloom_filter_saved:
+                self.bloom_filter.save(self.bloom_filter_path)
+                self.__bloom_filter_saved = True
 
     def __contains__(self, msg):
+        if self.__definitely_missing(msg):
+            return False
+
+        return msg in self.cache or msg in self.store
+
+    def contains_many(self, msgs):
+        """Return the set of msgs in the calendar, out of many, checking the store in bulk"""
+        r = set()
+        remaining = []
+        for msg in msgs:
+            if self.__definitely_missing(msg):
+                continue
+            elif msg in self.cache:
+                r.add(msg)
+            else:
+                remaining.append(msg)
+
+        r.update(self.store.contains_many(remaining))
+        return r
+
+    def __get_node(self, msg):
+        """Get the attestations and ops of a single timestamp node
+
+        Nodes are returned as an (attestations, ops) tuple, where ops is a
+        tuple of (op, result msg) pairs. Decoded nodes are cached.
+        """
         try:
-            self.db.Get(msg)
-            return True
+            return self.cache.get(msg)
         except KeyError:
-            return False
+            pass
 
-    def __get_timestamp(self, msg):
-        """Get a timestamp, non-recursively"""
-        serialized_timestamp = self.db.Get(msg)
-        ctx = BytesDeserializationContext(serialized_timestamp)
+        if self.__definitely_missing(msg):
+            raise KeyError(msg)
 
-        timestamp = Timestamp(msg)
+        generation = self.cache.generation
+        serialized_timestamp = self.store.get(msg)
+        ctx = BytesDeserializationContext(serialized_timestamp)
 
+        attestations = set()
         for i in range(ctx.read_varuint()):
             attestation = TimeAttestation.deserialize(ctx)
-            assert attestation not in timestamp.attestations
-            timestamp.attestations.add(attestation)
+            assert attestation not in attestations
+            attestations.add(attestation)
 
+        ops = {}
         for i in range(ctx.read_varuint()):
             op = Op.deserialize(ctx)
-            assert op not in timestamp.ops
-            timestamp.ops.add(op)
+            assert op not in ops
+            ops[op] = op(msg)
 
-        return timestamp
+        node = (tuple(attestations), tuple(ops.items()))
+        self.cache.put(msg, node, generation)
+        return node
 
-    def __put_timestamp(self, new_timestamp, batch, batch_cache):
-        """Write a single timestamp, non-recursively"""
-        ctx = BytesSerializationContext()
+    def __get_timestamp(self, msg, memo):
+        """Get the timestamp for a message, reusing the sub-timestamps in memo
 
-        ctx.write_varuint(len(new_timestamp.attestations))
-        for attestation in new_timestamp.attestations:
-            attestation.serialize(ctx)
+        memo maps msgs to the timestamps already built for them.
+        """
+        try:
+            return memo[msg]
+        except KeyError:
+            pass
 
-        ctx.write_varuint(len(new_timestamp.ops))
-        for op in new_timestamp.ops:
-            op.serialize(ctx)
+        attestations, ops = self.__get_node(msg)
+
+        timestamp = Timestamp(msg)
+        timestamp.attestations.update(attestations)
+        for op, result in ops:
+            timestamp.ops[op] = self.__get_timestamp(result, memo)
 
-        batch.Put(new_timestamp.msg, ctx.getbytes())
-        batch_cache[new_timestamp.msg] = new_timestamp
+        memo[msg] = timestamp
+        return timestamp
 
     def __getitem__(self, msg):
         """Get the timestamp for a given message"""
-        timestamp = self.__get_timestamp(msg)
+        return self.__get_timestamp(msg, {})
 
-        for op, op_stamp in timestamp.ops.items():
-            timestamp.ops[op] = self[op_stamp.msg]
+    def get_timestamps(self, msgs):
+        """Get the timestamps for many messages in one pass
 
-        return timestamp
+        Returns a dict of msg to timestamp; messages not in the calendar are
+        left out. Commitments timestamped together share most of their proofs,
+        and every shared node is only looked up and built once. The timestamps
+        returned share those nodes, so they must not be modified.
+        """
+        memo = {}
+        timestamps = {}
+        for msg in msgs:
+            try:
+                timestamps[msg] = self.__get_timestamp(msg, memo)
+            except KeyError:
+                pass
+        return timestamps
+
+    @staticmethod
+    def __prefix_successor(prefix):
+        """Smallest key greater than every key starting with prefix
+
+        Returns None if there is no such key.
+        """
+        prefix = prefix.rstrip(b'\xff')
+        if not prefix:
+            return None
+        return prefix[:-1] + bytes([prefix[-1] + 1])
+
+    def scan_commitments(self, prefix, after=None, limit=100, max_scan=1000):
+        """Find the commitments starting with prefix, in order
+
+        Scanning starts after the key after, if given, and stops once limit
+        commitments have been found or max_scan keys have been looked at,
+        whichever comes first; the other nodes of the calendar are interleaved
+        with the commitments, so a short prefix could otherwise scan the whole
+        database.
+
+        Returns a (commitments, cursor) tuple. If the scan stopped early, cursor
+        is the key to pass as after to continue it; otherwise cursor is None.
+
+        The stamper adds each commitment as the root of its timestamp, exactly
+        as it's stored in the journal: with its HMAC, or for older commitments
+        made without one, stripped of the null HMAC. So commitments are the
+        keys of either size.
+        """
+        sizes = (Journal.COMMITMENT_SIZE, Journal.COMMITMENT_SIZE - HMAC_SIZE)
+
+        start = prefix
+        if after is not None and after >= prefix:
+            start = after + b'\x00'
+        end = self.__prefix_successor(prefix)
+
+        commitments = []
+        n_scanned = 0
+        for key, value in self.store.range(start, end):
+            if len(key) in sizes:
+                commitments.append(key)
+                if len(commitments) >= limit:
+                    return (commitments, key)
+
+            n_scanned += 1
+            if n_scanned >= max_scan:
+                return (commitments, key)
+
+        return (commitments, None)
+
+    @staticmethod
+    def __serialize_node(attestations, ops):
+        """Serialize a single node, non-recursively"""
+        ctx = BytesSerializationContext()
 
-    def __add_timestamp(self, new_timestamp, batch, batch_cache):
-        existing_timestamp = None
-        try:
-            if new_timestamp.msg in batch_cache:
-                existing_timestamp = batch_cache[new_timestamp.msg]
-            else:
-                existing_timestamp = self.__get_timestamp(new_timestamp.msg)
+        ctx.write_varuint(len(attestations))
+        for attestation in attestations:
+            attestation.serialize(ctx)
 
-        except KeyError:
-            existing_timestamp = Timestamp(new_timestamp.msg)
+        ctx.write_varuint(len(ops))
+        for op in ops:
+            op.serialize(ctx)
+
+        return ctx.getbytes()
+
+    def __merge_node(self, new_timestamp, pending):
+        """Merge a timestamp's own attestations and ops into the node for its msg
+
+        Changed nodes are added to pending, waiting to be written.
+        """
+        msg = new_timestamp.msg
+        if msg in pending:
+            attestations, ops = pending[msg]
 
         else:
-            if existing_timestamp == new_timestamp:
-                # Note how because we didn't get the existing timestamp
-                # recursively, the only way old and new can be identical is if all
-                # the ops are verify operations.
+            try:
+                existing_attestations, existing_ops = self.__get_node(msg)
+            except KeyError:
+                existing_attestations, existing_ops = (), ()
+
+            attestations = set(existing_attestations)
+            ops = set(op for op, result in existing_ops)
+
+            if attestations.issuperset(new_timestamp.attestations) and ops.issuperset(new_timestamp.ops) \
+                    and (attestations or ops):
+                # Nothing new
                 return
 
-        # Update the existing timestamps attestations with those from the new
-        # timestamp
-        existing_timestamp.attestations.update(new_timestamp.attestations)
+        attestations.update(new_timestamp.attestations)
+        ops.update(new_timestamp.ops)
+        pending[msg] = (attestations, ops)
 
-        for new_op, new_op_stamp in new_timestamp.ops.items():
-            # Make sure the existing timestamp has this operation
-            existing_timestamp.ops.add(new_op)
+    def __add_timestamp(self, new_timestamp, pending, visited):
+        """Add a timestamp, children first
 
-            # Add the results timestamp to the calendar
-            self.__add_timestamp(new_op_stamp, batch, batch_cache)
+        Walks the timestamp with an explicit stack, so proof depth isn't
+        limited by the recursion limit. Nodes are merged in post-order, so every
+        node is written after all the nodes below it. visited maps msgs to the
+        timestamps already added, to skip parts of the graph shared with
+        previously added timestamps.
+        """
+        if visited.get(new_timestamp.msg) is new_timestamp:
+            return
+        visited[new_timestamp.msg] = new_timestamp
+
+        stack = [(new_timestamp, iter(new_timestamp.ops.values()))]
+        while stack:
+            stamp, op_stamps = stack[-1]
+            for op_stamp in op_stamps:
+                if visited.get(op_stamp.msg) is not op_stamp:
+                    visited[op_stamp.msg] = op_stamp
+                    stack.append((op_stamp, iter(op_stamp.ops.values())))
+                    break
 
-        self.__put_timestamp(existing_timestamp, batch, batch_cache)
+            else:
+                stack.pop()
+                self.__merge_node(stamp, pending)
+
+    def __write_pending(self, pending, sync):
+        self.__add_to_bloom_filter(pending)
+        self.store.write_batch(((msg, self.__serialize_node(attestations, ops))
+                                for msg, (attestations, ops) in pending.items()),
+                               sync=sync)
+        self.cache.invalidate(pending)
 
     def add_timestamps(self, new_timestamps):
-        batch = leveldb.WriteBatch()
-        batch_cache = {}
+        """Add timestamps to the calendar
+
+        Changed nodes are written in sub-batches of about batch_size nodes, so
+        memory use doesn't grow with the number of timestamps added. As nodes
+        are written in post-order, and LevelDB never reorders writes, a node's
+        presence in the database guarantees its entire timestamp is too; the
+        root of each timestamp is its commit marker. Only the final sub-batch is
+        synced, which makes all earlier ones durable as well.
+
+        Returns a dict of stats on the number of timestamps added and nodes
+        written, throughput, and peak process memory use.
+        """
+        pending = {}
+        visited = {}
+
+        self.__begin_write()
+        try:
+            start = last = time.time()
+            n = 0
+            n_nodes = 0
+            n_batches = 0
+            for new_timestamp in new_timestamps:
+                self.__add_timestamp(new_timestamp, pending, visited)
+                n += 1
+
+                if len(pending) >= self.batch_size:
+                    self.__write_pending(pending, sync=False)
+                    n_nodes += len(pending)
+                    n_batches += 1
+                    pending.clear()
+                    visited.clear()
+
+                if n % 10000 == 0:
+                    now = time.time()
+                    logging.debug("Added %d timestamps to the database; %f stamps/second" %
+                                    (n, 10000.0 / (now - last)))
+                    last = now
+
+            self.__write_pending(pending, sync=True)
+            n_nodes += len(pending)
+            n_batches += 1
+        finally:
+            self.__end_write()
+
+        elapsed = time.time() - start
+        stats = {'timestamps': n,
+                 'nodes': n_nodes,
+                 'batches': n_batches,
+                 'seconds': elapsed,
+                 'timestamps_per_second': n / elapsed if elapsed else 0,
+                 'peak_rss': peak_rss()}
+        logging.debug("Done DbCalendar.add_timestamps(), added %d timestamps total; "
+                      "%d nodes in %d batches, %f stamps/second, peak RSS %.1f MiB" %
+                      (n, n_nodes, n_batches, stats['timestamps_per_second'], stats['peak_rss'] / 2**20))
+        return stats
+
+    def stats(self):
+        """Return a JSON-serializable snapshot of node cache and Bloom filter stats"""
+        stats = {'cache': self.cache.stats(),
+                 'bloom_filter': None}
+        if self.bloom_filter is not None:
+            stats['bloom_filter'] = self.bloom_filter.stats()
+            stats['bloom_filter']['misses'] = self.bloom_filter_misses
+        return stats
+
+    def write_nodes(self, nodes):
+        """Write already serialized timestamp nodes
+
+        nodes is an iterable of (msg, serialized node) pairs, in the format used
+        by backup chunks.
+        """
+        nodes = list(nodes)
+        self.__begin_write()
+        try:
+            self.__add_to_bloom_filter(set(msg for msg, serialized_node in nodes))
+            self.store.write_batch(nodes, sync=True)
+            self.cache.invalidate(msg for msg, serialized_node in nodes)
+        finally:
+            self.__end_write()
+
 
-        last = time.time()
+class LevelDbCalendar(DbCalendar):
+    """DbCalendar stored in a LevelDB database"""
+
+    def __init__(self, path, **kwargs):
+        super().__init__(LevelDbStore(path), **kwargs)
+
+class ProofStore:
+    """Complete serialized timestamps for confirmed commitments
+
+    Since only Bitcoin attestations are made, a commitment's timestamp never
+    changes once it's confirmed. Storing the serialized proof lets it be served
+    with a single lookup rather than by walking the timestamp graph.
+    """
+    def __init__(self, store, batch_size=DbCalendar.DEFAULT_BATCH_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+
+    def __contains__(self, commitment):
+        return commitment in self.store
+
+    def __getitem__(self, commitment):
+        """Get the serialized timestamp for a commitment"""
+        return self.store.get(commitment)
+
+    def add(self, commitment_timestamps):
+        """Serialize and save complete commitment timestamps
+
+        Proofs are written in batches of batch_size, so memory use doesn't grow
+        with the number of timestamps; only the last batch is synced.
+        """
+        batch = []
         n = 0
-        for new_timestamp in new_timestamps:
-            self.__add_timestamp(new_timestamp, batch, batch_cache)
-            n += 1
+        for commitment_timestamp in commitment_timestamps:
+            ctx = BytesSerializationContext()
+            commitment_timestamp.serialize(ctx)
+            batch.append((commitment_timestamp.msg, ctx.getbytes()))
+
+            if len(batch) >= self.batch_size:
+                self.store.write_batch(batch, sync=False)
+                n += len(batch)
+                batch = []
 
-            if n % 10000 == 0:
-                now = time.time()
-                logging.debug("Added %d timestamps to LevelDB; %f stamps/second" %
-                                (n, 10000.0 / (now - last)))
-                last = now
+        self.store.write_batch(batch, sync=True)
+        return n + len(batch)
 
-        self.db.Write(batch, sync = True)
-        logging.debug("Done LevelDbCalendar.add_timestamps(), added %d timestamps total" % n)
 
 class Calendar:
-    def __init__(self, path):
+    def __init__(self, path, journal_group_commit=False, db_backend=DEFAULT_BACKEND,
+                 db_cache_size=DbCalendar.DEFAULT_CACHE_SIZE, db_batch_size=DbCalendar.DEFAULT_BATCH_SIZE,
+                 bloom_filter_capacity=0, bloom_filter_error_rate=0.001, materialize_proofs=False):
         path = os.path.normpath(path)
         os.makedirs(path, exist_ok=True)
         self.path = path
-        self.journal = JournalWriter(path + '/journal')
+        self.journal = JournalWriter(path + '/journal', group_commit=journal_group_commit)
 
-        self.db = LevelDbCalendar(path + '/db')
+        logging.info("Opening %s calendar database" % db_backend)
+        self.db = DbCalendar(open_store(db_backend, path + '/db'), cache_size=db_cache_size, batch_size=db_batch_size)
+        if bloom_filter_capacity:
+            self.db.enable_bloom_filter(bloom_filter_capacity, bloom_filter_error_rate,
+                                        snapshot_path=path + '/db.' + db_backend + '.bloom')
+
+        self.proofs = None
+        if materialize_proofs:
+            self.proofs = ProofStore(open_store(db_backend, path + '/proofs'), batch_size=db_batch_size)
 
         try:
             uri_path = self.path + '/uri'
@@ -229,7 +814,11 @@ class Calendar:
             logging.error('HMAC secret key not set; %r does not exist' % hmac_key_path)
             sys.exit(1)
 
-    def submit(self, submitted_commitment):
+    def submit_async(self, submitted_commitment):
+        """Submit a commitment, without waiting for it to reach the journal
+
+        Returns a future that completes once the commitment is durable.
+        """
         idx = int(time.time())
 
         serialized_idx = struct.pack('>L', idx)
@@ -241,70 +830,280 @@ class Calendar:
         macced_commitment = commitment.ops.add(OpAppend(mac))
 
         macced_commitment.attestations.add(PendingAttestation(self.uri))
-        self.journal.submit(macced_commitment.msg)
+        return self.journal.submit_async(macced_commitment.msg)
+
+    def submit(self, submitted_commitment):
+        self.submit_async(submitted_commitment).result()
 
     def __contains__(self, commitment):
         return commitment in self.db
 
+    def contains_many(self, commitments):
+        """Return the set of commitments that have been timestamped, out of many"""
+        return self.db.contains_many(commitments)
+
     def __getitem__(self, commitment):
         """Get commitment timestamps(s)"""
         return self.db[commitment]
 
+    def get_serialized_timestamp(self, commitment):
+        """Get the serialized timestamp for a commitment
+
+        Uses the materialized proof if there is one, falling back to walking the
+        timestamp graph for commitments confirmed before proofs were
+        materialized.
+        """
+        if self.proofs is not None:
+            try:
+                return self.proofs[commitment]
+            except KeyError:
+                pass
+
+        ctx = BytesSerializationContext()
+        self.db[commitment].serialize(ctx)
+        return ctx.getbytes()
+
+    def get_serialized_timestamps(self, commitments):
+        """Get the serialized timestamps for many commitments
+
+        Returns a dict of commitment to serialized timestamp, leaving out
+        commitments not in the calendar. Materialized proofs are used where
+        there are any; the rest are looked up in one pass over the graph.
+        """
+        serialized_timestamps = {}
+        remaining = []
+        for commitment in commitments:
+            if self.proofs is not None:
+                try:
+                    serialized_timestamps[commitment] = self.proofs[commitment]
+                    continue
+                except KeyError:
+                    pass
+            remaining.append(commitment)
+
+        for commitment, timestamp in self.db.get_timestamps(remaining).items():
+            ctx = BytesSerializationContext()
+            timestamp.serialize(ctx)
+            serialized_timestamps[commitment] = ctx.getbytes()
+
+        return serialized_timestamps
+
+    def save_bloom_filter(self):
+        """Save the Bloom filter snapshot, so the next start doesn't rebuild it"""
+        self.db.save_bloom_filter()
+
+    def scan_commitments(self, prefix, after=None, limit=100, max_scan=1000):
+        """Find the commitments starting with prefix; see DbCalendar.scan_commitments()"""
+        return self.db.scan_commitments(prefix, after=after, limit=limit, max_scan=max_scan)
+
+    def stats(self):
+        """Return a JSON-serializable snapshot of journal and database stats"""
+        return {'journal': self.journal.stats(),
+                'db': self.db.stats()}
+
     def add_commitment_timestamps(self, new_timestamps):
         """Add timestamps"""
         self.db.add_timestamps(new_timestamps)
 
+    def materialize_commitment_timestamps(self, commitment_timestamps):
+        """Save the serialized proofs of complete commitment timestamps
 
-class Aggregator:
-    def __loop(self):
-        logging.info("Starting aggregator loop")
-        while not self.exit_event.wait(self.commitment_interval):
-            digests = []
-            done_events = []
-            last_commitment = time.time()
-            while not self.digest_queue.empty():
-                # This should never raise the Empty exception, as we should be
-                # the only thread taking items off the queue
-                (digest, done_event) = self.digest_queue.get_nowait()
-                digests.append(digest)
-                done_events.append(done_event)
-
-            if not len(digests):
-                continue
+        Does nothing unless proof materialization is enabled. Must only be
+        called once the timestamps are in the calendar itself.
+        """
+        if self.proofs is not None:
+            n = self.proofs.add(commitment_timestamps)
+            logging.debug("Materialized %d proofs" % n)
+
+
+class AggregatorBusyError(Exception):
+    """Raised when the aggregator has too many digests in flight to accept more"""
 
-            digests_commitment = make_merkle_tree(digests)
 
-            logging.info("Aggregated %d digests under commitment %s" % (len(digests), b2x(digests_commitment.msg)))
+class Aggregator:
+    """Aggregates submitted digests into commitments
+
+    Digests are aggregated under a single commitment, which is submitted to
+    the calendar, when any of the following happens: max_batch_size digests are
+    waiting; the oldest waiting digest has waited max_latency seconds. However,
+    at least min_commitment_interval seconds are always left between
+    commitments, which bounds the rate of journal writes and fsyncs.
+
+    Every digest in a batch waits on the same future, which completes once the
+    batch's commitment is durable. Submissions that would take the number of
+    digests in flight, waiting or being committed, over max_in_flight are
+    rejected with AggregatorBusyError.
+    """
 
-            self.calendar.submit(digests_commitment)
+    DEFAULT_MAX_BATCH_SIZE = 100000
+    """Default number of waiting digests that triggers a commitment"""
 
-            # Notify all requestors that the commitment is done
-            for done_event in done_events:
-                done_event.set()
+    IDLE_POLL_INTERVAL = 1
+    """How often to check for exit while there's nothing to aggregate"""
 
-    def __init__(self, calendar, exit_event, commitment_interval=1):
+    def __init__(self, calendar, exit_event, max_latency=1, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 min_commitment_interval=0, max_in_flight=None):
         self.calendar = calendar
-        self.commitment_interval = commitment_interval
-        self.digest_queue = queue.Queue()
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+        self.min_commitment_interval = min_commitment_interval
+        self.max_in_flight = max_in_flight
         self.exit_event = exit_event
+
+        self.__cond = threading.Condition()
+        self.__groups = []
+        self.__n_digests = 0
+        self.__first_submitted = None
+        self.__future = concurrent.futures.Future()
+        self.__last_commitment = 0
+        self.__n_in_flight = 0
+        self.rejected_digests = 0
+
+        self.batch_sizes = Histogram(SIZE_BUCKETS)
+        self.batch_latencies = Histogram(LATENCY_BUCKETS)
+
         self.thread = threading.Thread(target=self.__loop)
         self.thread.start()
 
+    def __next_batch(self):
+        """Wait for the next batch to be due
+
+        Returns a (digests, future, first_submitted) tuple, or None if the
+        batch isn't due yet. Must be called with the condition held.
+        """
+        if not self.__groups:
+            self.__cond.wait(self.IDLE_POLL_INTERVAL)
+            return None
+
+        earliest = self.__last_commitment + self.min_commitment_interval
+        if self.__n_digests < self.max_batch_size:
+            earliest = max(earliest, self.__first_submitted + self.max_latency)
+
+        now = time.time()
+        if now < earliest:
+            self.__cond.wait(earliest - now)
+            return None
+
+        digests = [digest for group in self.__groups for digest in group]
+        batch = (digests, self.__future, self.__first_submitted)
+
+        self.__groups = []
+        self.__n_digests = 0
+        self.__first_submitted = None
+        self.__future = concurrent.futures.Future()
+        self.__last_commitment = now
+        return batch
+
+    def __loop(self):
+        logging.info("Starting aggregator loop")
+        while not self.exit_event.is_set():
+            with self.__cond:
+                batch = self.__next_batch()
+            if batch is None:
+                continue
+
+            digests, future, first_submitted = batch
+            try:
+                digests_commitment = make_merkle_tree(digests)
+
+                logging.info("Aggregated %d digests under commitment %s" % (len(digests), b2x(digests_commitment.msg)))
+
+                durable = self.calendar.submit_async(digests_commitment)
+
+            except Exception as exp:
+                logging.error("Failed to aggregate %d digests: %r" % (len(digests), exp))
+                self.__done(len(digests))
+                future.set_exception(exp)
+                continue
+
+            # Notify all requestors once the commitment is done; with journal
+            # group commit that happens in the background while we go on to
+            # aggregate the next batch.
+            durable.add_done_callback(lambda durable, batch=batch: self.__notify(durable, *batch))
+
+    def __done(self, n):
+        with self.__cond:
+            self.__n_in_flight -= n
+
+    def __notify(self, durable, digests, future, first_submitted):
+        self.__done(len(digests))
+        if durable.exception() is not None:
+            logging.error("Failed to submit commitment: %r" % durable.exception())
+            future.set_exception(durable.exception())
+            return
+
+        self.batch_sizes.add(len(digests))
+        self.batch_latencies.add(time.time() - first_submitted)
+        future.set_result(None)
+
+    def stats(self):
+        """Return a JSON-serializable snapshot of batch size and latency stats
+
+        Latency is measured from the first digest of a batch being submitted to
+        its commitment being durable.
+        """
+        with self.__cond:
+            n_waiting = self.__n_digests
+            n_in_flight = self.__n_in_flight
+
+        return {'waiting_digests': n_waiting,
+                'in_flight_digests': n_in_flight,
+                'max_in_flight_digests': self.max_in_flight,
+                'rejected_digests': self.rejected_digests,
+                'batch_sizes': self.batch_sizes.to_dict(),
+                'batch_latencies': self.batch_latencies.to_dict()}
+
     def submit(self, msg):
         """Submit message for aggregation
 
         Aggregator thread will aggregate the message along with all other
         messages, and return a Timestamp
         """
-        timestamp = Timestamp(msg)
+        return self.submit_many([msg])[0]
+
+    def submit_many_async(self, msgs):
+        """Submit a group of messages for aggregation, without waiting
+
+        Returns a (timestamps, future) tuple. The timestamps, in the same order
+        as msgs, are complete once the future is.
+
+        Raises AggregatorBusyError if there are too many digests in flight.
+        """
+        with self.__cond:
+            if self.max_in_flight is not None and self.__n_in_flight + len(msgs) > self.max_in_flight:
+                self.rejected_digests += len(msgs)
+                raise AggregatorBusyError('%d digests in flight' % self.__n_in_flight)
+            self.__n_in_flight += len(msgs)
+
+        timestamps = [Timestamp(msg) for msg in msgs]
 
         # Add nonce to ensure requestor doesn't learn anything about other
         # messages being committed at the same time, as well as to ensure that
         # anything we store related to this commitment can't be controlled by
         # them.
-        done_event = threading.Event()
-        self.digest_queue.put((nonce_timestamp(timestamp), done_event))
+        nonced = [nonce_timestamp(timestamp) for timestamp in timestamps]
 
-        done_event.wait()
+        with self.__cond:
+            if not self.__groups:
+                self.__first_submitted = time.time()
+                self.__cond.notify()
 
-        return timestamp
+            self.__groups.append(nonced)
+            self.__n_digests += len(nonced)
+            if self.__n_digests >= self.max_batch_size:
+                self.__cond.notify()
+
+            future = self.__future
+
+        return (timestamps, future)
+
+    def submit_many(self, msgs):
+        """Submit a group of messages for aggregation
+
+        The group is handed to the aggregator as a single item, so this is much
+        cheaper than submitting each message on its own. Returns a list of
+        Timestamps, in the same order as msgs.
+        """
+        timestamps, future = self.submit_many_async(msgs)
+        future.result()
+        return timestamps
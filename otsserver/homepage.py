@@ -0,0 +1,150 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+from functools import reduce
+
+import bitcoin.core
+import pystache
+from bitcoin.core import b2lx, b2x
+
+import otsserver
+from otsserver.bitcoind import BitcoindClient
+
+renderer = pystache.Renderer()
+
+HOMEPAGE_TEMPLATE = """<html>
+<head>
+    <title>OpenTimestamps Calendar Server</title>
+</head>
+<body>
+<p>This is an <a href="https://opentimestamps.org">OpenTimestamps</a> <a href="https://github.com/opentimestamps/opentimestamps-server">Calendar Server</a> (v{{ version }})</p>
+<p>
+Pending commitments: {{ pending_commitments }}</br>
+Transactions waiting for confirmation: {{ txs_waiting_for_confirmation }}</br>
+Most recent timestamp tx: {{ most_recent_tx }} ({{ prior_versions }} prior versions)</br>
+Most recent merkle tree tip: {{ tip }}</br>
+Best-block: {{ best_block }}, height {{ block_height }}</br>
+</br>
+Wallet balance: {{ balance }} BTC</br>
+</p>
+<p>
+You can donate to the wallet by sending funds to: {{ address }}</br>
+This address changes after every donation.
+</p>
+<p>
+Average time between transactions in the last week: {{ time_between_transactions }} </br>
+Fees used in the last week: {{ fees_in_last_week }} BTC</br>
+Latest transactions: </br>
+{{#transactions}}
+    {{txid}} </br>
+{{/transactions}}
+</p>
+</body>
+</html>"""
+
+HomepageSnapshot = collections.namedtuple('HomepageSnapshot', ['time', 'stats', 'html', 'json'])
+
+
+class Homepage:
+    """Calendar stats shown on the homepage
+
+    Gathering them means several bitcoind calls, one of them listing the last
+    1000 wallet transactions, so rather than doing that for every request a
+    background thread takes a snapshot every refresh_interval seconds, and
+    whenever the stamper sees a new block. The snapshot is rendered once, and
+    requests are served the rendered page, or the stats as JSON, from memory.
+    """
+
+    DEFAULT_REFRESH_INTERVAL = 10
+
+    def __init__(self, calendar, exit_event, refresh_interval=DEFAULT_REFRESH_INTERVAL, bitcoind=None):
+        self.calendar = calendar
+        self.exit_event = exit_event
+        self.refresh_interval = refresh_interval
+        self.bitcoind = bitcoind if bitcoind is not None else BitcoindClient()
+
+        self.snapshot = None
+        """Most recent HomepageSnapshot; None until the first refresh succeeds"""
+
+        self.__refresh_event = threading.Event()
+
+        self.thread = threading.Thread(target=self.__loop, daemon=True)
+        self.thread.start()
+
+    def refresh_soon(self):
+        """Ask for the snapshot to be refreshed now, rather than on schedule"""
+        self.__refresh_event.set()
+
+    def get_stats(self):
+        proxy = self.bitcoind
+
+        # FIXME: Unfortunately getbalance() doesn't return the right thing;
+        # need to investigate further, but this seems to work.
+        str_wallet_balance = str(proxy.call("getbalance"))
+
+        transactions = proxy.call("listtransactions", "", 1000)
+        # We want only the confirmed txs containing an OP_RETURN, from most to least recent
+        transactions = list(filter(lambda x: x["confirmations"] > 0 and x["amount"] == 0, transactions))
+        a_week_ago = (datetime.date.today() - datetime.timedelta(days=7)).timetuple()
+        a_week_ago_posix = time.mktime(a_week_ago)
+        transactions_in_last_week = list(filter(lambda x: x["time"] > a_week_ago_posix, transactions))
+        fees_in_last_week = reduce(lambda a,b: a-b["fee"], transactions_in_last_week, 0)
+        try:
+            time_between_transactions = str(round(168 / len(transactions_in_last_week), 2)) # in hours based on 168 hours in a week
+            time_between_transactions += " hours"
+        except ZeroDivisionError:
+            time_between_transactions = "N/A"
+        transactions.sort(key=lambda x: x["confirmations"])
+
+        # The stamper thread replaces these as it goes, so work on copies
+        stamper = self.calendar.stamper
+        unconfirmed_txs = list(stamper.unconfirmed_txs)
+
+        return {'version': otsserver.__version__,
+                'pending_commitments': len(stamper.pending_commitments),
+                'txs_waiting_for_confirmation': len(stamper.txs_waiting_for_confirmation),
+                'most_recent_tx': b2lx(unconfirmed_txs[-1].tx.GetTxid()) if unconfirmed_txs else 'None',
+                'prior_versions': max(0, len(unconfirmed_txs) - 1),
+                'tip': b2x(unconfirmed_txs[-1].tip_timestamp.msg) if unconfirmed_txs else 'None',
+                'best_block': bitcoin.core.b2lx(proxy.getbestblockhash()),
+                'block_height': proxy.getblockcount(),
+                'balance': str_wallet_balance,
+                'address': str(proxy.getaccountaddress('')),
+                'transactions': [{'txid': tx['txid']} for tx in transactions[:5]],
+                'time_between_transactions': time_between_transactions,
+                'fees_in_last_week': str(fees_in_last_week),
+               }
+
+    def refresh(self):
+        """Take a new snapshot"""
+        stats = self.get_stats()
+        self.snapshot = HomepageSnapshot(time.time(),
+                                         stats,
+                                         renderer.render(HOMEPAGE_TEMPLATE, stats).encode(),
+                                         json.dumps(stats, indent=4, sort_keys=True).encode())
+
+    def __loop(self):
+        while not self.exit_event.is_set():
+            self.__refresh_event.clear()
+            try:
+                self.refresh()
+            except Exception as exp:
+                # bitcoind being unavailable shouldn't take the homepage down;
+                # keep serving the last snapshot until it's back.
+                logging.error("Failed to refresh homepage stats: %r" % exp)
+
+            self.__refresh_event.wait(self.refresh_interval)
@@ -0,0 +1,167 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Merkle trees of raw digests
+
+Both build the same trees as opentimestamps' make_merkle_tree(), without
+making a Timestamp per digest. See doc/merkle-mountain-range.md for merkle
+mountain ranges.
+"""
+
+import hashlib
+
+from opentimestamps.core.op import OpAppend, OpPrepend, OpSHA256
+from opentimestamps.core.timestamp import Timestamp
+
+
+def cat_sha256(left, right):
+    """Digest of two digests, as opentimestamps' cat_sha256() commits to them"""
+    return hashlib.sha256(left + right).digest()
+
+
+class MerkleMountainRange:
+    """Append-only merkle mountain range of digests
+
+    Only the peaks of the mountains are kept, so adding a digest costs at most
+    log2(n) hashes, and memory is O(log n) no matter how many digests are added.
+
+    The peaks are bagged right to left, so the tip is the same digest that
+    opentimestamps' make_merkle_tree() makes from the same digests: it pairs up
+    digests level by level, carrying an odd one out up to the next level,
+    which builds exactly these mountains.
+    """
+
+    def __init__(self, digests=()):
+        self.__peaks = []
+        """(height, digest) of each mountain, tallest first"""
+
+        self.n = 0
+        for digest in digests:
+            self.add(digest)
+
+    def __len__(self):
+        return self.n
+
+    def add(self, digest):
+        height = 0
+        while self.__peaks and self.__peaks[-1][0] == height:
+            left_height, left = self.__peaks.pop()
+            digest = cat_sha256(left, digest)
+            height += 1
+
+        self.__peaks.append((height, digest))
+        self.n += 1
+
+    def peaks(self):
+        return [digest for height, digest in self.__peaks]
+
+    def tip(self):
+        """Bag the peaks, returning the digest committing to every digest added"""
+        if not self.__peaks:
+            raise ValueError('Need at least one digest')
+
+        tip = self.__peaks[-1][1]
+        for height, peak in reversed(self.__peaks[:-1]):
+            tip = cat_sha256(peak, tip)
+        return tip
+
+
+class MerkleTree:
+    """Merkle tree of digests, kept as packed arrays of digests
+
+    Each level of the tree is a single bytes object of concatenated digests,
+    made by hashing the level below pair by pair, with an odd digest out
+    carried up unchanged, as make_merkle_tree() does; the root is the same
+    digest. Compared to a tree of Timestamps that's one object per level rather
+    than several per digest. The Timestamps themselves, with every leaf's proof,
+    are only made when needed, by make_timestamps().
+    """
+
+    DIGEST_SIZE = 32
+
+    def __init__(self, leaves):
+        level = bytes(leaves)
+        if not level or len(level) % self.DIGEST_SIZE:
+            raise ValueError('Need at least one digest, and only whole %d byte digests' % self.DIGEST_SIZE)
+
+        self.levels = [level]
+        while len(level) > self.DIGEST_SIZE:
+            level = self.__hash_level(level)
+            self.levels.append(level)
+
+    @classmethod
+    def __hash_level(cls, level):
+        pair_size = 2 * cls.DIGEST_SIZE
+        end = len(level) - len(level) % pair_size
+        view = memoryview(level)
+        sha256 = hashlib.sha256
+        return b''.join([sha256(view[i:i + pair_size]).digest() for i in range(0, end, pair_size)]) + level[end:]
+
+    def __len__(self):
+        return len(self.levels[0]) // self.DIGEST_SIZE
+
+    @property
+    def root(self):
+        return self.levels[-1]
+
+    def leaf(self, i):
+        return self.levels[0][i * self.DIGEST_SIZE:(i + 1) * self.DIGEST_SIZE]
+
+    def __digest(self, level, i):
+        return level[i * self.DIGEST_SIZE:(i + 1) * self.DIGEST_SIZE]
+
+    def make_timestamps(self, leaf_timestamps, start=0):
+        """Build the tree out of Timestamps, on top of leaf_timestamps
+
+        leaf_timestamps must be the Timestamps of a contiguous range of the
+        leaves, in order, starting with leaf start; by default, all of them.
+        Only the paths from those leaves to the root are made, with the digests
+        of nodes off those paths taken from the tree. The resulting Timestamps
+        are the same as make_merkle_tree() would make, but as every digest is
+        already known nothing is hashed again.
+
+        Returns the Timestamp of the root.
+        """
+        stamps = list(leaf_timestamps)
+        assert stamps and start + len(stamps) <= len(self)
+
+        lo = start
+        for level, next_level in zip(self.levels, self.levels[1:]):
+            n = len(level) // self.DIGEST_SIZE
+            hi = lo + len(stamps)
+
+            next_stamps = []
+            for parent_i in range(lo // 2, (hi - 1) // 2 + 1):
+                i = parent_i * 2
+                if i + 1 == n:
+                    # Odd one out, carried up as is
+                    next_stamps.append(stamps[i - lo])
+                    continue
+
+                left = stamps[i - lo] if i >= lo else None
+                right = stamps[i + 1 - lo] if i + 1 < hi else None
+                left_msg = left.msg if left is not None else self.__digest(level, i)
+                right_msg = right.msg if right is not None else self.__digest(level, i + 1)
+
+                cat_stamp = Timestamp(left_msg + right_msg)
+                if left is not None:
+                    left.ops[OpAppend(right_msg)] = cat_stamp
+                if right is not None:
+                    right.ops[OpPrepend(left_msg)] = cat_stamp
+
+                parent = Timestamp(self.__digest(next_level, parent_i))
+                cat_stamp.ops[OpSHA256()] = parent
+                next_stamps.append(parent)
+
+            stamps = next_stamps
+            lo //= 2
+
+        return stamps[0]
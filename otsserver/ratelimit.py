@@ -0,0 +1,99 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import threading
+import time
+
+
+class RateLimiter:
+    """Per-client token bucket rate limiting
+
+    Each client has a bucket of up to burst tokens, refilled at rate tokens per
+    second; every request takes tokens from its client's bucket, and is refused
+    if there aren't enough. A request for more than burst tokens is allowed
+    only with a full bucket, and leaves it in debt for the excess.
+    """
+
+    MAX_CLIENTS = 100000
+    """Maximum number of clients tracked
+
+    Beyond that, clients whose buckets have refilled are forgotten, and then,
+    if there are still too many, those least recently seen.
+    """
+
+    PRUNE_INTERVAL = 1
+    """Minimum seconds between scans for full buckets"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        self.__last_prune = 0
+        self.allowed = 0
+        self.refused = 0
+
+    def __prune(self, now):
+        """Forget clients whose buckets have refilled
+
+        Done at most every PRUNE_INTERVAL seconds, as it's a scan of every
+        client.
+        """
+        if now - self.__last_prune < self.PRUNE_INTERVAL:
+            return
+        self.__last_prune = now
+        self.__buckets = {client: (tokens, last) for client, (tokens, last) in self.__buckets.items()
+                                                 if tokens + (now - last) * self.rate < self.burst}
+
+    def __update(self, client, tokens, now):
+        # Re-inserted, so the buckets stay in order of when they were last used
+        self.__buckets.pop(client, None)
+        self.__buckets[client] = (tokens, now)
+
+    def allow(self, client, n=1):
+        """Take n tokens from a client's bucket
+
+        Returns True if there were enough, and False if the request should be
+        refused.
+        """
+        now = time.time()
+        with self.__lock:
+            bucket = self.__buckets.get(client)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+            if tokens < min(n, self.burst):
+                # Only clients already tracked are updated, so refusing
+                # requests never adds clients
+                if bucket is not None:
+                    self.__update(client, tokens, now)
+                self.refused += 1
+                return False
+
+            self.__update(client, tokens - n, now)
+            self.allowed += 1
+            if bucket is None and len(self.__buckets) > self.MAX_CLIENTS:
+                self.__prune(now)
+                while len(self.__buckets) > self.MAX_CLIENTS:
+                    del self.__buckets[next(iter(self.__buckets))]
+            return True
+
+    def stats(self):
+        with self.__lock:
+            n_clients = len(self.__buckets)
+
+        return {'rate': self.rate,
+                'burst': self.burst,
+                'clients': n_clients,
+                'allowed': self.allowed,
+                'refused': self.refused}
@@ -0,0 +1,97 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import concurrent.futures
+import logging
+import time
+
+import requests
+import requests.adapters
+
+from bitcoin.core import b2x
+
+from opentimestamps.core.serialize import BytesDeserializationContext, DeserializationError
+from opentimestamps.core.timestamp import Timestamp
+
+import otsserver
+
+
+class UpstreamCalendar:
+    """Submits aggregated commitments to a remote calendar
+
+    Used in place of a Calendar by the Aggregator of an aggregation server
+    that has no calendar of its own. Each commitment is submitted to the
+    upstream calendar's /digest, and the timestamp it returns is merged into
+    the commitment's, completing the timestamps of every digest aggregated
+    under it.
+
+    Requests are made over a pool of keep-alive connections. Those that fail in
+    a way that may be temporary, the connection failing, a 5xx or a 429, are
+    retried with exponential backoff; other errors are raised straight away.
+    """
+
+    DEFAULT_TIMEOUT = 10
+    DEFAULT_RETRIES = 3
+    DEFAULT_RETRY_DELAY = 1
+
+    MAX_CONCURRENT_REQUESTS = 4
+    """Largest number of commitments being submitted at once"""
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.MAX_CONCURRENT_REQUESTS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'application/vnd.opentimestamps.v1',
+                                     'User-Agent': 'OpenTimestamps Aggregator/%s' % otsserver.__version__})
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.MAX_CONCURRENT_REQUESTS)
+
+    def __post_digest(self, msg):
+        r = self.session.post(self.url + '/digest', data=msg, timeout=self.timeout)
+        r.raise_for_status()
+        return Timestamp.deserialize(BytesDeserializationContext(r.content), msg)
+
+    @staticmethod
+    def __is_retryable(exp):
+        if isinstance(exp, (requests.ConnectionError, requests.Timeout)):
+            return True
+        elif isinstance(exp, requests.HTTPError) and exp.response is not None:
+            status = exp.response.status_code
+            return status >= 500 or status == 429
+        else:
+            return False
+
+    def __submit(self, timestamp):
+        for attempt in range(self.retries + 1):
+            try:
+                upstream_timestamp = self.__post_digest(timestamp.msg)
+                break
+
+            except (requests.RequestException, DeserializationError) as exp:
+                if attempt == self.retries or not self.__is_retryable(exp):
+                    raise
+
+                delay = self.retry_delay * 2**attempt
+                logging.warning("Failed to submit %s to %s: %r; retrying in %d seconds" %
+                                (b2x(timestamp.msg), self.url, exp, delay))
+                time.sleep(delay)
+
+        timestamp.merge(upstream_timestamp)
+
+    def submit_async(self, timestamp):
+        """Submit a commitment, returning a future that completes once it's timestamped"""
+        return self.executor.submit(self.__submit, timestamp)
@@ -10,102 +10,195 @@
 # in the LICENSE file.
 
 import binascii
-import http.server
-import os
-import socketserver
-import threading
-import time
-import pystache
-import datetime 
-from functools import reduce
-
-import bitcoin.core
-from bitcoin.core import b2lx, b2x
+import json
+import urllib.parse
 
 from otsserver.backup import Backup
-import otsserver
-from opentimestamps.core.serialize import StreamSerializationContext
+from opentimestamps.core.serialize import BytesDeserializationContext, BytesSerializationContext, DeserializationError
 
-from otsserver.calendar import Journal
-renderer = pystache.Renderer()
+from otsserver.calendar import AggregatorBusyError, Journal
+from otsserver.web import AsyncServer, PendingResponse, Response, Service, ThreadedServer
 
-class RPCRequestHandler(http.server.BaseHTTPRequestHandler):
+
+class RPCService(Service):
     MAX_DIGEST_LENGTH = 64
     """Largest digest that can be POSTed for timestamping"""
 
-    digest_queue = None
+    MAX_BATCH_DIGESTS = 10000
+    """Largest number of digests that can be POSTed for timestamping at once"""
+
+    DEFAULT_PREFIX_LIMIT = 100
+    """Default number of timestamps returned by a prefix query"""
+
+    MAX_PREFIX_LIMIT = 1000
+    """Largest number of timestamps a prefix query can ask for"""
+
+    PREFIX_SCAN_FACTOR = 10
+    """Number of database keys a prefix query may scan per timestamp asked for"""
+
+    MAX_BATCH_COMMITMENTS = 1000
+    """Largest number of commitments that can be looked up in one request"""
+
+    MAX_COMMITMENT_LENGTH = 64
+    """Longest commitment that can be looked up in a batch"""
 
-    def post_digest(self):
-        content_length = int(self.headers['Content-Length'])
+    MAX_BODY_SIZE = max(MAX_BATCH_DIGESTS * (MAX_DIGEST_LENGTH + 1),
+                        MAX_BATCH_COMMITMENTS * (MAX_COMMITMENT_LENGTH + 1))
 
-        if content_length > self.MAX_DIGEST_LENGTH:
-            self.send_response(400)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'digest too long')
-            return
+    BATCH_FOUND = 0
+    BATCH_PENDING = 1
+    BATCH_NOT_FOUND = 2
 
-        digest = self.rfile.read(content_length)
+    RETRY_AFTER = 1
+    """Seconds clients are told to wait before retrying refused submissions"""
 
-        timestamp = self.aggregator.submit(digest)
+    NOT_FOUND = Response(404,
+                         [('Content-type', 'text/plain'),
+                          # a 404 is only going to become not a 404 if the server is upgraded
+                          ('Cache-Control', 'public, max-age=3600')],
+                         b'Not found')
 
-        self.send_response(200)
-        self.send_header('Content-type', 'application/octet-stream')
-        self.end_headers()
+    def __init__(self, aggregator, calendar=None, backup=None, homepage=None, rate_limiter=None, client_ip_header=None):
+        self.aggregator = aggregator
+        self.calendar = calendar
+        self.backup = backup
+        self.homepage = homepage
 
-        ctx = StreamSerializationContext(self.wfile)
-        timestamp.serialize(ctx)
+        self.rate_limiter = rate_limiter
+        """Optional otsserver.ratelimit.RateLimiter for digest submissions"""
 
-    def get_tip(self):
+        self.client_ip_header = client_ip_header
+        """Header with the client's IP, set by a reverse proxy; by default the peer's address is used"""
+
+    def client_ip(self, request):
+        if self.client_ip_header is not None and self.client_ip_header in request.headers:
+            return request.headers[self.client_ip_header]
+        return request.client_address[0]
+
+    def retry_later(self, code, message):
+        return Response(code,
+                        [('Content-type', 'text/plain'),
+                         ('Retry-After', str(self.RETRY_AFTER))],
+                        message)
+
+    def submit_digests(self, request, digests, make_response):
+        """Submit digests to the aggregator, subject to admission control
+
+        Returns a PendingResponse made by make_response(timestamps) once the
+        digests are timestamped, or an error Response if the submission was
+        refused.
+        """
+        if self.rate_limiter is not None and not self.rate_limiter.allow(self.client_ip(request), len(digests)):
+            return self.retry_later(429, b'too many requests')
+
+        try:
+            timestamps, future = self.aggregator.submit_many_async(digests)
+        except AggregatorBusyError:
+            return self.retry_later(503, b'server busy')
+
+        def finish():
+            if future.exception() is not None:
+                return self.retry_later(503, b'server busy')
+            return make_response(timestamps)
+
+        return PendingResponse(future, finish)
+
+    def post_digest(self, request):
+        if request.body is None or len(request.body) > self.MAX_DIGEST_LENGTH:
+            return Response(400, [('Content-type', 'text/plain')], b'digest too long')
+
+        def make_response(timestamps):
+            ctx = BytesSerializationContext()
+            timestamps[0].serialize(ctx)
+            return Response(200, [('Content-type', 'application/octet-stream')], ctx.getbytes())
+
+        return self.submit_digests(request, [request.body], make_response)
+
+    def post_digests(self, request):
+        """Timestamp many digests at once
+
+        The request body is a sequence of varbytes digests. They're aggregated
+        as a single group, and the response is their timestamps, in the same
+        order, each serialized as varbytes.
+        """
+        digests = []
+        if request.body is not None:
+            ctx = BytesDeserializationContext(request.body)
+            try:
+                while ctx.fd.tell() < len(request.body) and len(digests) <= self.MAX_BATCH_DIGESTS:
+                    digests.append(ctx.read_varbytes(self.MAX_DIGEST_LENGTH))
+            except DeserializationError:
+                digests = []
+
+        if not 0 < len(digests) <= self.MAX_BATCH_DIGESTS:
+            return Response(400, [('Content-type', 'text/plain')],
+                            b'expected 1 to %d varbytes digests of at most %d bytes' %
+                            (self.MAX_BATCH_DIGESTS, self.MAX_DIGEST_LENGTH))
+
+        def make_response(timestamps):
+            ctx = BytesSerializationContext()
+            for timestamp in timestamps:
+                timestamp_ctx = BytesSerializationContext()
+                timestamp.serialize(timestamp_ctx)
+                ctx.write_varbytes(timestamp_ctx.getbytes())
+            return Response(200, [('Content-type', 'application/octet-stream')], ctx.getbytes())
+
+        return self.submit_digests(request, digests, make_response)
+
+    def get_stats(self, request):
+        """Report aggregator, server, calendar and bitcoind RPC stats, as JSON"""
+        stats = {'aggregator': self.aggregator.stats(),
+                 'server': self.server.stats(),
+                 'rate_limiter': self.rate_limiter.stats() if self.rate_limiter is not None else None}
+        if self.calendar is not None:
+            stats['calendar'] = self.calendar.stats()
+        if self.homepage is not None:
+            # The same client as the stamper's, so this covers every call made
+            stats['bitcoind_rpc'] = self.homepage.bitcoind.stats()
+
+        return Response(200,
+                        [('Content-type', 'application/json'),
+                         ('Cache-Control', 'no-cache')],
+                        json.dumps(stats, indent=4, sort_keys=True).encode())
+
+    def get_tip(self, request):
         msg = self.calendar.stamper.unconfirmed_txs[-1].tip_timestamp.msg
         if msg is not None:
-            self.send_response(200)
-            self.send_header('Content-type', 'application/octet-stream')
-            self.send_header('Cache-Control', 'public, max-age=10')
-            self.end_headers()
-            self.wfile.write(msg)
+            return Response(200,
+                            [('Content-type', 'application/octet-stream'),
+                             ('Cache-Control', 'public, max-age=10')],
+                            msg)
         else:
-            self.send_response(204)
-            self.send_header('Cache-Control', 'public, max-age=10')
-            self.end_headers()
+            return Response(204, [('Cache-Control', 'public, max-age=10')], None)
 
-    def get_backup(self):
-        chunk = self.path[len('/experimental/backup/'):]
+    def get_backup(self, request):
+        chunk = request.path[len('/experimental/backup/'):]
         try:
             chunk = int(chunk)
             result = self.backup[chunk]
         except:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            return
+            return Response(404, [('Content-type', 'text/plain')], None)
 
         assert result is not None
-        self.send_response(200)
-        self.send_header('Content-type', 'application/octet-stream')
-        self.send_header('Cache-Control', 'public, max-age=31536000')
-        self.end_headers()
-        self.wfile.write(result)
+        return Response(200,
+                        [('Content-type', 'application/octet-stream'),
+                         ('Cache-Control', 'public, max-age=31536000')],
+                        result)
 
-    def get_timestamp(self):
-        commitment = self.path[len('/timestamp/'):]
+    def get_timestamp(self, request):
+        commitment = request.path[len('/timestamp/'):]
 
         try:
             commitment = binascii.unhexlify(commitment)
         except binascii.Error:
-            self.send_response(400)
-            self.send_header('Content-type', 'text/plain')
-            self.send_header('Cache-Control', 'public, max-age=31536000') # this will never not be an error!
-            self.end_headers()
-            self.wfile.write(b'commitment must be hex-encoded bytes')
-            return
+            return Response(400,
+                            [('Content-type', 'text/plain'),
+                             ('Cache-Control', 'public, max-age=31536000')], # this will never not be an error!
+                            b'commitment must be hex-encoded bytes')
 
         try:
-            timestamp = self.calendar[commitment]
+            serialized_timestamp = self.calendar.get_serialized_timestamp(commitment)
         except KeyError:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-
             # Pending?
             reason = self.calendar.stamper.is_pending(commitment)
             if reason:
@@ -113,7 +206,7 @@ class RPCRequestHandler(http.server.BaseHTTPRequestHandler):
 
                 # The commitment is pending, so its status will change soonish
                 # as blocks are found.
-                self.send_header('Cache-Control', 'public, max-age=60')
+                cache_control = 'public, max-age=60'
 
             else:
                 # The commitment isn't in this calendar at all. Clients only
@@ -130,143 +223,209 @@ class RPCRequestHandler(http.server.BaseHTTPRequestHandler):
                 #
                 # See https://github.com/opentimestamps/opentimestamps-server/issues/10
                 # for more info.
-                self.send_header('Cache-Control', 'public, max-age=60')
+                cache_control = 'public, max-age=60'
                 reason = b'Not found'
 
-            self.end_headers()
-            self.wfile.write(reason)
-            return
-
-        self.send_response(200)
+            return Response(404,
+                            [('Content-type', 'text/plain'),
+                             ('Cache-Control', cache_control)],
+                            reason)
 
         # Since only Bitcoin attestations are currently made, once a commitment
         # is timestamped by Bitcoin this response will never change.
-        self.send_header('Cache-Control', 'public, max-age=3600')
-
-        self.send_header('Content-type', 'application/octet-stream')
-        self.end_headers()
+        return Response(200,
+                        [('Cache-Control', 'public, max-age=3600'),
+                         ('Content-type', 'application/octet-stream')],
+                        serialized_timestamp)
+
+    def get_timestamps_prefix(self, request):
+        """Get the timestamps of every commitment starting with a prefix
+
+        The response is a sequence of (commitment, timestamp) pairs, each
+        serialized as varbytes. At most limit pairs are returned; if there may
+        be more, the X-Next-Cursor header is set, and passing it back as the
+        after parameter gets the next page.
+        """
+        url = urllib.parse.urlsplit(request.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            prefix = binascii.unhexlify(url.path[len('/timestamps/prefix/'):])
+            after = binascii.unhexlify(query['after'][-1]) if 'after' in query else None
+            limit = int(query['limit'][-1]) if 'limit' in query else self.DEFAULT_PREFIX_LIMIT
+            if not 0 < limit <= self.MAX_PREFIX_LIMIT:
+                raise ValueError('limit out of range')
+
+        except (binascii.Error, ValueError):
+            return Response(400,
+                            [('Content-type', 'text/plain'),
+                             ('Cache-Control', 'public, max-age=31536000')], # this will never not be an error!
+                            b'prefix and after must be hex-encoded bytes, and limit between 1 and %d' % self.MAX_PREFIX_LIMIT)
+
+        commitments, cursor = self.calendar.scan_commitments(prefix, after=after, limit=limit,
+                                                             max_scan=limit * self.PREFIX_SCAN_FACTOR)
+
+        ctx = BytesSerializationContext()
+        for commitment in commitments:
+            ctx.write_varbytes(commitment)
+            ctx.write_varbytes(self.calendar.get_serialized_timestamp(commitment))
+
+        headers = [('Content-type', 'application/octet-stream'),
+                   # New commitments matching the prefix show up as blocks are found
+                   ('Cache-Control', 'public, max-age=60')]
+        if cursor is not None:
+            headers.append(('X-Next-Cursor', binascii.hexlify(cursor).decode()))
+
+        return Response(200, headers, ctx.getbytes())
+
+    def post_timestamps(self, request):
+        """Look up the timestamps of many commitments
+
+        The request body is a sequence of varbytes commitments. The response
+        has one entry per commitment, in the same order: a status byte, then
+        for BATCH_FOUND the varbytes serialized timestamp, for BATCH_PENDING the
+        varbytes reason it's pending, and for BATCH_NOT_FOUND nothing.
+        """
+        commitments = []
+        if request.body is not None:
+            ctx = BytesDeserializationContext(request.body)
+            try:
+                while ctx.fd.tell() < len(request.body) and len(commitments) <= self.MAX_BATCH_COMMITMENTS:
+                    commitments.append(ctx.read_varbytes(self.MAX_COMMITMENT_LENGTH))
+            except DeserializationError:
+                commitments = []
 
-        timestamp.serialize(StreamSerializationContext(self.wfile))
+        if not 0 < len(commitments) <= self.MAX_BATCH_COMMITMENTS:
+            return Response(400, [('Content-type', 'text/plain')],
+                            b'expected 1 to %d varbytes commitments of at most %d bytes' %
+                            (self.MAX_BATCH_COMMITMENTS, self.MAX_COMMITMENT_LENGTH))
 
-    def do_POST(self):
-        if self.path == '/digest':
-            self.post_digest()
+        serialized_timestamps = self.calendar.get_serialized_timestamps(commitments)
 
+        ctx = BytesSerializationContext()
+        for commitment in commitments:
+            try:
+                serialized_timestamp = serialized_timestamps[commitment]
+            except KeyError:
+                reason = self.calendar.stamper.is_pending(commitment)
+                if reason:
+                    ctx.write_bytes(bytes([self.BATCH_PENDING]))
+                    ctx.write_varbytes(reason.encode())
+                else:
+                    ctx.write_bytes(bytes([self.BATCH_NOT_FOUND]))
+            else:
+                ctx.write_bytes(bytes([self.BATCH_FOUND]))
+                ctx.write_varbytes(serialized_timestamp)
+
+        return Response(200, [('Content-type', 'application/octet-stream')], ctx.getbytes())
+
+    def get_homepage(self, request):
+        snapshot = self.homepage.snapshot
+        if snapshot is None:
+            return self.retry_later(503, b'stats not available yet')
+
+        return Response(200,
+                        [('Content-type', 'text/html'),
+                         # Humans are likely to be refreshing this, so keep it up-to-date
+                         ('Cache-Control', 'public, max-age=1')],
+                        snapshot.html)
+
+    def get_homepage_stats(self, request):
+        """Get the homepage's stats, as JSON"""
+        snapshot = self.homepage.snapshot
+        if snapshot is None:
+            return self.retry_later(503, b'stats not available yet')
+
+        return Response(200,
+                        [('Content-type', 'application/json'),
+                         ('Cache-Control', 'public, max-age=1')],
+                        snapshot.json)
+
+    def handle(self, request):
+        if request.method == 'POST':
+            if request.path == '/digest':
+                return self.post_digest(request)
+            elif request.path == '/digests':
+                return self.post_digests(request)
+            elif request.path == '/timestamps':
+                return self.post_timestamps(request)
+            else:
+                return self.NOT_FOUND._replace(body=b'not found')
+
+        elif request.path == '/':
+            return self.get_homepage(request)
+        elif request.path.startswith('/timestamp/'):
+            return self.get_timestamp(request)
+        elif request.path.startswith('/timestamps/prefix/'):
+            return self.get_timestamps_prefix(request)
+        elif request.path == '/tip':
+            return self.get_tip(request)
+        elif request.path.startswith('/experimental/backup/'):
+            return self.get_backup(request)
+        elif request.path == '/experimental/stats':
+            return self.get_stats(request)
+        elif request.path == '/experimental/homepage':
+            return self.get_homepage_stats(request)
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
+            return self.NOT_FOUND
 
-            # a 404 is only going to become not a 404 if the server is upgraded
-            self.send_header('Cache-Control', 'public, max-age=3600')
 
-            self.end_headers()
-            self.wfile.write(b'not found')
+def make_stamp_service(aggregator, calendar, homepage, rate_limiter=None, client_ip_header=None):
+    journal = Journal(calendar.path + '/journal')
+    backup = Backup(journal, calendar, calendar.path + '/backup_cache')
+    return RPCService(aggregator, calendar, backup, homepage,
+                      rate_limiter=rate_limiter, client_ip_header=client_ip_header)
 
-    def do_GET(self):
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
 
-            # Humans are likely to be refreshing this, so keep it up-to-date
-            self.send_header('Cache-Control', 'public, max-age=1')
+class StampServer(ThreadedServer):
+    def __init__(self, server_address, aggregator, calendar, homepage,
+                 max_threads=None, rate_limiter=None, client_ip_header=None):
+        service = make_stamp_service(aggregator, calendar, homepage, rate_limiter, client_ip_header)
+        super().__init__(server_address, service, max_threads=max_threads)
 
-            self.end_headers()
 
-            proxy = bitcoin.rpc.Proxy()
+class AsyncStampServer(AsyncServer):
+    """StampServer, served with asyncio"""
+    def __init__(self, server_address, aggregator, calendar, homepage,
+                 max_workers=AsyncServer.DEFAULT_MAX_WORKERS, max_connections=None,
+                 rate_limiter=None, client_ip_header=None):
+        service = make_stamp_service(aggregator, calendar, homepage, rate_limiter, client_ip_header)
+        super().__init__(server_address, service,
+                         max_workers=max_workers, max_connections=max_connections)
 
-            # FIXME: Unfortunately getbalance() doesn't return the right thing;
-            # need to investigate further, but this seems to work.
-            str_wallet_balance = str(proxy._call("getbalance"))
 
-            transactions = proxy._call("listtransactions", "", 1000)
-            # We want only the confirmed txs containing an OP_RETURN, from most to least recent
-            transactions = list(filter(lambda x: x["confirmations"] > 0 and x["amount"] == 0, transactions))
-            a_week_ago = (datetime.date.today() - datetime.timedelta(days=7)).timetuple()
-            a_week_ago_posix = time.mktime(a_week_ago)
-            transactions_in_last_week = list(filter(lambda x: x["time"] > a_week_ago_posix, transactions))
-            fees_in_last_week = reduce(lambda a,b: a-b["fee"], transactions_in_last_week, 0)
-            try:
-                time_between_transactions = str(round(168 / len(transactions_in_last_week), 2)) # in hours based on 168 hours in a week
-                time_between_transactions += " hours"
-            except ZeroDivisionError:
-                time_between_transactions = "N/A"
-            transactions.sort(key=lambda x: x["confirmations"])
-            homepage_template = """<html>
-<head>
-    <title>OpenTimestamps Calendar Server</title>
-</head>
-<body>
-<p>This is an <a href="https://opentimestamps.org">OpenTimestamps</a> <a href="https://github.com/opentimestamps/opentimestamps-server">Calendar Server</a> (v{{ version }})</p>
-<p>
-Pending commitments: {{ pending_commitments }}</br>
-Transactions waiting for confirmation: {{ txs_waiting_for_confirmation }}</br>
-Most recent timestamp tx: {{ most_recent_tx }} ({{ prior_versions }} prior versions)</br>
-Most recent merkle tree tip: {{ tip }}</br>
-Best-block: {{ best_block }}, height {{ block_height }}</br>
-</br>
-Wallet balance: {{ balance }} BTC</br>
-</p>
-<p>
-You can donate to the wallet by sending funds to: {{ address }}</br>
-This address changes after every donation.
-</p>
-<p>
-Average time between transactions in the last week: {{ time_between_transactions }} </br>
-Fees used in the last week: {{ fees_in_last_week }} BTC</br>
-Latest transactions: </br>
-{{#transactions}}
-    {{txid}} </br>
-{{/transactions}}
-</p>
-</body>
-</html>"""
-
-            stats = { 'version': otsserver.__version__,
-              'pending_commitments': len(self.calendar.stamper.pending_commitments),
-              'txs_waiting_for_confirmation':len(self.calendar.stamper.txs_waiting_for_confirmation),
-              'most_recent_tx': b2lx(self.calendar.stamper.unconfirmed_txs[-1].tx.GetTxid()) if self.calendar.stamper.unconfirmed_txs else 'None',
-              'prior_versions': max(0, len(self.calendar.stamper.unconfirmed_txs) - 1),
-              'tip': b2x(self.calendar.stamper.unconfirmed_txs[-1].tip_timestamp.msg) if self.calendar.stamper.unconfirmed_txs else 'None',
-              'best_block': bitcoin.core.b2lx(proxy.getbestblockhash()),
-              'block_height': proxy.getblockcount(),
-              'balance': str_wallet_balance,
-              'address': str(proxy.getaccountaddress('')),
-              'transactions': transactions[:5],
-              'time_between_transactions': time_between_transactions,
-              'fees_in_last_week': fees_in_last_week,
-            }
-            welcome_page = renderer.render(homepage_template, stats)
-            self.wfile.write(str.encode(welcome_page))
-
-
-        elif self.path.startswith('/timestamp/'):
-            self.get_timestamp()
-        elif self.path == '/tip':
-            self.get_tip()
-        elif self.path.startswith('/experimental/backup/'):
-            self.get_backup()
-        else:
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
+class AggregationService(RPCService):
+    """Service that only accepts digests for aggregation"""
 
-            # a 404 is only going to become not a 404 if the server is upgraded
-            self.send_header('Cache-Control', 'public, max-age=3600')
+    MAX_BODY_SIZE = RPCService.MAX_BATCH_DIGESTS * (RPCService.MAX_DIGEST_LENGTH + 1)
 
-            self.end_headers()
-            self.wfile.write(b'Not found')
+    def handle(self, request):
+        if request.method == 'POST' and request.path == '/digest':
+            return self.post_digest(request)
+        elif request.method == 'POST' and request.path == '/digests':
+            return self.post_digests(request)
+        elif request.method == 'GET' and request.path == '/experimental/stats':
+            return self.get_stats(request)
+        else:
+            return self.NOT_FOUND
 
 
-class StampServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    def __init__(self, server_address, aggregator, calendar):
-        class rpc_request_handler(RPCRequestHandler):
-            pass
-        rpc_request_handler.aggregator = aggregator
-        rpc_request_handler.calendar = calendar
+class AggregationServer(ThreadedServer):
+    """Server for aggregating digests, without a local calendar
 
-        journal = Journal(calendar.path + '/journal')
-        rpc_request_handler.backup = Backup(journal, calendar, calendar.path + '/backup_cache')
+    With reuse_port, any number of processes can listen on the same port, and
+    the kernel balances connections between them.
+    """
+    def __init__(self, server_address, aggregator, reuse_port=False,
+                 max_threads=None, rate_limiter=None, client_ip_header=None):
+        service = AggregationService(aggregator, rate_limiter=rate_limiter, client_ip_header=client_ip_header)
+        super().__init__(server_address, service, reuse_port=reuse_port, max_threads=max_threads)
 
-        super().__init__(server_address, rpc_request_handler)
 
-    def serve_forever(self):
-        super().serve_forever()
+class AsyncAggregationServer(AsyncServer):
+    """AggregationServer, served with asyncio"""
+    def __init__(self, server_address, aggregator, reuse_port=False,
+                 max_workers=AsyncServer.DEFAULT_MAX_WORKERS, max_connections=None,
+                 rate_limiter=None, client_ip_header=None):
+        service = AggregationService(aggregator, rate_limiter=rate_limiter, client_ip_header=client_ip_header)
+        super().__init__(server_address, service, reuse_port=reuse_port,
+                         max_workers=max_workers, max_connections=max_connections)
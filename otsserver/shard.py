@@ -0,0 +1,231 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Sharded digest aggregation
+
+Aggregation workers are separate processes, each with its own Aggregator,
+listening on a shared port. Rather than committing to the journal themselves,
+workers send the merkle root of each batch to the process that owns the
+calendar. That process aggregates the roots from every worker as it would any
+other digests, and sends back the timestamp of each root, which the worker
+grafts on to the batch's tree to complete the timestamps of its digests.
+
+Workers listen on a port of their own, as they only accept digests; requests
+for everything else still have to go to the calendar process. Rate limits are
+also enforced by the calendar process, so that they apply across all workers.
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+
+from opentimestamps.core.serialize import BytesDeserializationContext, BytesSerializationContext
+from opentimestamps.core.timestamp import Timestamp
+
+from otsserver.calendar import Aggregator, AggregatorBusyError
+from otsserver.rpc import AggregationServer
+
+# Requests are a request id and kind, followed by either the root's msg, or the
+# number of digests and the client to take rate limit tokens for; replies are
+# the request id, a success flag, and either the root's serialized timestamp or
+# an error message. Rate limit replies have no body, the success flag being
+# whether the digests are allowed.
+REQUEST_HEADER = struct.Struct('>QB')
+REPLY_HEADER = struct.Struct('>Q?')
+RATE_LIMIT_HEADER = struct.Struct('>I')
+
+REQUEST_ROOT = 0
+REQUEST_RATE_LIMIT = 1
+
+
+class RootUplink:
+    """Submits batch roots to the calendar process
+
+    Used in place of a Calendar by a worker's Aggregator.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__next_request_id = 0
+
+        self.__thread = threading.Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+
+    def __request(self, kind, body, timestamp=None):
+        future = concurrent.futures.Future()
+        with self.__lock:
+            request_id = self.__next_request_id
+            self.__next_request_id += 1
+            self.__pending[request_id] = (timestamp, future)
+            self.conn.send_bytes(REQUEST_HEADER.pack(request_id, kind) + body)
+        return future
+
+    def submit_async(self, timestamp):
+        """Submit a root, returning a future that completes once it's timestamped"""
+        return self.__request(REQUEST_ROOT, timestamp.msg, timestamp)
+
+    def rate_limit_async(self, client, n):
+        """Take n rate limit tokens for a client, returning a future of whether there were enough"""
+        return self.__request(REQUEST_RATE_LIMIT, RATE_LIMIT_HEADER.pack(n) + client.encode())
+
+    def __loop(self):
+        while True:
+            try:
+                reply = self.conn.recv_bytes()
+            except EOFError:
+                # Without the calendar process there's nothing useful to do
+                logging.error("Lost connection to the calendar process; exiting")
+                os._exit(1)
+
+            request_id, ok = REPLY_HEADER.unpack_from(reply)
+            body = reply[REPLY_HEADER.size:]
+            with self.__lock:
+                timestamp, future = self.__pending.pop(request_id)
+
+            if timestamp is None:
+                future.set_result(ok)
+                continue
+
+            if not ok:
+                future.set_exception(Exception(body.decode()))
+                continue
+
+            try:
+                timestamp.merge(Timestamp.deserialize(BytesDeserializationContext(body), timestamp.msg))
+            except Exception as exp:
+                future.set_exception(exp)
+                continue
+
+            future.set_result(None)
+
+
+class UplinkRateLimiter:
+    """Rate limiter for a worker, taking tokens from the calendar process's buckets
+
+    Used in place of the worker's own RateLimiter, which would only limit the
+    requests that happen to reach that worker.
+    """
+
+    def __init__(self, uplink):
+        self.uplink = uplink
+
+    def allow(self, client, n=1):
+        return self.uplink.rate_limit_async(client, n).result()
+
+    def stats(self):
+        # Kept by the calendar process
+        return None
+
+
+def serve_worker(conn, aggregator, rate_limiter=None):
+    """Aggregate the roots sent by a worker, until it disconnects
+
+    Rate limit requests are checked against rate_limiter; with none, they're
+    all allowed.
+    """
+    send_lock = threading.Lock()
+
+    def reply_error(request_id, exp):
+        with send_lock:
+            conn.send_bytes(REPLY_HEADER.pack(request_id, False) + repr(exp).encode())
+
+    def reply(request_id, timestamp, future):
+        if future.exception() is not None:
+            reply_error(request_id, future.exception())
+            return
+
+        ctx = BytesSerializationContext()
+        timestamp.serialize(ctx)
+        with send_lock:
+            conn.send_bytes(REPLY_HEADER.pack(request_id, True) + ctx.getbytes())
+
+    while True:
+        try:
+            request = conn.recv_bytes()
+        except EOFError:
+            logging.error("Aggregation worker disconnected")
+            return
+
+        request_id, kind = REQUEST_HEADER.unpack_from(request)
+        body = request[REQUEST_HEADER.size:]
+        if kind == REQUEST_RATE_LIMIT:
+            n, = RATE_LIMIT_HEADER.unpack_from(body)
+            client = body[RATE_LIMIT_HEADER.size:].decode()
+            allowed = rate_limiter is None or rate_limiter.allow(client, n)
+            with send_lock:
+                conn.send_bytes(REPLY_HEADER.pack(request_id, allowed))
+            continue
+
+        try:
+            timestamps, future = aggregator.submit_many_async([body])
+        except AggregatorBusyError as exp:
+            reply_error(request_id, exp)
+            continue
+        future.add_done_callback(lambda future, request_id=request_id, timestamp=timestamps[0]:
+                                     reply(request_id, timestamp, future))
+
+
+def serve_workers(conns, aggregator, rate_limiter=None):
+    """Serve workers started by start_workers() with the calendar's aggregator and rate limiter"""
+    for conn in conns:
+        threading.Thread(target=serve_worker, args=(conn, aggregator, rate_limiter), daemon=True).start()
+
+
+def _worker_main(conn, inherited_conns, server_address, server_class, server_kwargs, aggregator_kwargs):
+    # Other workers' connections were inherited when forking; close them so
+    # that they see the calendar process exit.
+    for inherited_conn in inherited_conns:
+        inherited_conn.close()
+
+    exit_event = threading.Event()
+    uplink = RootUplink(conn)
+    aggregator = Aggregator(uplink, exit_event, **aggregator_kwargs)
+
+    # The inherited rate limiter is only this worker's copy
+    if server_kwargs.get('rate_limiter') is not None:
+        server_kwargs = dict(server_kwargs, rate_limiter=UplinkRateLimiter(uplink))
+    server = server_class(server_address, aggregator, reuse_port=True, **server_kwargs)
+    logging.info("Aggregation worker %d listening on %s:%d" % (os.getpid(), server_address[0], server_address[1]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        exit_event.set()
+
+
+def start_workers(n, server_address, server_class=AggregationServer, server_kwargs=None, **aggregator_kwargs):
+    """Start n aggregation worker processes, listening on server_address
+
+    Each worker has its own server_class server, created with server_kwargs, and
+    Aggregator, created with aggregator_kwargs. A rate_limiter in server_kwargs
+    is enforced by the calendar process instead, so must also be passed to
+    serve_workers(). The workers are forked, so
+    this must be called before any threads are started. Returns the
+    connections to the workers, to pass to serve_workers() once the calendar's
+    aggregator is running.
+    """
+    mp = multiprocessing.get_context('fork')
+    conns = []
+    for i in range(n):
+        conn, worker_conn = mp.Pipe()
+        process = mp.Process(target=_worker_main, name='aggregation-worker-%d' % i, daemon=True,
+                             args=(worker_conn, list(conns) + [conn], server_address,
+                                   server_class, server_kwargs or {}, aggregator_kwargs))
+        process.start()
+        worker_conn.close()
+        conns.append(conn)
+
+    return conns
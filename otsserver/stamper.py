@@ -10,24 +10,29 @@
 # in the LICENSE file.
 
 import collections
+import hashlib
+import itertools
 import logging
+import os
+import struct
 import threading
 import time
 import sys
 import bitcoin.rpc
 
-from bitcoin.core import COIN, b2lx, b2x, CTxIn, CTxOut, CTransaction, str_money_value
+from bitcoin.core import COIN, b2lx, b2x, lx, CTxIn, CTxOut, CTransaction, str_money_value
 from bitcoin.core.script import CScript, OP_RETURN
 
 from opentimestamps.bitcoin import cat_sha256d
 from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
 from opentimestamps.core.op import OpPrepend, OpSHA256
-from opentimestamps.core.timestamp import Timestamp, make_merkle_tree
+from opentimestamps.core.timestamp import Timestamp
 
+from otsserver.bitcoind import BitcoindClient, CONNECTION_ERRORS
 from otsserver.calendar import Journal
+from otsserver.merkle import MerkleMountainRange, MerkleTree
 
 KnownBlock = collections.namedtuple('KnownBlock', ['height', 'hash'])
-TimestampTx = collections.namedtuple('TimestampTx', ['tx', 'tip_timestamp', 'commitment_timestamps'])
 UnconfirmedTimestampTx = collections.namedtuple('TimestampTx', ['tx', 'tip_timestamp', 'n'])
 
 
@@ -50,7 +55,40 @@ def make_btc_block_merkle_tree(blk_txids):
     return digests[0]
 
 
-def make_timestamp_from_block_tx(confirmed_tx, block, blockheight):
+def make_btc_block_merkle_branch(blk_txids, i):
+    """Merkle branch of the i'th txid of a block
+
+    The tree is hashed one level at a time from packed digests, without
+    making a Timestamp per txid; only the branch is returned, as a list of
+    (sibling, sibling_is_right) from the txid up, along with the merkle root.
+    """
+    assert 0 <= i < len(blk_txids)
+
+    sha256 = hashlib.sha256
+    level = b''.join(blk_txids)
+    branch = []
+    while len(level) > 32:
+        # The famously broken Satoshi algorithm: if the # of digests at this
+        # level is odd, double the last one.
+        if len(level) % 64:
+            level += level[-32:]
+
+        sibling = i ^ 1
+        branch.append((level[sibling * 32:sibling * 32 + 32], sibling > i))
+
+        view = memoryview(level)
+        level = b''.join([sha256(sha256(view[j:j + 64]).digest()).digest() for j in range(0, len(level), 64)])
+        i //= 2
+
+    return level, branch
+
+
+def make_timestamp_from_block_tx(confirmed_tx, block, blockheight, blk_txids=None):
+    """Timestamp the tip of confirmed_tx, found in block
+
+    blk_txids, if given, are the txids of the block's transactions, in order,
+    saving having to compute them again.
+    """
 
     commitment_tx = confirmed_tx.tx
     serialized_tx = commitment_tx.serialize(params={'include_witness': False})
@@ -72,17 +110,19 @@ def make_timestamp_from_block_tx(confirmed_tx, block, blockheight):
 
     assert commitment_tx.GetTxid() == txid_stamp.msg
 
-    # Create the txid list, with our commitment txid op in the appropriate
-    # place
-    block_txid_stamps = []
-    for tx in block.vtx:
-        if tx.GetTxid() != txid_stamp.msg:
-            block_txid_stamps.append(Timestamp(tx.GetTxid()))
-        else:
-            block_txid_stamps.append(txid_stamp)
+    if blk_txids is None:
+        blk_txids = [tx.GetTxid() for tx in block.vtx]
+
+    # Only our own tx's branch of the block's merkle tree needs Timestamps
+    merkleroot, branch = make_btc_block_merkle_branch(blk_txids, blk_txids.index(txid_stamp.msg))
+    assert merkleroot == block.hashMerkleRoot
 
-    # Build the merkle tree
-    merkleroot_stamp = make_btc_block_merkle_tree(block_txid_stamps)
+    merkleroot_stamp = txid_stamp
+    for sibling, sibling_is_right in branch:
+        if sibling_is_right:
+            merkleroot_stamp = cat_sha256d(merkleroot_stamp, sibling)
+        else:
+            merkleroot_stamp = cat_sha256d(sibling, merkleroot_stamp)
     assert merkleroot_stamp.msg == block.hashMerkleRoot
 
     attestation = BitcoinBlockHeaderAttestation(blockheight)
@@ -91,12 +131,194 @@ def make_timestamp_from_block_tx(confirmed_tx, block, blockheight):
     return digest_timestamp
 
 
-class OrderedSet(collections.OrderedDict):
-    def add(self, item):
-        self[item] = ()
+class TimestampTx:
+    """A mined timestamp tx, waiting for confirmations
+
+    Rather than the timestamps of its commitments, only the commitments, the
+    merkle tree of their digests, and the timestamp of the tree's tip in the
+    block are kept; the commitments' timestamps are made by
+    make_commitment_timestamps(), once they're needed, a chunk at a time.
+    """
+    def __init__(self, tx, commitments, tree, block_timestamp):
+        assert len(commitments) == len(tree)
+        assert block_timestamp.msg == tree.root
+
+        self.tx = tx
+        self.commitments = commitments
+        self.tree = tree
+        self.block_timestamp = block_timestamp
+
+    def make_commitment_timestamps(self, chunk_size):
+        """Yield the commitments' timestamps, in lists of up to chunk_size
+
+        Each chunk is made only once the previous one has been consumed, so
+        only one chunk of timestamps is in memory at a time.
+        """
+        for start in range(0, len(self.commitments), chunk_size):
+            commitment_timestamps = []
+            digest_timestamps = []
+            for i in range(start, min(start + chunk_size, len(self.commitments))):
+                commitment_timestamp = Timestamp(self.commitments[i])
+                digest_timestamp = Timestamp(self.tree.leaf(i))
+                commitment_timestamp.ops[OpSHA256()] = digest_timestamp
+                commitment_timestamps.append(commitment_timestamp)
+                digest_timestamps.append(digest_timestamp)
+
+            self.tree.make_timestamps(digest_timestamps, start).merge(self.block_timestamp)
+            yield commitment_timestamps
+
+
+class PendingQueueView:
+    """Zero-copy view of the first n commitments of a PendingQueue
+
+    Only valid until commitments are next removed from the queue.
+    """
+    def __init__(self, queue, n):
+        self.queue = queue
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return self.queue[i]
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.queue[i]
+
+
+class PendingQueue:
+    """Queue of commitments waiting to be timestamped
+
+    Commitments are stored back to back in a single bytearray, in fixed-size
+    entries of the journal index the commitment was read from and its length,
+    followed by the commitment, zero-padded, with a set of the queued
+    commitments for de-duplication and membership tests. Commitments are only
+    ever taken from the front: views of a prefix of the queue don't copy it,
+    and removing a prefix just drops the start of the buffer.
+    """
+
+    ENTRY_HEADER = struct.Struct('>QB')
+    ENTRY_SIZE = ENTRY_HEADER.size + Journal.COMMITMENT_SIZE
+
+    def __init__(self):
+        self.__buf = bytearray()
+        self.__index = set()
+
+        # Journal indexes are mostly added in increasing order, but
+        # commitments put back by reorgs aren't, so the lowest is tracked with
+        # the (position, journal index) of every entry that's lower than all
+        # those after it. Positions count from the first entry ever added.
+        self.__start = 0
+        self.__lowest = collections.deque()
+
+    def __len__(self):
+        return len(self.__buf) // self.ENTRY_SIZE
+
+    def __contains__(self, commitment):
+        return commitment in self.__index
+
+    def __entry(self, i):
+        offset = i * self.ENTRY_SIZE
+        journal_idx, length = self.ENTRY_HEADER.unpack_from(self.__buf, offset)
+        offset += self.ENTRY_HEADER.size
+        return bytes(self.__buf[offset:offset + length]), journal_idx
+
+    def __getitem__(self, i):
+        """Get the ith commitment from the front of the queue"""
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.__entry(i)[0]
+
+    def __iter__(self):
+        return iter(self.prefix(len(self)))
+
+    def items(self):
+        """Iterate over the (commitment, journal index) of every entry"""
+        for i in range(len(self)):
+            yield self.__entry(i)
+
+    def first_journal_idx(self):
+        """Return the lowest journal index in the queue, or None if it's empty"""
+        return self.__lowest[0][1] if self.__lowest else None
+
+    def __track_lowest(self, position, journal_idx):
+        while self.__lowest and self.__lowest[-1][1] >= journal_idx:
+            self.__lowest.pop()
+        self.__lowest.append((position, journal_idx))
+
+    def add(self, commitment, journal_idx=0):
+        """Add a commitment to the end of the queue
+
+        Returns False if it was already queued.
+        """
+        if commitment in self.__index:
+            return False
+        if len(commitment) > Journal.COMMITMENT_SIZE:
+            raise ValueError('commitment too long: %d bytes' % len(commitment))
+
+        self.__track_lowest(self.__start + len(self), journal_idx)
+        self.__index.add(commitment)
+        self.__buf += self.ENTRY_HEADER.pack(journal_idx, len(commitment))
+        self.__buf += commitment
+        self.__buf += bytes(Journal.COMMITMENT_SIZE - len(commitment))
+        return True
+
+    def prefix(self, n):
+        """Get a view of the first n commitments"""
+        return PendingQueueView(self, min(n, len(self)))
+
+    def remove_prefix(self, n):
+        """Remove the first n commitments
+
+        Returns the removed commitments, as a queue of their own.
+        """
+        n = min(n, len(self))
+        removed = PendingQueue()
+        removed.__buf = self.__buf[:n * self.ENTRY_SIZE]
+        removed.__index = set(self.prefix(n))
+        for i, (commitment, journal_idx) in enumerate(removed.items()):
+            removed.__track_lowest(i, journal_idx)
+        self.__index.difference_update(removed.__index)
+
+        # Deleting from the front of a bytearray doesn't move the rest of it
+        del self.__buf[:n * self.ENTRY_SIZE]
+        self.__start += n
+        while self.__lowest and self.__lowest[0][0] < self.__start:
+            self.__lowest.popleft()
+        return removed
+
+
+class JournalCheckpoint:
+    """Durable record of how far into the journal every commitment is stamped
+
+    Every journal entry before the checkpoint's index is in the calendar, so
+    on restart the stamper only has to check the entries after it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """Return the checkpointed index, or 0 if there isn't one"""
+        try:
+            with open(self.path, 'r') as fd:
+                return int(fd.read().strip())
+        except FileNotFoundError:
+            return 0
+
+    def write(self, idx):
+        """Atomically replace the checkpoint"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            fd.write('%d\n' % idx)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp_path, self.path)
 
-    def remove(self, item):
-        self.pop(item)
 
 class KnownBlocks:
     """Maintain a list of known blocks"""
@@ -121,29 +343,38 @@ class KnownBlocks:
             self.__blocks.pop(-1)
 
     def update_from_proxy(self, proxy):
-        """Update from an RPC proxy
+        """Update from a BitcoindClient
+
+        The hashes of all the new blocks are fetched in a single request.
 
         Returns a list of new block heights, hashes
         """
         r = []
-        while not self.__blocks or proxy.getbestblockhash() != self.__blocks[-1].hash:
-            self.__detect_reorgs(proxy)
+        while True:
+            (best_hash, best_height) = proxy.batch([('getbestblockhash',), ('getblockcount',)])
+            if self.__blocks and lx(best_hash) == self.__blocks[-1].hash:
+                break
 
-            height = self.__blocks[-1].height + 1 if self.__blocks else proxy.getblockcount()
+            self.__detect_reorgs(proxy)
 
+            heights = range(self.__blocks[-1].height + 1 if self.__blocks else best_height, best_height + 1)
             try:
-                hash = proxy.getblockhash(height)
+                hashes = proxy.getblockhashes(heights)
             except IndexError:
                 continue
 
-            self.__blocks.append(KnownBlock(height, hash))
-            r.append(self.__blocks[-1])
+            for height, hash in zip(heights, hashes):
+                self.__blocks.append(KnownBlock(height, hash))
+                r.append(self.__blocks[-1])
 
         return r
 
     def best_block_height(self):
         return self.__blocks[-1].height if self.__blocks else 0
 
+    def best_block_hash(self):
+        return self.__blocks[-1].hash if self.__blocks else None
+
 
 def _get_tx_fee(tx, proxy):
     """Calculate tx fee
@@ -151,10 +382,8 @@ def _get_tx_fee(tx, proxy):
     Assumes inputs are confirmed
     """
     value_in = 0
-    for txin in tx.vin:
-        try:
-            r = proxy.gettxout(txin.prevout, False)
-        except IndexError:
+    for r in proxy.gettxouts([txin.prevout for txin in tx.vin], False):
+        if r is None:
             return None
         value_in += r['txout'].nValue
 
@@ -178,27 +407,35 @@ def find_unspent(proxy):
         # Try again with the unconfirmed transactions
         unconfirmed_unspent = sort_filter_unspent(proxy.listunspent(0, 1))
 
-        confirmed_unspent = []
-        for unspent_txout in unconfirmed_unspent:
-            txid = unspent_txout['outpoint'].hash
-            tx = proxy.getrawtransaction(txid)
-            for txin in tx.vin:
-                try:
-                    confirmed_outpoint = proxy.gettxout(txin.prevout, includemempool=False)
+        # Each step is a single batched request, covering every input of
+        # every unconfirmed tx
+        txs = proxy.getrawtransactions([unspent_txout['outpoint'].hash for unspent_txout in unconfirmed_unspent])
+        prevouts = [txin.prevout for tx in txs if tx is not None for txin in tx.vin]
 
-                    # make sure this txout is from a wallet transaction, which
-                    # means we can spend it
-                    proxy.gettransaction(txin.prevout.hash)
+        confirmed_outpoints = proxy.gettxouts(prevouts, includemempool=False)
 
-                    # All our txs will have a single input, with opt-in RBF set
-                    prevout_tx = proxy.getrawtransaction(txin.prevout.hash)
-                    if len(prevout_tx.vin) != 1 or prevout_tx.vin[0].nSequence != 0xfffffffd:
-                        continue
-                except IndexError:
-                    continue
+        # make sure these txouts are from wallet transactions, which means we
+        # can spend them
+        wallet_txs = proxy.batch([('gettransaction', b2lx(prevout.hash)) for prevout in prevouts], return_errors=True)
 
-                confirmed_unspent.append({'outpoint': txin.prevout,
-                                          'amount': confirmed_outpoint['txout'].nValue})
+        prevout_txs = proxy.getrawtransactions([prevout.hash for prevout in prevouts])
+
+        confirmed_unspent = []
+        for prevout, confirmed_outpoint, wallet_tx, prevout_tx in zip(prevouts, confirmed_outpoints,
+                                                                      wallet_txs, prevout_txs):
+            if confirmed_outpoint is None or prevout_tx is None:
+                continue
+            if isinstance(wallet_tx, bitcoin.rpc.InvalidAddressOrKeyError):
+                continue
+            elif isinstance(wallet_tx, bitcoin.rpc.JSONRPCError):
+                raise wallet_tx
+
+            # All our txs will have a single input, with opt-in RBF set
+            if len(prevout_tx.vin) != 1 or prevout_tx.vin[0].nSequence != 0xfffffffd:
+                continue
+
+            confirmed_unspent.append({'outpoint': prevout,
+                                      'amount': confirmed_outpoint['txout'].nValue})
 
         return sorted(confirmed_unspent, key=lambda x: x['amount'])
 
@@ -240,36 +477,69 @@ class Stamper:
                             nLockTime=new_min_block_height)
 
     def __save_confirmed_timestamp_tx(self, confirmed_tx):
-        """Save a fully confirmed timestamp to disk"""
-        self.calendar.add_commitment_timestamps(confirmed_tx.commitment_timestamps)
+        """Save a fully confirmed timestamp to disk
+
+        The timestamps are made in chunks of the calendar's write batch size,
+        separately for the calendar and the materialized proofs, rather than
+        all held in memory at once.
+        """
+        chunk_size = self.calendar.db.batch_size
+        self.calendar.add_commitment_timestamps(
+                itertools.chain.from_iterable(confirmed_tx.make_commitment_timestamps(chunk_size)))
+
+        # Only once the timestamps themselves are safely in the calendar, as
+        # materialized proofs are just a cache
+        if self.calendar.proofs is not None:
+            self.calendar.materialize_commitment_timestamps(
+                    itertools.chain.from_iterable(confirmed_tx.make_commitment_timestamps(chunk_size)))
         logging.info("tx %s fully confirmed, %d timestamps added to calendar" %
                      (b2lx(confirmed_tx.tx.GetTxid()),
-                      len(confirmed_tx.commitment_timestamps)))
+                      len(confirmed_tx.commitments)))
 
-    def __pending_to_merkle_tree(self, n):
-            # Update the most recent timestamp transaction with new commitments
-            commitment_timestamps = [Timestamp(commitment) for commitment in tuple(self.pending_commitments)[0:n]]
+    def __update_journal_checkpoint(self):
+        """Checkpoint the journal up to the first entry that isn't stamped yet
+
+        Every journal entry read that isn't pending or waiting for
+        confirmation is in the calendar.
+        """
+        outstanding = [self.pending_commitments.first_journal_idx()]
+        for ttx in self.txs_waiting_for_confirmation.values():
+            outstanding.append(ttx.commitments.first_journal_idx())
 
-            # Remember that commitment_timestamps contains raw commitments,
-            # which are longer than necessary, so we sha256 them before passing
-            # them to make_merkle_tree, which concatenates whatever it gets (or
-            # for the matter, returns what it gets if there's only one item for
-            # the tree!)
-            commitment_digest_timestamps = [stamp.ops.add(OpSHA256()) for stamp in commitment_timestamps]
+        checkpoint_idx = min((idx for idx in outstanding if idx is not None), default=self.journal_idx)
+        if checkpoint_idx > self.journal_checkpoint_idx:
+            self.journal_checkpoint.write(checkpoint_idx)
+            self.journal_checkpoint_idx = checkpoint_idx
+            logging.debug("Journal stamped up to idx %d" % checkpoint_idx)
+
+    def __add_pending(self, commitment, journal_idx):
+        """Add a commitment to pending_commitments, and to the pending tree
+
+        Must be called with __status_lock held.
+        """
+        if self.pending_commitments.add(commitment, journal_idx):
+            # Commitments are hashed before going in the tree, as they are by
+            # __pending_to_merkle_tree()
+            self.pending_mmr.add(hashlib.sha256(commitment).digest())
+
+    def __pending_to_merkle_tree(self, n):
+            # Remember that commitments are raw commitments, which are longer
+            # than necessary, so we sha256 them before making the tree, which
+            # concatenates whatever it gets (or for the matter, returns what it
+            # gets if there's only one item for the tree!)
+            sha256 = hashlib.sha256
+            digests = b''.join([sha256(commitment).digest() for commitment in self.pending_commitments.prefix(n)])
 
             logging.debug("Making merkle tree")
-            tip_timestamp = make_merkle_tree(commitment_digest_timestamps)
+            tree = MerkleTree(digests)
             logging.debug("Done making merkle tree")
 
-            return tip_timestamp, commitment_timestamps
+            return tree
 
     def __do_bitcoin(self):
         """Do Bitcoin-related maintenance"""
 
-        # FIXME: we shouldn't have to create a new proxy each time, but with
-        # current python-bitcoinlib and the RPC implementation it seems that
-        # the proxy connection can timeout w/o recovering properly.
-        proxy = bitcoin.rpc.Proxy()
+        proxy = self.bitcoind
 
         new_blocks = self.known_blocks.update_from_proxy(proxy)
 
@@ -282,22 +552,31 @@ class Stamper:
             logging.info("New block %s at height %d" % (b2lx(block_hash), block_height))
 
             # Save commitments to disk that have reached min_confirmations
-            confirmed_tx = self.txs_waiting_for_confirmation.pop(block_height - self.min_confirmations + 1, None)
+            confirmed_tx = self.txs_waiting_for_confirmation.get(block_height - self.min_confirmations + 1)
             if confirmed_tx is not None:
                 self.__save_confirmed_timestamp_tx(confirmed_tx)
 
+                # Only now that they're in the calendar, so they're always
+                # either there or pending
+                with self.__status_lock:
+                    del self.txs_waiting_for_confirmation[block_height - self.min_confirmations + 1]
+                    self.__unindex_waiting_tx(confirmed_tx)
+                self.__update_journal_checkpoint()
+
             # If there already are txs waiting for confirmation at this
             # block_height, there was a reorg and those pending commitments now
             # need to be added back to the pool
-            reorged_tx = self.txs_waiting_for_confirmation.pop(block_height, None)
-            if reorged_tx is not None:
-                # FIXME: the reorged transaction might get mined in another
-                # block, so just adding the commitments for it back to the pool
-                # isn't ideal, but it is safe
-                logging.info('tx %s at height %d removed by reorg, adding %d commitments back to pending'
-                             % (b2lx(reorged_tx.tx.GetTxid()), block_height, len(reorged_tx.commitment_timestamps)))
-                for reorged_commitment_timestamp in reorged_tx.commitment_timestamps:
-                    self.pending_commitments.add(reorged_commitment_timestamp.msg)
+            with self.__status_lock:
+                reorged_tx = self.txs_waiting_for_confirmation.pop(block_height, None)
+                if reorged_tx is not None:
+                    # FIXME: the reorged transaction might get mined in another
+                    # block, so just adding the commitments for it back to the pool
+                    # isn't ideal, but it is safe
+                    logging.info('tx %s at height %d removed by reorg, adding %d commitments back to pending'
+                                 % (b2lx(reorged_tx.tx.GetTxid()), block_height, len(reorged_tx.commitments)))
+                    self.__unindex_waiting_tx(reorged_tx)
+                    for reorged_commitment, journal_idx in reorged_tx.commitments.items():
+                        self.__add_pending(reorged_commitment, journal_idx)
 
             # Check if this block contains any of the pending transactions
             block = None
@@ -308,45 +587,50 @@ class Stamper:
                     # Must have been a reorg or something, return
                     logging.error("Failed to get block")
                     return
-                except BrokenPipeError:
-                    logging.error("BrokenPipeError to get block")
+                except CONNECTION_ERRORS as exp:
+                    logging.error("Failed to get block: %r" % exp)
                     time.sleep(5)
-                    proxy = bitcoin.rpc.Proxy()
 
             # the following is an optimization, by pre computing the tx_id we rapidly check if our unconfirmed tx
-            # is in the block
-            block_txids = set(tx.GetTxid() for tx in block.vtx)
+            # is in the block; the txids are reused to build the block timestamp
+            block_txids = [tx.GetTxid() for tx in block.vtx]
+            block_txid_set = set(block_txids)
 
             # Check all potential pending txs against this block.
             # iterating in reverse order to prioritize most recent digest which commits to a bigger merkle tree
             for unconfirmed_tx in self.unconfirmed_txs[::-1]:
 
-                if unconfirmed_tx.tx.GetTxid() not in block_txids:
+                if unconfirmed_tx.tx.GetTxid() not in block_txid_set:
                     continue
 
                 confirmed_tx = unconfirmed_tx  # Success! Found tx
-                block_timestamp = make_timestamp_from_block_tx(confirmed_tx, block, block_height)
+                block_timestamp = make_timestamp_from_block_tx(confirmed_tx, block, block_height, block_txids)
 
                 logging.info("Found commitment %s in tx %s"
                              % (b2x(confirmed_tx.tip_timestamp.msg), b2lx(confirmed_tx.tx.GetTxid())))
                 # Success!
-                (tip_timestamp, commitment_timestamps) = self.__pending_to_merkle_tree(confirmed_tx.n)
-                mined_tx = TimestampTx(confirmed_tx.tx, tip_timestamp, commitment_timestamps)
-                assert tip_timestamp.msg == unconfirmed_tx.tip_timestamp.msg
+                tree = self.__pending_to_merkle_tree(confirmed_tx.n)
+                assert tree.root == unconfirmed_tx.tip_timestamp.msg
+
+                # Move the commitments from pending to waiting for
+                # confirmations in one go, so they're never in neither
+                with self.__status_lock:
+                    commitments = self.pending_commitments.remove_prefix(unconfirmed_tx.n)
+                    mined_tx = TimestampTx(confirmed_tx.tx, commitments, tree, block_timestamp)
+                    logging.debug("Removed %d commitments from pending" % unconfirmed_tx.n)
 
-                mined_tx.tip_timestamp.merge(block_timestamp)
+                    # Add pending_tx to the list of timestamp transactions that
+                    # have been mined, and are waiting for confirmations.
+                    self.txs_waiting_for_confirmation[block_height] = mined_tx
+                    self.__index_waiting_tx(mined_tx)
 
-                for commitment in tuple(self.pending_commitments)[0:unconfirmed_tx.n]:
-                    self.pending_commitments.remove(commitment)
-                    logging.debug("Removed commitment %s from pending" % b2x(commitment))
+                # The commitments left start a new tree
+                self.pending_mmr = MerkleMountainRange(hashlib.sha256(commitment).digest()
+                                                       for commitment in self.pending_commitments)
 
                 assert self.min_confirmations > 1
                 logging.info("Success! %d commitments timestamped, now waiting for %d more confirmations" %
-                             (len(mined_tx.commitment_timestamps), self.min_confirmations - 1))
-
-                # Add pending_tx to the list of timestamp transactions that
-                # have been mined, and are waiting for confirmations.
-                self.txs_waiting_for_confirmation[block_height] = mined_tx
+                             (len(mined_tx.commitments), self.min_confirmations - 1))
 
                 # Erase all unconfirmed txs, as they all conflict with each other
                 self.unconfirmed_txs.clear()
@@ -357,6 +641,9 @@ class Stamper:
 
                 break
 
+        for callback in self.new_block_callbacks:
+            callback()
+
         time_to_next_tx = int(self.last_timestamp_tx + self.min_tx_interval - time.time())
         if time_to_next_tx > 0:
             # Minimum interval between transactions hasn't been reached, so do nothing
@@ -384,11 +671,11 @@ class Stamper:
             logging.debug('New timestamp tx, spending output %r, value %s' % (unspent[-1]['outpoint'],
                                                                               str_money_value(unspent[-1]['amount'])))
 
-        (tip_timestamp, commitment_timestamps) = self.__pending_to_merkle_tree(len(self.pending_commitments))
+        # Only the tip is needed until the tx is mined, and the mountain range
+        # has it ready; the full tree is made if and when it is.
+        n = len(self.pending_mmr)
+        tip_timestamp = Timestamp(self.pending_mmr.tip())
         logging.debug("New tip is %s" % b2x(tip_timestamp.msg))
-        # make_merkle_tree() seems to take long enough on really big adds
-        # that the proxy dies
-        proxy = bitcoin.rpc.Proxy()
 
         sent_tx = None
         relay_feerate = self.relay_feerate
@@ -427,13 +714,13 @@ class Stamper:
 
         if self.unconfirmed_txs:
             logging.info("Sent timestamp tx %s, replacing %s; %d total commitments; %d prior tx versions" %
-                         (b2lx(sent_tx.GetTxid()), b2lx(prev_tx.GetTxid()), len(commitment_timestamps),
+                         (b2lx(sent_tx.GetTxid()), b2lx(prev_tx.GetTxid()), n,
                           len(self.unconfirmed_txs)))
         else:
             logging.info("Sent timestamp tx %s; %d total commitments" % (b2lx(sent_tx.GetTxid()),
-                                                                         len(commitment_timestamps)))
+                                                                         n))
 
-        self.unconfirmed_txs.append(UnconfirmedTimestampTx(sent_tx, tip_timestamp, len(commitment_timestamps)))
+        self.unconfirmed_txs.append(UnconfirmedTimestampTx(sent_tx, tip_timestamp, n))
 
     def __loop(self):
         logging.info("Starting stamper loop")
@@ -446,24 +733,45 @@ class Stamper:
         except FileNotFoundError as exp:
             idx = 0
 
+        self.journal_checkpoint_idx = self.journal_checkpoint.read()
+        if self.journal_checkpoint_idx > idx:
+            logging.info("Journal stamped up to idx %d, skipping ahead" % self.journal_checkpoint_idx)
+            idx = self.journal_checkpoint_idx
+        self.journal_idx = idx
+
+        next_poll = 0
         while not self.exit_event.is_set():
-            # Get all pending commitments
+            # Get all pending commitments, checking whether they're already
+            # stamped a batch at a time
             while len(self.pending_commitments) < self.max_pending:
-                try:
-                    commitment = journal[idx]
-                except KeyError:
+                # Reading no more than there's room for in pending
+                n = min(self.JOURNAL_BATCH_SIZE, self.max_pending - len(self.pending_commitments))
+                commitments = list(journal.iter_commitments(idx, idx + n))
+                if not commitments:
                     break
-
-                # Is this commitment already stamped?
-                if commitment not in self.calendar:
-                    self.pending_commitments.add(commitment)
-                    logging.debug('Added %s (idx %d) to pending commitments; %d total'
-                                  % (b2x(commitment), idx, len(self.pending_commitments)))
-                else:
-                    if idx % 1000 == 0:
-                        logging.debug('Commitment at idx %d already stamped' % idx)
-
-                idx += 1
+                stamped = self.calendar.contains_many(commitments)
+
+                for commitment in commitments:
+                    # Is this commitment already stamped?
+                    if commitment not in stamped:
+                        with self.__status_lock:
+                            self.__add_pending(commitment, idx)
+                        logging.debug('Added %s (idx %d) to pending commitments; %d total'
+                                      % (b2x(commitment), idx, len(self.pending_commitments)))
+                    else:
+                        if idx % 1000 == 0:
+                            logging.debug('Commitment at idx %d already stamped' % idx)
+
+                    idx += 1
+                self.journal_idx = idx
+
+            # Without a block notification, only poll bitcoind every
+            # poll_interval seconds
+            if not self.__new_block_event.is_set() and time.time() < next_poll:
+                self.__new_block_event.wait(1)
+                continue
+            self.__new_block_event.clear()
+            next_poll = time.time() + self.poll_interval
 
             try:
                 self.__do_bitcoin()
@@ -480,29 +788,63 @@ class Stamper:
                 # __do_bitcoin() is fairly self-contained.
                 logging.error("__do_bitcoin() failed: %r" % exp, exc_info=True)
 
-            self.exit_event.wait(1)
+            self.__new_block_event.wait(1)
+
+    def notify_new_block(self, block_hash=None):
+        """Wake the stamper up to process a new block right away
+
+        Called by block notification listeners, from their own threads, rather
+        than waiting for the stamper to next poll bitcoind. Only the stamper's
+        own thread touches its state, so block_hash isn't looked at here; the
+        stamper finds out which blocks are new when it updates its known
+        blocks.
+        """
+        self.__new_block_event.set()
+
+    def __index_waiting_tx(self, ttx):
+        for commitment in ttx.commitments:
+            self.__waiting_commitments[commitment] = ttx
+
+    def __unindex_waiting_tx(self, ttx):
+        for commitment in ttx.commitments:
+            if self.__waiting_commitments.get(commitment) is ttx:
+                del self.__waiting_commitments[commitment]
 
     def is_pending(self, commitment):
         """Return whether or not a commitment is waiting to be stamped
 
         Returns False if not, or str reason if it is
         """
-        if commitment in self.pending_commitments:
-            return "Pending confirmation in Bitcoin blockchain"
+        with self.__status_lock:
+            if commitment in self.pending_commitments:
+                return "Pending confirmation in Bitcoin blockchain"
+
+            ttx = self.__waiting_commitments.get(commitment)
+
+        if ttx is not None:
+            return "Timestamped by transaction %s; waiting for %d confirmations"\
+                   % (b2lx(ttx.tx.GetTxid()), self.min_confirmations-1)
 
         else:
-            for height, ttx in self.txs_waiting_for_confirmation.items():
-               for commitment_timestamp in ttx.commitment_timestamps:
-                    if commitment == commitment_timestamp.msg:
-                        return "Timestamped by transaction %s; waiting for %d confirmations"\
-                               % (b2lx(ttx.tx.GetTxid()), self.min_confirmations-1)
+            return False
 
-            else:
-                return False
+    DEFAULT_POLL_INTERVAL = 1
 
-    def __init__(self, calendar, exit_event, relay_feerate, min_confirmations, min_tx_interval, max_fee, max_pending):
+    DEFAULT_NOTIFIED_POLL_INTERVAL = 60
+    """Default poll interval when block notifications are also used, as a fallback"""
+
+    JOURNAL_BATCH_SIZE = 10000
+    """Number of journal entries checked against the calendar at a time"""
+
+    def __init__(self, calendar, exit_event, relay_feerate, min_confirmations, min_tx_interval, max_fee, max_pending,
+                 bitcoind=None, poll_interval=DEFAULT_POLL_INTERVAL):
         self.calendar = calendar
         self.exit_event = exit_event
+        self.bitcoind = bitcoind if bitcoind is not None else BitcoindClient()
+
+        self.poll_interval = poll_interval
+        """How often bitcoind is polled for new blocks, in addition to notify_new_block()"""
+        self.__new_block_event = threading.Event()
 
         self.relay_feerate = relay_feerate
         self.min_confirmations = min_confirmations
@@ -514,10 +856,30 @@ class Stamper:
         self.known_blocks = KnownBlocks()
         self.unconfirmed_txs = []
 
-        self.pending_commitments = OrderedSet()
+        # Commitments move from pending_commitments to a tx in
+        # txs_waiting_for_confirmation, and from there to the calendar. Both,
+        # and the index of commitments waiting for confirmation, are only
+        # changed with __status_lock held, so is_pending() sees a consistent
+        # view from other threads.
+        self.__status_lock = threading.Lock()
+        self.pending_commitments = PendingQueue()
+
+        # Tree of every pending commitment, kept up to date as they're added,
+        # for the tip of the next timestamp tx
+        self.pending_mmr = MerkleMountainRange()
         self.txs_waiting_for_confirmation = {}
+        self.__waiting_commitments = {}
 
         self.last_timestamp_tx = 0
 
+        # Only used by the stamper thread
+        self.journal_checkpoint = JournalCheckpoint(self.calendar.path + '/journal.stamped')
+        self.journal_checkpoint_idx = 0
+        self.journal_idx = 0
+        """Index of the next journal entry to read"""
+
+        self.new_block_callbacks = []
+        """Called, without arguments, after new blocks have been processed"""
+
         self.thread = threading.Thread(target=self.__loop)
         self.thread.start()
@@ -0,0 +1,56 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import bisect
+import threading
+
+# Bucket upper bounds for latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Bucket upper bounds for batch sizes
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000)
+
+
+class Histogram:
+    """Thread-safe histogram of observed values
+
+    Values are counted in buckets with fixed, inclusive, upper bounds; values
+    larger than the last bound go in an overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.__lock = threading.Lock()
+        self.__buckets = [0] * (len(self.bounds) + 1)
+        self.__count = 0
+        self.__sum = 0
+        self.__max = 0
+
+    def add(self, value):
+        with self.__lock:
+            self.__buckets[bisect.bisect_left(self.bounds, value)] += 1
+            self.__count += 1
+            self.__sum += value
+            self.__max = max(self.__max, value)
+
+    def __len__(self):
+        return self.__count
+
+    def to_dict(self):
+        """Return a JSON-serializable snapshot of the histogram"""
+        with self.__lock:
+            buckets = [(str(bound), n) for bound, n in zip(self.bounds, self.__buckets)]
+            buckets.append(('+inf', self.__buckets[-1]))
+            return {'count': self.__count,
+                    'sum': self.__sum,
+                    'mean': self.__sum / self.__count if self.__count else 0,
+                    'max': self.__max,
+                    'buckets': buckets}
@@ -0,0 +1,335 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Key-value storage backends for calendar data"""
+
+import hashlib
+import heapq
+import sqlite3
+import threading
+
+import leveldb
+
+
+class Store:
+    """Ordered, durable, key-value store
+
+    Keys and values are bytes, and keys are ordered bytewise. Batches are
+    written atomically, and in the order they're written in.
+    """
+
+    PATH_SUFFIX = ''
+    """Appended to the path the store is opened with by open_store()"""
+
+    RANGE_PAGE_SIZE = 1000
+    """Number of items range scans read at a time, for backends that page"""
+
+    def get(self, key):
+        """Get the value for a key, raising KeyError if it doesn't exist"""
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def contains_many(self, keys):
+        """Return the set of keys that exist, out of many
+
+        Keys are looked up in order, which is much faster than at random for
+        large databases.
+        """
+        return set(key for key in sorted(set(keys)) if key in self)
+
+    def write_batch(self, items, sync=True):
+        """Atomically write an iterable of (key, value) pairs
+
+        If sync is true the batch, and every batch written before it, is
+        durable once this returns.
+        """
+        raise NotImplementedError
+
+    def range(self, start=None, end=None):
+        """Iterate over (key, value) pairs, in key order
+
+        Iterates over keys that are >= start, and < end; either may be None
+        for no limit.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LevelDbStore(Store):
+    def __init__(self, path):
+        self.db = leveldb.LevelDB(path)
+
+    def get(self, key):
+        return bytes(self.db.Get(key))
+
+    def write_batch(self, items, sync=True):
+        batch = leveldb.WriteBatch()
+        for key, value in items:
+            batch.Put(key, value)
+        self.db.Write(batch, sync=sync)
+
+    def range(self, start=None, end=None):
+        for key, value in self.db.RangeIter(key_from=start, include_value=True):
+            key = bytes(key)
+            if end is not None and key >= end:
+                break
+            yield key, bytes(value)
+
+
+class LmdbStore(Store):
+    """LMDB backed store
+
+    Reads are served from LMDB's memory map, and any number of threads, or
+    processes, can read concurrently. Every write is synced.
+
+    LMDB limits key size, 511 bytes by default, while timestamp messages can be
+    up to 4096 bytes. Longer keys are kept in a separate database, indexed by
+    their hash.
+    """
+
+    PATH_SUFFIX = '.lmdb'
+
+    DEFAULT_MAP_SIZE = 2**40
+    """Maximum database size; address space is reserved, not disk"""
+
+    def __init__(self, path, map_size=DEFAULT_MAP_SIZE):
+        import lmdb
+        self.env = lmdb.open(path, map_size=map_size, max_dbs=2, max_readers=1024, readahead=False)
+        self.nodes = self.env.open_db(b'nodes')
+        self.long_keys = self.env.open_db(b'long_keys')
+        self.max_key_size = self.env.max_key_size()
+
+    def __long_key(self, key):
+        return hashlib.sha256(key).digest()
+
+    @staticmethod
+    def __unpack_long_value(packed):
+        key_len = int.from_bytes(packed[0:2], 'big')
+        return bytes(packed[2:2 + key_len]), bytes(packed[2 + key_len:])
+
+    def get(self, key):
+        with self.env.begin(buffers=True) as txn:
+            if len(key) <= self.max_key_size:
+                value = txn.get(key, db=self.nodes)
+                if value is not None:
+                    return bytes(value)
+
+            else:
+                packed = txn.get(self.__long_key(key), db=self.long_keys)
+                if packed is not None:
+                    stored_key, value = self.__unpack_long_value(packed)
+                    if stored_key == key:
+                        return value
+
+        raise KeyError(key)
+
+    def contains_many(self, keys):
+        # One read transaction for them all; long keys are rare enough to look
+        # up one by one.
+        r = set()
+        long_keys = []
+        with self.env.begin(buffers=True, db=self.nodes) as txn:
+            for key in sorted(set(keys)):
+                if len(key) > self.max_key_size:
+                    long_keys.append(key)
+                elif txn.get(key) is not None:
+                    r.add(key)
+        r.update(key for key in long_keys if key in self)
+        return r
+
+    def write_batch(self, items, sync=True):
+        with self.env.begin(write=True) as txn:
+            for key, value in items:
+                if len(key) <= self.max_key_size:
+                    txn.put(key, value, db=self.nodes)
+                else:
+                    txn.put(self.__long_key(key), len(key).to_bytes(2, 'big') + key + value, db=self.long_keys)
+
+    def __range_long_keys(self, start, end):
+        # There are only ever a handful of these, so just sort them
+        r = []
+        with self.env.begin(buffers=True, db=self.long_keys) as txn:
+            for packed in txn.cursor().iternext(keys=False, values=True):
+                key, value = self.__unpack_long_value(packed)
+                if (start is None or key >= start) and (end is None or key < end):
+                    r.append((key, value))
+        return sorted(r)
+
+    def __range_nodes(self, start, end):
+        # Read a page at a time, rather than holding a read transaction open
+        # for as long as the caller takes to iterate.
+        page = True
+        while page:
+            page = []
+            with self.env.begin(buffers=True, db=self.nodes) as txn:
+                cursor = txn.cursor()
+                positioned = cursor.set_range(start) if start is not None else cursor.first()
+                while positioned and len(page) < self.RANGE_PAGE_SIZE:
+                    key = bytes(cursor.key())
+                    if end is not None and key >= end:
+                        break
+                    page.append((key, bytes(cursor.value())))
+                    positioned = cursor.next()
+
+            yield from page
+            if len(page) < self.RANGE_PAGE_SIZE:
+                break
+            start = page[-1][0] + b'\x00'
+
+    def range(self, start=None, end=None):
+        return heapq.merge(self.__range_nodes(start, end), self.__range_long_keys(start, end))
+
+    def close(self):
+        self.env.close()
+
+
+class SqliteStore(Store):
+    """SQLite backed store
+
+    Reads are made over a pool of connections, so concurrent readers don't
+    block each other, or the writer, in WAL mode. Up to max_idle_readers are
+    kept open between reads; any more are closed once they're done with.
+    """
+
+    PATH_SUFFIX = '.sqlite'
+
+    DEFAULT_MAX_IDLE_READERS = 4
+    """Number of idle reader connections kept open"""
+
+    def __init__(self, path, max_idle_readers=DEFAULT_MAX_IDLE_READERS):
+        self.path = path
+        self.max_idle_readers = max_idle_readers
+        self.__write_lock = threading.Lock()
+        self.__readers_lock = threading.Lock()
+        self.__idle_readers = []
+        self.n_readers = 0
+
+        self.__writer = self.__connect()
+        with self.__writer:
+            self.__writer.execute('CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID')
+
+    def __connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def __get_reader(self):
+        with self.__readers_lock:
+            if self.__idle_readers:
+                return self.__idle_readers.pop()
+            self.n_readers += 1
+        return self.__connect()
+
+    def __put_reader(self, conn):
+        with self.__readers_lock:
+            if len(self.__idle_readers) < self.max_idle_readers:
+                self.__idle_readers.append(conn)
+                return
+            self.n_readers -= 1
+        conn.close()
+
+    def __query(self, query, args):
+        """Run a read-only query, returning all its rows"""
+        conn = self.__get_reader()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            self.__put_reader(conn)
+
+    def get(self, key):
+        rows = self.__query('SELECT value FROM kv WHERE key = ?', (key,))
+        if not rows:
+            raise KeyError(key)
+        return rows[0][0]
+
+    MAX_QUERY_KEYS = 500
+    """Number of keys looked up per query by contains_many(), under SQLite's limit on query parameters"""
+
+    def contains_many(self, keys):
+        keys = sorted(set(keys))
+        r = set()
+        for i in range(0, len(keys), self.MAX_QUERY_KEYS):
+            chunk = keys[i:i + self.MAX_QUERY_KEYS]
+            query = 'SELECT key FROM kv WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            r.update(bytes(row[0]) for row in self.__query(query, chunk))
+        return r
+
+    def write_batch(self, items, sync=True):
+        with self.__write_lock:
+            conn = self.__writer
+            # In WAL mode, NORMAL keeps commits ordered and atomic but only
+            # makes them durable at the next FULL commit or checkpoint.
+            conn.execute('PRAGMA synchronous=%s' % ('FULL' if sync else 'NORMAL'))
+            conn.execute('BEGIN')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', items)
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+
+    def range(self, start=None, end=None):
+        op = '>='
+        while True:
+            query = 'SELECT key, value FROM kv WHERE 1'
+            args = []
+            if start is not None:
+                query += ' AND key %s ?' % op
+                args.append(start)
+            if end is not None:
+                query += ' AND key < ?'
+                args.append(end)
+            query += ' ORDER BY key LIMIT %d' % self.RANGE_PAGE_SIZE
+
+            page = self.__query(query, args)
+            yield from page
+            if len(page) < self.RANGE_PAGE_SIZE:
+                break
+            start = page[-1][0]
+            op = '>'
+
+    def close(self):
+        with self.__readers_lock:
+            for conn in self.__idle_readers:
+                conn.close()
+            self.n_readers -= len(self.__idle_readers)
+            self.__idle_readers = []
+        self.__writer.close()
+
+
+BACKENDS = {'leveldb': LevelDbStore,
+            'lmdb': LmdbStore,
+            'sqlite': SqliteStore}
+
+DEFAULT_BACKEND = 'leveldb'
+
+
+def open_store(backend, path):
+    """Open a store with a given backend
+
+    The backend's PATH_SUFFIX is appended to path, so stores with different
+    backends can live side by side.
+    """
+    try:
+        store_class = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown storage backend %r" % backend)
+
+    return store_class(path + store_class.PATH_SUFFIX)
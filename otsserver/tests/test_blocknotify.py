@@ -0,0 +1,105 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from bitcoin.core import b2lx
+
+from otsserver.blocknotify import UnixSocketBlockListener, ZmqBlockListener
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+class ListenerTests:
+    def setUp(self):
+        self.exit_event = threading.Event()
+        self.notifications = queue.Queue()
+
+    def start_listener(self, listener):
+        listener.start()
+        self.addCleanup(listener.thread.join)
+        self.addCleanup(self.exit_event.set)
+        return listener
+
+    def assertNotified(self, *block_hashes):
+        for block_hash in block_hashes:
+            self.assertEqual(self.notifications.get(timeout=5), block_hash)
+
+
+class Test_UnixSocketBlockListener(ListenerTests, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = tmpdir.name + '/blocknotify.sock'
+
+    def send(self, data):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall(data)
+
+    def test_notify(self):
+        listener = self.start_listener(UnixSocketBlockListener(self.path, self.notifications.put, self.exit_event))
+
+        block_hashes = [bytes([i])*32 for i in range(3)]
+        self.send(b2lx(block_hashes[0]).encode() + b'\n')
+        self.send(b'nothex\n' + b2lx(block_hashes[1]).encode() + b'\n\n' + b2lx(block_hashes[2]).encode())
+        self.assertNotified(*block_hashes)
+        self.assertEqual(listener.n_notifications, 3)
+
+    def test_stale_socket(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.path)
+
+        self.start_listener(UnixSocketBlockListener(self.path, self.notifications.put, self.exit_event))
+        self.send(b'00'*32)
+        self.assertNotified(b'\x00'*32)
+
+    def test_close(self):
+        listener = self.start_listener(UnixSocketBlockListener(self.path, self.notifications.put, self.exit_event))
+        self.exit_event.set()
+        listener.thread.join()
+        self.assertFalse(os.path.exists(self.path))
+
+
+@unittest.skipIf(zmq is None, "pyzmq not installed")
+class Test_ZmqBlockListener(ListenerTests, unittest.TestCase):
+    def test_notify(self):
+        # Stands in for bitcoind's -zmqpubhashblock publisher
+        context = zmq.Context()
+        self.addCleanup(context.term)
+        publisher = context.socket(zmq.PUB)
+        self.addCleanup(publisher.close, linger=0)
+        port = publisher.bind_to_random_port('tcp://127.0.0.1')
+
+        listener = self.start_listener(ZmqBlockListener('tcp://127.0.0.1:%d' % port,
+                                                        self.notifications.put, self.exit_event))
+
+        # Subscriptions take a moment to propagate, and messages published
+        # before then are dropped
+        block_hash = bytes(range(32))
+        deadline = time.time() + 5
+        while self.notifications.empty() and time.time() < deadline:
+            publisher.send_multipart([b'hashtx', b'\xff'*32, b'\x00'*4])
+            publisher.send_multipart([b'hashblock', block_hash[::-1], b'\x00'*4])
+            time.sleep(0.05)
+
+        self.assertNotified(block_hash)
+        self.assertGreaterEqual(listener.n_notifications, 1)
@@ -0,0 +1,52 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import os
+import tempfile
+import unittest
+
+from otsserver.bloom import *
+
+class Test_BloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = [os.urandom(44) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+
+        for key in keys:
+            self.assertIn(key, bloom)
+        self.assertEqual(len(bloom), 1000)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(os.urandom(44))
+
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.005)
+
+        false_positives = sum(os.urandom(44) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as path:
+            bloom = BloomFilter(100)
+            bloom.add(b'foo')
+            bloom.save(path + '/bloom')
+
+            bloom2 = BloomFilter.load(path + '/bloom')
+            self.assertIn(b'foo', bloom2)
+            self.assertEqual(bloom2.stats(), bloom.stats())
+
+            with open(path + '/bloom', 'r+b') as fd:
+                fd.truncate(20)
+            with self.assertRaises(ValueError):
+                BloomFilter.load(path + '/bloom')
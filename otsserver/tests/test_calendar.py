@@ -9,14 +9,23 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import hashlib
+import os
+import sys
 import tempfile
+import threading
 import unittest
 
 from bitcoin.core import *
 
+from opentimestamps.core.notary import BitcoinBlockHeaderAttestation, PendingAttestation
+from opentimestamps.core.serialize import BytesSerializationContext
 from opentimestamps.core.timestamp import *
 
+from otsserver.bloom import BloomFilter
 from otsserver.calendar import *
+from otsserver.merkle import MerkleTree
+from otsserver.stamper import TimestampTx
 
 class Test_LevelDbCalendar(unittest.TestCase):
     def test_creation(self):
@@ -66,3 +75,408 @@ class Test_LevelDbCalendar(unittest.TestCase):
             for root in roots:
                 retrieved_root = cal[root.msg]
                 self.assertEqual(root, retrieved_root)
+
+    def test_small_batches(self):
+        """Timestamps added over many sub-batches"""
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path, batch_size=3)
+
+            roots = [Timestamp(bytes([i])) for i in range(256)]
+            merkle_tip = make_merkle_tree(roots)
+            merkle_tip.attestations.add(PendingAttestation('http://example.com'))
+
+            stats = cal.add_timestamps(roots)
+            self.assertEqual(stats['timestamps'], 256)
+            self.assertGreater(stats['batches'], 1)
+
+            for root in roots:
+                self.assertEqual(cal[root.msg], root)
+
+    def test_deep_timestamp(self):
+        """Timestamps deeper than the recursion limit can be added"""
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path, batch_size=100)
+
+            t = root = Timestamp(b'foo')
+            for i in range(sys.getrecursionlimit() * 2):
+                t = t.ops.add(OpSHA256())
+
+            cal.add_timestamps([root])
+            self.assertIn(root.msg, cal)
+            self.assertIn(t.msg, cal)
+
+    def test_bloom_filter(self):
+        """Commitments ruled out by the Bloom filter skip the store"""
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path + '/db')
+
+            commitments = [Timestamp(bytes([i])*Journal.COMMITMENT_SIZE) for i in range(10)]
+            for commitment in commitments:
+                commitment.ops.add(OpSHA256())
+            cal.add_timestamps(commitments[0:5])
+
+            cal.enable_bloom_filter(100, 0.001, snapshot_path=db_path + '/bloom')
+            self.assertEqual(len(cal.bloom_filter), 5)
+
+            # Each new key is a miss when looked up to be merged, but not again
+            # when added to the filter
+            cal.add_timestamps(commitments[5:8])
+            self.assertEqual(cal.bloom_filter_misses, 3)
+            misses = cal.bloom_filter_misses
+            for commitment in commitments[0:8]:
+                self.assertIn(commitment.msg, cal)
+                self.assertEqual(cal[commitment.msg], commitment)
+            for commitment in commitments[8:]:
+                self.assertNotIn(commitment.msg, cal)
+                with self.assertRaises(KeyError):
+                    cal[commitment.msg]
+            self.assertEqual(cal.bloom_filter_misses - misses, 4)
+
+            self.assertEqual(cal.contains_many(commitment.msg for commitment in commitments),
+                             set(commitment.msg for commitment in commitments[0:8]))
+
+            # Keys of other sizes aren't tracked
+            self.assertIn(commitments[0].ops[OpSHA256()].msg, cal)
+
+            # Keys already in the calendar aren't counted again when rewritten
+            updated = [Timestamp(commitment.msg) for commitment in commitments[0:8]]
+            for t in updated:
+                t.attestations.add(PendingAttestation('http://example.com'))
+            misses = cal.bloom_filter_misses
+            cal.add_timestamps(updated)
+            self.assertEqual(len(cal.bloom_filter), 8)
+            self.assertEqual(cal.bloom_filter_misses, misses)
+
+            # The snapshot is removed by writes, and only saved when asked to
+            self.assertFalse(os.path.exists(db_path + '/bloom'))
+            cal.save_bloom_filter()
+            self.assertIn(commitments[7].msg, BloomFilter.load(db_path + '/bloom'))
+            self.assertEqual(len(BloomFilter.load(db_path + '/bloom')), 8)
+
+    def test_node_cache(self):
+        """Cached nodes are reused, and invalidated by writes"""
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path)
+
+            t1 = Timestamp(b'foo')
+            t2 = t1.ops.add(OpAppend(b'bar'))
+            cal.add_timestamps([t1])
+
+            self.assertEqual(cal[b'foo'], t1)
+            self.assertEqual(cal.cache.hits, 0)
+            self.assertEqual(cal[b'foo'], t1)
+            self.assertEqual(cal.cache.hits, 2)
+
+            # Extend an already cached node
+            t3 = t2.ops.add(OpAppend(b'baz'))
+            t1.ops.add(OpPrepend(b'qux'))
+            cal.add_timestamps([t1])
+            self.assertEqual(cal[b'foo'], t1)
+
+    def test_node_cache_disabled(self):
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path, cache_size=0)
+
+            t1 = Timestamp(b'foo')
+            t1.ops.add(OpAppend(b'bar'))
+            cal.add_timestamps([t1])
+
+            self.assertEqual(cal[b'foo'], t1)
+            self.assertEqual(cal[b'foo'], t1)
+            self.assertEqual(len(cal.cache), 0)
+            self.assertEqual(cal.cache.hits, 0)
+
+    def test_get_timestamps(self):
+        """Many timestamps are looked up in one pass, sharing nodes"""
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path)
+
+            roots = [Timestamp(bytes([i])) for i in range(16)]
+            merkle_tip = make_merkle_tree(roots)
+            merkle_tip.attestations.add(PendingAttestation('http://example.com'))
+            cal.add_timestamps(roots)
+
+            timestamps = cal.get_timestamps([root.msg for root in roots] + [b'missing'])
+            self.assertEqual(timestamps, {root.msg: root for root in roots})
+
+            # The merkle tip is only built once
+            tips = set()
+            for timestamp in timestamps.values():
+                while not timestamp.attestations:
+                    timestamp = next(iter(timestamp.ops.values()))
+                tips.add(id(timestamp))
+            self.assertEqual(len(tips), 1)
+
+    def test_scan_commitments(self):
+        """Commitments are found by prefix, in pages"""
+        with tempfile.TemporaryDirectory() as db_path:
+            cal = LevelDbCalendar(db_path)
+
+            # HMAC'd commitments, and older commitments without a HMAC, added
+            # to the calendar from the journal the way the stamper does
+            writer = JournalWriter(db_path + '/journal')
+            for i in range(20):
+                commitment = bytes([0, 0, i % 2, i]) + bytes([i])*32
+                if i % 5:
+                    commitment += bytes([i])*HMAC_SIZE
+                writer.submit(commitment)
+
+            commitments = list(Journal(db_path + '/journal').iter_commitments(0))
+            tree = MerkleTree(b''.join(hashlib.sha256(c).digest() for c in commitments))
+            block_timestamp = Timestamp(tree.root)
+            block_timestamp.attestations.add(BitcoinBlockHeaderAttestation(1))
+            ttx = TimestampTx(None, commitments, tree, block_timestamp)
+            cal.add_timestamps(sum(ttx.make_commitment_timestamps(len(commitments)), []))
+
+            odd = sorted(c for c in commitments if c[2] == 1)
+            self.assertEqual(cal.scan_commitments(b'\x00\x00\x01'), (odd, None))
+            self.assertEqual(cal.scan_commitments(b''), (sorted(commitments), None))
+            self.assertEqual(cal.scan_commitments(b'\x01'), ([], None))
+
+            # Paging by result limit
+            found = []
+            cursor = None
+            while True:
+                page, cursor = cal.scan_commitments(b'\x00\x00\x01', after=cursor, limit=3)
+                self.assertLessEqual(len(page), 3)
+                found.extend(page)
+                if cursor is None:
+                    break
+            self.assertEqual(found, odd)
+
+            # Paging by scan budget; other nodes are interleaved
+            found = []
+            cursor = None
+            while True:
+                page, cursor = cal.scan_commitments(b'', after=cursor, max_scan=5)
+                found.extend(page)
+                if cursor is None:
+                    break
+            self.assertEqual(found, sorted(commitments))
+
+
+class Test_Journal(unittest.TestCase):
+    def test_empty(self):
+        with tempfile.TemporaryDirectory() as path:
+            JournalWriter(path + '/journal')
+            journal = Journal(path + '/journal')
+
+            self.assertEqual(len(journal), 0)
+            self.assertEqual(len(journal.slice(0, 10)), 0)
+            self.assertEqual(list(journal.iter_commitments(0)), [])
+            with self.assertRaises(KeyError):
+                journal[0]
+
+    def test_slice_grows_with_journal(self):
+        """Journal reads see entries appended after it was opened"""
+        with tempfile.TemporaryDirectory() as path:
+            writer = JournalWriter(path + '/journal')
+            journal = Journal(path + '/journal')
+
+            commitments = [bytes([i])*Journal.COMMITMENT_SIZE for i in range(1, 11)]
+            for commitment in commitments[0:5]:
+                writer.submit(commitment)
+
+            self.assertEqual(len(journal), 5)
+            self.assertEqual(list(journal.iter_commitments(0)), commitments[0:5])
+            self.assertEqual(journal.slice(1, 3).tobytes(), b''.join(commitments[1:3]))
+
+            for commitment in commitments[5:]:
+                writer.submit(commitment)
+
+            self.assertEqual(len(journal), 10)
+            self.assertEqual(journal[9], commitments[9])
+            self.assertEqual(list(journal.iter_commitments(3, 100)), commitments[3:])
+            with self.assertRaises(KeyError):
+                journal[10]
+
+    def test_null_hmac_stripped(self):
+        with tempfile.TemporaryDirectory() as path:
+            writer = JournalWriter(path + '/journal')
+            journal = Journal(path + '/journal')
+
+            commitment = b'\x01'*(Journal.COMMITMENT_SIZE - HMAC_SIZE)
+            writer.submit(commitment)
+
+            self.assertEqual(journal[0], commitment)
+            self.assertEqual(list(journal.iter_commitments(0)), [commitment])
+
+class Test_JournalWriter(unittest.TestCase):
+    def test_group_commit(self):
+        """Concurrent submitters are all written with group commit"""
+        with tempfile.TemporaryDirectory() as path:
+            writer = JournalWriter(path + '/journal', group_commit=True)
+
+            commitments = [bytes([i])*Journal.COMMITMENT_SIZE for i in range(1, 101)]
+            threads = [threading.Thread(target=writer.submit, args=(commitment,)) for commitment in commitments]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            journal = Journal(path + '/journal')
+            self.assertEqual(sorted(journal.iter_commitments(0)), commitments)
+
+            stats = writer.stats()
+            self.assertEqual(stats['batch_sizes']['sum'], 100)
+            self.assertEqual(stats['fsync_latencies']['count'], stats['batch_sizes']['count'])
+
+    def test_submit_async(self):
+        with tempfile.TemporaryDirectory() as path:
+            writer = JournalWriter(path + '/journal', group_commit=True)
+            futures = [writer.submit_async(bytes([i])*Journal.COMMITMENT_SIZE) for i in range(10)]
+            for future in futures:
+                future.result()
+
+            self.assertEqual(len(Journal(path + '/journal')), 10)
+
+            with self.assertRaises(ValueError):
+                writer.submit_async(b'too short')
+
+def make_calendar(path, **kwargs):
+    with open(path + '/uri', 'w') as fd:
+        fd.write('http://localhost:14788')
+    with open(path + '/hmac-key', 'wb') as fd:
+        fd.write(b'\x00'*32)
+    return Calendar(path, **kwargs)
+
+class Test_Calendar(unittest.TestCase):
+
+    def test_materialized_proofs(self):
+        """Serialized timestamps come from materialized proofs, falling back to the graph"""
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path, materialize_proofs=True)
+
+            t1 = Timestamp(b'foo')
+            t1.ops.add(OpAppend(b'bar')).attestations.add(PendingAttestation('http://example.com'))
+            t2 = Timestamp(b'baz')
+            t2.ops.add(OpAppend(b'qux')).attestations.add(PendingAttestation('http://example.com'))
+
+            calendar.add_commitment_timestamps([t1, t2])
+            calendar.materialize_commitment_timestamps([t1])
+
+            self.assertIn(b'foo', calendar.proofs)
+            self.assertNotIn(b'baz', calendar.proofs)
+
+            for t in (t1, t2):
+                ctx = BytesSerializationContext()
+                t.serialize(ctx)
+                self.assertEqual(calendar.get_serialized_timestamp(t.msg), ctx.getbytes())
+
+            with self.assertRaises(KeyError):
+                calendar.get_serialized_timestamp(b'missing')
+
+    def test_materialized_proofs_batched(self):
+        """Proofs are written in batches of db_batch_size"""
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path, materialize_proofs=True, db_batch_size=3)
+
+            batches = []
+            write_batch = calendar.proofs.store.write_batch
+            def recording_write_batch(items, sync=True):
+                items = list(items)
+                batches.append((len(items), sync))
+                write_batch(items, sync=sync)
+            calendar.proofs.store.write_batch = recording_write_batch
+
+            roots = [Timestamp(bytes([i])) for i in range(8)]
+            make_merkle_tree(roots).attestations.add(PendingAttestation('http://example.com'))
+            calendar.add_commitment_timestamps(roots)
+            calendar.materialize_commitment_timestamps(iter(roots))
+
+            self.assertEqual(batches, [(3, False), (3, False), (2, True)])
+            for root in roots:
+                self.assertIn(root.msg, calendar.proofs)
+
+    def test_get_serialized_timestamps(self):
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path, materialize_proofs=True)
+
+            roots = [Timestamp(bytes([i])) for i in range(4)]
+            make_merkle_tree(roots).attestations.add(PendingAttestation('http://example.com'))
+            calendar.add_commitment_timestamps(roots)
+            calendar.materialize_commitment_timestamps(roots[0:2])
+
+            expected = {}
+            for root in roots:
+                ctx = BytesSerializationContext()
+                root.serialize(ctx)
+                expected[root.msg] = ctx.getbytes()
+
+            self.assertEqual(calendar.get_serialized_timestamps([root.msg for root in roots] + [b'missing']),
+                             expected)
+
+    def test_proofs_not_materialized_by_default(self):
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path)
+
+            t1 = Timestamp(b'foo')
+            t1.ops.add(OpAppend(b'bar')).attestations.add(PendingAttestation('http://example.com'))
+            calendar.add_commitment_timestamps([t1])
+            calendar.materialize_commitment_timestamps([t1])
+
+            self.assertIsNone(calendar.proofs)
+            self.assertFalse(os.path.exists(path + '/proofs'))
+
+
+class Test_Aggregator(unittest.TestCase):
+    def test_submit_many(self):
+        """A group of digests is aggregated into one commitment"""
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path)
+            exit_event = threading.Event()
+            aggregator = Aggregator(calendar, exit_event, max_latency=0.01)
+            try:
+                digests = [bytes([i])*32 for i in range(10)]
+                timestamps = aggregator.submit_many(digests)
+                single = aggregator.submit(b'\xff'*32)
+            finally:
+                exit_event.set()
+                aggregator.thread.join()
+
+            self.assertEqual([timestamp.msg for timestamp in timestamps], digests)
+
+            commitments = set()
+            for timestamp in timestamps + [single]:
+                msg, attestation = list(timestamp.all_attestations())[0]
+                self.assertEqual(attestation, PendingAttestation('http://localhost:14788'))
+                commitments.add(msg)
+
+            self.assertEqual(len(commitments), 2)
+            self.assertEqual(set(Journal(path + '/journal').iter_commitments(0)), commitments)
+
+    def test_flush_on_batch_size(self):
+        """A full batch is committed without waiting for max_latency"""
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path)
+            exit_event = threading.Event()
+            aggregator = Aggregator(calendar, exit_event, max_latency=60, max_batch_size=4)
+            try:
+                timestamps = aggregator.submit_many([bytes([i])*32 for i in range(4)])
+                stats = aggregator.stats()
+            finally:
+                exit_event.set()
+                aggregator.thread.join()
+
+            self.assertEqual(len(timestamps), 4)
+            self.assertEqual(stats['waiting_digests'], 0)
+            self.assertEqual(stats['batch_sizes']['count'], 1)
+            self.assertLess(stats['batch_latencies']['max'], 60)
+
+    def test_max_in_flight(self):
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path)
+            exit_event = threading.Event()
+            aggregator = Aggregator(calendar, exit_event, max_latency=0.01, max_in_flight=2)
+            try:
+                with self.assertRaises(AggregatorBusyError):
+                    aggregator.submit_many([bytes([i])*32 for i in range(3)])
+                aggregator.submit_many([bytes([i])*32 for i in range(2)])
+                aggregator.submit_many([bytes([i])*32 for i in range(2)])
+                stats = aggregator.stats()
+            finally:
+                exit_event.set()
+                aggregator.thread.join()
+
+            self.assertEqual(stats['rejected_digests'], 3)
+            self.assertEqual(stats['in_flight_digests'], 0)
@@ -0,0 +1,87 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import json
+import threading
+import time
+import unittest
+from decimal import Decimal
+
+from otsserver.homepage import Homepage
+from otsserver.stamper import PendingQueue
+
+
+class FakeProxy:
+    """Stands in for a BitcoindClient, counting the calls made"""
+    n_calls = 0
+
+    def call(self, method, *args):
+        FakeProxy.n_calls += 1
+        if method == 'getbalance':
+            return Decimal('1.5')
+        elif method == 'listtransactions':
+            return [{'txid': 'aa'*32, 'confirmations': 3, 'amount': 0, 'time': time.time(), 'fee': Decimal('-0.0001')},
+                    {'txid': 'bb'*32, 'confirmations': 0, 'amount': 0, 'time': time.time(), 'fee': Decimal('-0.0001')}]
+
+    def getbestblockhash(self):
+        return b'\x00'*32
+
+    def getblockcount(self):
+        return 500000
+
+    def getaccountaddress(self, account):
+        return '1BitcoinEaterAddressDontSendf59kuE'
+
+
+class FakeStamper:
+    def __init__(self):
+        self.pending_commitments = PendingQueue()
+        self.pending_commitments.add(b'foo')
+        self.txs_waiting_for_confirmation = {}
+        self.unconfirmed_txs = []
+
+
+class FakeCalendar:
+    def __init__(self):
+        self.stamper = FakeStamper()
+
+
+class Test_Homepage(unittest.TestCase):
+    def test_refresh(self):
+        exit_event = threading.Event()
+        self.addCleanup(exit_event.set)
+        homepage = Homepage(FakeCalendar(), exit_event, refresh_interval=3600, bitcoind=FakeProxy())
+
+        deadline = time.time() + 5
+        while homepage.snapshot is None and time.time() < deadline:
+            time.sleep(0.01)
+        snapshot = homepage.snapshot
+
+        stats = json.loads(snapshot.json.decode())
+        self.assertEqual(stats['pending_commitments'], 1)
+        self.assertEqual(stats['balance'], '1.5')
+        self.assertEqual(stats['fees_in_last_week'], '0.0001')
+        self.assertEqual(stats['transactions'], [{'txid': 'aa'*32}])
+        self.assertNotIn('bitcoind_rpc', stats)
+        self.assertIn(b'Pending commitments: 1</br>', snapshot.html)
+        self.assertIn(b'aa'*32, snapshot.html)
+
+        # Served from memory until asked to refresh
+        n_calls = FakeProxy.n_calls
+        time.sleep(0.05)
+        self.assertIs(homepage.snapshot, snapshot)
+        self.assertEqual(FakeProxy.n_calls, n_calls)
+
+        homepage.refresh_soon()
+        deadline = time.time() + 5
+        while homepage.snapshot is snapshot and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNot(homepage.snapshot, snapshot)
@@ -0,0 +1,77 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import hashlib
+import unittest
+
+from opentimestamps.core.timestamp import Timestamp, make_merkle_tree
+
+from otsserver.merkle import MerkleMountainRange, MerkleTree
+
+
+class Test_MerkleMountainRange(unittest.TestCase):
+    def test_same_tip_as_make_merkle_tree(self):
+        digests = [hashlib.sha256(bytes([i])).digest() for i in range(70)]
+
+        mmr = MerkleMountainRange()
+        for n, digest in enumerate(digests, 1):
+            mmr.add(digest)
+            self.assertEqual(len(mmr), n)
+            self.assertEqual(len(mmr.peaks()), bin(n).count('1'))
+            self.assertEqual(mmr.tip(), make_merkle_tree([Timestamp(d) for d in digests[0:n]]).msg)
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            MerkleMountainRange().tip()
+
+        self.assertEqual(MerkleMountainRange([b'\x00'*32]).tip(), b'\x00'*32)
+
+
+class Test_MerkleTree(unittest.TestCase):
+    def test_same_as_make_merkle_tree(self):
+        digests = [hashlib.sha256(bytes([i])).digest() for i in range(70)]
+
+        for n in (1, 2, 3, 4, 5, 7, 8, 9, 31, 64, 70):
+            tree = MerkleTree(b''.join(digests[0:n]))
+            self.assertEqual(len(tree), n)
+            self.assertEqual([tree.leaf(i) for i in range(n)], digests[0:n])
+
+            expected_leaves = [Timestamp(d) for d in digests[0:n]]
+            expected_root = make_merkle_tree(expected_leaves)
+            self.assertEqual(tree.root, expected_root.msg)
+
+            leaves = [Timestamp(d) for d in digests[0:n]]
+            root = tree.make_timestamps(leaves)
+            self.assertEqual(root, expected_root)
+            self.assertEqual(leaves, expected_leaves)
+
+    def test_make_timestamps_range(self):
+        """Timestamps made for ranges of leaves are the same as for all of them"""
+        digests = [hashlib.sha256(bytes([i])).digest() for i in range(70)]
+
+        for n in (1, 2, 3, 5, 8, 9, 31, 70):
+            tree = MerkleTree(b''.join(digests[0:n]))
+            expected_leaves = [Timestamp(d) for d in digests[0:n]]
+            expected_root = make_merkle_tree(expected_leaves)
+
+            for chunk_size in (1, 2, 3, 7, n):
+                leaves = []
+                for start in range(0, n, chunk_size):
+                    chunk = [Timestamp(d) for d in digests[start:min(start + chunk_size, n)]]
+                    self.assertEqual(tree.make_timestamps(chunk, start).msg, expected_root.msg)
+                    leaves += chunk
+                self.assertEqual(leaves, expected_leaves)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            MerkleTree(b'')
+        with self.assertRaises(ValueError):
+            MerkleTree(b'\x00'*33)
@@ -0,0 +1,75 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import time
+import unittest
+
+from otsserver.ratelimit import RateLimiter
+
+
+class Test_RateLimiter(unittest.TestCase):
+    def test_burst(self):
+        limiter = RateLimiter(0.001, 3)
+        self.assertEqual([limiter.allow('a') for i in range(4)], [True, True, True, False])
+
+        # Clients have buckets of their own
+        self.assertTrue(limiter.allow('b'))
+        self.assertEqual(limiter.stats()['clients'], 2)
+        self.assertEqual(limiter.stats()['refused'], 1)
+
+    def test_refill(self):
+        limiter = RateLimiter(100, 1)
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        time.sleep(0.05)
+        self.assertTrue(limiter.allow('a'))
+
+    def test_large_request(self):
+        limiter = RateLimiter(0.001, 5)
+        self.assertTrue(limiter.allow('a', 100))
+        self.assertFalse(limiter.allow('a'))
+
+        self.assertTrue(limiter.allow('b', 2))
+        self.assertFalse(limiter.allow('b', 100))
+
+    def test_clients_bounded(self):
+        limiter = RateLimiter(1000000, 1)
+        limiter.MAX_CLIENTS = 10
+        limiter.PRUNE_INTERVAL = 0
+        for i in range(1000):
+            limiter.allow(i)
+            time.sleep(0.0001)
+        self.assertLessEqual(limiter.stats()['clients'], 10)
+
+    def test_prune(self):
+        limiter = RateLimiter(1000, 1)
+        limiter.MAX_CLIENTS = 10
+        limiter.PRUNE_INTERVAL = 0
+        for i in range(11):
+            limiter.allow(i)
+        time.sleep(0.01)
+        limiter.allow('a')
+        self.assertEqual(limiter.stats()['clients'], 1)
+
+    def test_evict_least_recent(self):
+        """With no buckets refilled, the least recently seen clients are forgotten"""
+        limiter = RateLimiter(0.001, 2)
+        limiter.MAX_CLIENTS = 10
+        for i in range(10):
+            limiter.allow(i, 2)
+        limiter.allow(0)
+
+        limiter.allow('a', 2)
+        self.assertEqual(limiter.stats()['clients'], 10)
+
+        # Client 0 was seen again, so client 1 was forgotten, with its debt
+        self.assertFalse(limiter.allow(0))
+        self.assertTrue(limiter.allow(1))
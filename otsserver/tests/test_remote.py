@@ -0,0 +1,124 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import http.server
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from opentimestamps.core.notary import PendingAttestation
+from opentimestamps.core.serialize import BytesDeserializationContext, BytesSerializationContext
+from opentimestamps.core.timestamp import Timestamp
+
+from otsserver.calendar import Aggregator, Journal
+from otsserver.remote import UpstreamCalendar
+from otsserver.rpc import AggregationServer
+from otsserver.tests.test_calendar import make_calendar
+
+
+class FlakyRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Fails every other request, and timestamps the rest with a fixed attestation"""
+    n_requests = 0
+
+    def do_POST(self):
+        digest = self.rfile.read(int(self.headers['Content-Length']))
+
+        FlakyRequestHandler.n_requests += 1
+        if FlakyRequestHandler.n_requests % 2:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        timestamp = Timestamp(digest)
+        timestamp.attestations.add(PendingAttestation('http://upstream.example.com'))
+        ctx = BytesSerializationContext()
+        timestamp.serialize(ctx)
+
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(ctx.getbytes())
+
+    def log_message(self, *args):
+        pass
+
+
+class NotFoundRequestHandler(http.server.BaseHTTPRequestHandler):
+    n_requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        NotFoundRequestHandler.n_requests += 1
+        self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class Test_UpstreamCalendar(unittest.TestCase):
+    def start_server(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d' % server.server_port
+
+    def start_aggregator(self, calendar, **kwargs):
+        exit_event = threading.Event()
+        aggregator = Aggregator(calendar, exit_event, **kwargs)
+        self.addCleanup(aggregator.thread.join)
+        self.addCleanup(exit_event.set)
+        return aggregator
+
+    def test_aggregation_server(self):
+        """Digests aggregated locally are timestamped by the upstream calendar"""
+        with tempfile.TemporaryDirectory() as path:
+            calendar = make_calendar(path)
+            upstream_aggregator = self.start_aggregator(calendar, max_latency=0.01)
+            upstream_url = self.start_server(AggregationServer(('127.0.0.1', 0), upstream_aggregator))
+
+            aggregator = self.start_aggregator(UpstreamCalendar(upstream_url), max_latency=0.01)
+            url = self.start_server(AggregationServer(('127.0.0.1', 0), aggregator))
+
+            digests = [bytes([i])*32 for i in range(4)]
+            timestamps = aggregator.submit_many(digests[0:3])
+            timestamps.append(Timestamp.deserialize(
+                    BytesDeserializationContext(requests.post(url + '/digest', data=digests[3]).content),
+                    digests[3]))
+
+            commitments = set(Journal(path + '/journal').iter_commitments(0))
+            self.assertEqual(len(commitments), 2)
+            for digest, timestamp in zip(digests, timestamps):
+                self.assertEqual(timestamp.msg, digest)
+                msg, attestation = list(timestamp.all_attestations())[0]
+                self.assertEqual(attestation, PendingAttestation('http://localhost:14788'))
+                self.assertIn(msg, commitments)
+
+    def test_retries(self):
+        url = self.start_server(http.server.HTTPServer(('127.0.0.1', 0), FlakyRequestHandler))
+
+        upstream = UpstreamCalendar(url, retries=1, retry_delay=0)
+        timestamp = Timestamp(b'\x00'*32)
+        upstream.submit_async(timestamp).result()
+        self.assertEqual(list(timestamp.all_attestations()),
+                         [(b'\x00'*32, PendingAttestation('http://upstream.example.com'))])
+
+        upstream = UpstreamCalendar(url, retries=0, retry_delay=0)
+        with self.assertRaises(requests.HTTPError):
+            upstream.submit_async(Timestamp(b'\x01'*32)).result()
+
+    def test_client_errors_not_retried(self):
+        url = self.start_server(http.server.HTTPServer(('127.0.0.1', 0), NotFoundRequestHandler))
+
+        upstream = UpstreamCalendar(url, retries=3, retry_delay=0)
+        with self.assertRaises(requests.HTTPError):
+            upstream.submit_async(Timestamp(b'\x00'*32)).result()
+        self.assertEqual(NotFoundRequestHandler.n_requests, 1)
@@ -0,0 +1,225 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import json
+import re
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from opentimestamps.core.notary import PendingAttestation
+from opentimestamps.core.serialize import BytesDeserializationContext, BytesSerializationContext
+from opentimestamps.core.timestamp import Timestamp, make_merkle_tree
+
+from otsserver.calendar import Aggregator
+from otsserver.ratelimit import RateLimiter
+from otsserver.rpc import RPCService
+from otsserver.tests.test_calendar import make_calendar
+from otsserver.web import AsyncServer, ThreadedServer
+
+
+class NothingPendingStamper:
+    def is_pending(self, commitment):
+        return False
+
+
+class FakeBitcoind:
+    def stats(self):
+        return {'getblockcount': {'calls': 1}}
+
+
+class FakeHomepage:
+    bitcoind = FakeBitcoind()
+
+
+def http_request(port, request):
+    """Send raw requests, returning the raw responses minus their Date headers
+
+    Reads until the server closes the connection.
+    """
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(request)
+        response = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+    return re.sub(rb'\r\nDate: [^\r]*', b'', response)
+
+
+def varbytes(*items):
+    ctx = BytesSerializationContext()
+    for item in items:
+        ctx.write_varbytes(item)
+    return ctx.getbytes()
+
+
+class Test_AsyncServer(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        self.calendar = make_calendar(tmpdir.name)
+        self.calendar.stamper = NothingPendingStamper()
+        roots = [Timestamp(bytes([i])*32) for i in range(4)]
+        make_merkle_tree(roots).attestations.add(PendingAttestation('http://example.com'))
+        self.calendar.add_commitment_timestamps(roots)
+
+        exit_event = threading.Event()
+        self.aggregator = Aggregator(self.calendar, exit_event, max_latency=0.01)
+        self.addCleanup(self.aggregator.thread.join)
+        self.addCleanup(exit_event.set)
+
+    def start_server(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_port
+
+    def test_same_responses(self):
+        """The asyncio server sends the same bytes as the threaded server"""
+        threaded_port = self.start_server(ThreadedServer(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+        async_port = self.start_server(AsyncServer(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+
+        lookup = varbytes(b'\x00'*32, b'\x01'*32, b'missing')
+        for request in (b'GET /timestamp/' + b'00'*32 + b' HTTP/1.0\r\n\r\n',
+                        b'GET /timestamp/' + b'ff'*32 + b' HTTP/1.0\r\n\r\n',
+                        b'GET /timestamp/zz HTTP/1.0\r\n\r\n',
+                        b'GET /timestamps/prefix/0101?limit=2 HTTP/1.0\r\n\r\n',
+                        b'GET /timestamps/prefix/?limit=0 HTTP/1.0\r\n\r\n',
+                        b'GET /nonexistent HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n',
+                        b'POST /nonexistent HTTP/1.0\r\nContent-Length: 0\r\n\r\n',
+                        b'POST /timestamps HTTP/1.0\r\nContent-Length: %d\r\n\r\n' % len(lookup) + lookup,
+                        b'POST /digest HTTP/1.0\r\nContent-Length: 65\r\n\r\n' + b'\x00'*65,
+                        b'POST /digest HTTP/1.0\r\nContent-Length: 10000000\r\n\r\n',
+                        b'POST /digests HTTP/1.0\r\nContent-Length: 1\r\n\r\n\x05'):
+            expected = http_request(threaded_port, request)
+            self.assertTrue(expected.startswith(b'HTTP/1.1 '))
+            self.assertEqual(http_request(async_port, request), expected)
+
+    def test_same_errors(self):
+        """Malformed and unsupported requests get the same error responses from both servers"""
+        threaded_port = self.start_server(ThreadedServer(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+        async_port = self.start_server(AsyncServer(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+
+        lookup = varbytes(b'\x00'*32)
+        for request in (b'PUT /digest HTTP/1.1\r\nContent-Length: 0\r\n\r\n',
+                        b'HEAD /tip HTTP/1.0\r\n\r\n',
+                        b'GET /tip FOO/1.1\r\n\r\n',
+                        b'GET /tip HTTP/2.0\r\n\r\n',
+                        b'GET /tip <b>x</b> HTTP/1.0\r\n\r\n',
+                        b'GET\r\n\r\n',
+                        b'POST /digest\r\n\r\n',
+                        b'GET /timestamp/zz\r\n\r\n',
+                        b'GET /tip HTTP/1.1\r\n' + b''.join(b'X-%d: x\r\n' % i for i in range(101)),
+                        b'\r\n',
+                        b'POST /timestamps HTTP/1.1\r\nExpect: 100-continue\r\nContent-Length: %d\r\n'
+                        b'Connection: close\r\n\r\n' % len(lookup) + lookup,
+                        b'POST /timestamps HTTP/1.0\r\nExpect: 100-continue\r\nContent-Length: %d\r\n\r\n' % len(lookup) + lookup):
+            self.assertEqual(http_request(async_port, request), http_request(threaded_port, request), request)
+
+    def test_keep_alive(self):
+        """Pipelined requests are answered in order on one connection"""
+        for server_class in (ThreadedServer, AsyncServer):
+            port = self.start_server(server_class(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+
+            response = http_request(port, b'GET /timestamp/' + b'00'*32 + b' HTTP/1.1\r\n\r\n' +
+                                          b'GET /timestamp/zz HTTP/1.1\r\n\r\n' +
+                                          b'GET /nonexistent HTTP/1.1\r\nConnection: close\r\n\r\n' +
+                                          b'GET /tip HTTP/1.1\r\n\r\n')
+
+            statuses = re.findall(rb'HTTP/1.1 (\d+) ', response)
+            self.assertEqual(statuses, [b'200', b'400', b'404'])
+            for head, body in re.findall(rb'(HTTP/1.1 .*?\r\n\r\n)(?=(.*?)(?:HTTP/1.1 |$))', response, re.S):
+                content_length = int(re.search(rb'Content-Length: (\d+)', head).group(1))
+                self.assertEqual(content_length, len(body))
+
+    def test_unread_body_closes_connection(self):
+        for server_class in (ThreadedServer, AsyncServer):
+            port = self.start_server(server_class(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+
+            response = http_request(port, b'POST /digest HTTP/1.1\r\nContent-Length: 10000000\r\n\r\n')
+            self.assertIn(b'\r\nConnection: close\r\n', response)
+            self.assertTrue(response.endswith(b'\r\n\r\ndigest too long'))
+
+    def test_stats(self):
+        """bitcoind RPC stats are served with the other stats"""
+        service = RPCService(self.aggregator, self.calendar, homepage=FakeHomepage())
+        port = self.start_server(ThreadedServer(('127.0.0.1', 0), service))
+
+        response = http_request(port, b'GET /experimental/stats HTTP/1.0\r\n\r\n')
+        stats = json.loads(response.split(b'\r\n\r\n', 1)[1].decode())
+        self.assertEqual(stats['bitcoind_rpc'], {'getblockcount': {'calls': 1}})
+        self.assertIn('aggregator', stats)
+
+    def test_max_threads(self):
+        """At the thread limit idle connections are closed for new ones, and otherwise they're refused"""
+        server = ThreadedServer(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar), max_threads=1)
+        port = self.start_server(server)
+        request = b'GET /timestamp/' + b'00'*32 + b' HTTP/1.1\r\nConnection: close\r\n\r\n'
+
+        with socket.create_connection(('127.0.0.1', port)) as idle:
+            idle.sendall(b'GET /timestamp/zz HTTP/1.1\r\n\r\n')
+            response = b''
+            while not response.endswith(b'\r\n\r\ncommitment must be hex-encoded bytes'):
+                response += idle.recv(65536)
+            while server.stats()['idle_connections'] != 1:
+                time.sleep(0.01)
+
+            self.assertTrue(http_request(port, request).startswith(b'HTTP/1.1 200 '))
+            self.assertEqual(idle.recv(65536), b'')
+        while server.stats()['active_threads']:
+            time.sleep(0.01)
+
+        # Part way through its headers, a connection isn't idle
+        with socket.create_connection(('127.0.0.1', port)) as busy:
+            busy.sendall(b'GET /timestamp/zz HTTP/1.1\r\n')
+            while server.stats()['active_threads'] != 1:
+                time.sleep(0.01)
+
+            # The request is read and discarded, so the 503 isn't lost to a reset
+            response = http_request(port, request)
+            self.assertTrue(response.startswith(b'HTTP/1.1 503 '))
+            self.assertTrue(response.endswith(b'server busy'))
+
+        stats = server.stats()
+        self.assertEqual((stats['closed_idle_connections'], stats['rejected_connections']), (1, 1))
+
+    def test_submit_digests(self):
+        port = self.start_server(AsyncServer(('127.0.0.1', 0), RPCService(self.aggregator, self.calendar)))
+
+        digests = [b'\x10'*32, b'\x11'*32]
+        body = varbytes(*digests)
+        response = http_request(port, b'POST /digests HTTP/1.0\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK\r\n'))
+
+        ctx = BytesDeserializationContext(body)
+        for digest in digests:
+            timestamp = Timestamp.deserialize(BytesDeserializationContext(ctx.read_varbytes(1024)), digest)
+            msg, attestation = list(timestamp.all_attestations())[0]
+            self.assertEqual(attestation, PendingAttestation('http://localhost:14788'))
+
+    def test_rate_limit_counts_digests(self):
+        """A batch of digests takes a token per digest"""
+        rate_limiter = RateLimiter(0.001, 5)
+        port = self.start_server(AsyncServer(('127.0.0.1', 0),
+                                             RPCService(self.aggregator, self.calendar, rate_limiter=rate_limiter)))
+
+        body = varbytes(*[bytes([i])*32 for i in range(100)])
+        response = http_request(port, b'POST /digests HTTP/1.0\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+
+        response = http_request(port, b'POST /digest HTTP/1.0\r\nContent-Length: 32\r\n\r\n' + b'\x00'*32)
+        self.assertTrue(response.startswith(b'HTTP/1.1 429 '))
@@ -0,0 +1,92 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import multiprocessing
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from opentimestamps.core.notary import PendingAttestation
+from opentimestamps.core.serialize import BytesDeserializationContext
+from opentimestamps.core.timestamp import Timestamp
+
+from otsserver.calendar import Aggregator, Journal
+from otsserver.ratelimit import RateLimiter
+from otsserver.rpc import AggregationServer
+from otsserver.shard import RootUplink, UplinkRateLimiter, serve_worker
+from otsserver.tests.test_calendar import make_calendar
+
+
+class Test_Shard(unittest.TestCase):
+    def test_worker(self):
+        """Digests aggregated by a worker are timestamped by the calendar"""
+        with tempfile.TemporaryDirectory() as path:
+            exit_event = threading.Event()
+            calendar = make_calendar(path)
+            aggregator = Aggregator(calendar, exit_event, max_latency=0.01)
+
+            conn, worker_conn = multiprocessing.Pipe()
+            threading.Thread(target=serve_worker, args=(conn, aggregator), daemon=True).start()
+
+            worker_aggregator = Aggregator(RootUplink(worker_conn), exit_event, max_latency=0.01)
+            server = AggregationServer(('127.0.0.1', 0), worker_aggregator, reuse_port=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            try:
+                url = 'http://127.0.0.1:%d' % server.server_port
+                digests = [bytes([i])*32 for i in range(3)]
+                responses = []
+                for digest in digests:
+                    with urllib.request.urlopen(url + '/digest', data=digest) as response:
+                        responses.append(response.read())
+
+                with self.assertRaises(urllib.error.HTTPError):
+                    urllib.request.urlopen(url + '/tip')
+
+            finally:
+                server.shutdown()
+                server.server_close()
+                exit_event.set()
+                aggregator.thread.join()
+                worker_aggregator.thread.join()
+
+            commitments = set(Journal(path + '/journal').iter_commitments(0))
+            for digest, response in zip(digests, responses):
+                timestamp = Timestamp.deserialize(BytesDeserializationContext(response), digest)
+                msg, attestation = list(timestamp.all_attestations())[0]
+                self.assertEqual(attestation, PendingAttestation('http://localhost:14788'))
+                self.assertIn(msg, commitments)
+
+    def test_rate_limit(self):
+        """Workers share the calendar process's rate limit"""
+        with tempfile.TemporaryDirectory() as path:
+            exit_event = threading.Event()
+            aggregator = Aggregator(make_calendar(path), exit_event)
+            rate_limiter = RateLimiter(0.001, 3)
+
+            worker_rate_limiters = []
+            for i in range(2):
+                conn, worker_conn = multiprocessing.Pipe()
+                threading.Thread(target=serve_worker, args=(conn, aggregator, rate_limiter), daemon=True).start()
+                worker_rate_limiters.append(UplinkRateLimiter(RootUplink(worker_conn)))
+
+            try:
+                self.assertTrue(worker_rate_limiters[0].allow('1.2.3.4', 2))
+                self.assertTrue(worker_rate_limiters[1].allow('1.2.3.4'))
+                self.assertFalse(worker_rate_limiters[0].allow('1.2.3.4'))
+                self.assertFalse(worker_rate_limiters[1].allow('1.2.3.4'))
+                self.assertTrue(worker_rate_limiters[1].allow('5.6.7.8'))
+                self.assertEqual(rate_limiter.stats()['refused'], 2)
+            finally:
+                exit_event.set()
+                aggregator.thread.join()
@@ -0,0 +1,377 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from bitcoin.core import COIN, CBlock, COutPoint, CTransaction, CTxIn, CTxOut, b2lx
+from bitcoin.core.script import CScript, OP_RETURN
+from bitcoin.wallet import P2PKHBitcoinAddress
+from opentimestamps.core.notary import BitcoinBlockHeaderAttestation
+from opentimestamps.core.op import OpPrepend, OpSHA256
+from opentimestamps.core.timestamp import Timestamp, cat_sha256d, make_merkle_tree
+
+from otsserver.bitcoind import BitcoindClient
+from otsserver.merkle import MerkleTree
+from otsserver.stamper import (JournalCheckpoint, KnownBlocks, PendingQueue, Stamper, TimestampTx,
+                               UnconfirmedTimestampTx, make_btc_block_merkle_tree, make_timestamp_from_block_tx)
+from otsserver.tests.test_bitcoind import FakeBitcoind
+from otsserver.tests.test_calendar import make_calendar
+
+
+class Test_PendingQueue(unittest.TestCase):
+    def test_add(self):
+        queue = PendingQueue()
+        commitments = [bytes([i])*36 for i in range(3)] + [b'\x00'*44, b'']
+
+        for commitment in commitments:
+            self.assertTrue(queue.add(commitment))
+        self.assertFalse(queue.add(commitments[1]))
+
+        self.assertEqual(len(queue), len(commitments))
+        self.assertEqual(list(queue), commitments)
+        self.assertEqual(queue[3], b'\x00'*44)
+        self.assertIn(commitments[2], queue)
+        self.assertNotIn(b'\x00'*36 + b'\x01', queue)
+
+        with self.assertRaises(ValueError):
+            queue.add(b'\x00'*45)
+
+    def test_prefix(self):
+        queue = PendingQueue()
+        commitments = [bytes([i])*36 for i in range(10)]
+        for commitment in commitments:
+            queue.add(commitment)
+
+        self.assertEqual(list(queue.prefix(3)), commitments[0:3])
+        self.assertEqual(len(queue.prefix(100)), 10)
+        self.assertEqual(queue.prefix(3)[2], commitments[2])
+        with self.assertRaises(IndexError):
+            queue.prefix(3)[3]
+
+        removed = queue.remove_prefix(4)
+        self.assertEqual(list(queue), commitments[4:])
+        self.assertNotIn(commitments[0], queue)
+        self.assertEqual(list(removed), commitments[0:4])
+        self.assertIn(commitments[0], removed)
+
+        # Removed commitments can be queued again, at the end
+        self.assertTrue(queue.add(commitments[0]))
+        self.assertEqual(list(queue), commitments[4:] + commitments[0:1])
+
+        queue.remove_prefix(100)
+        self.assertEqual(len(queue), 0)
+        self.assertIsNone(queue.first_journal_idx())
+
+    def test_first_journal_idx(self):
+        queue = PendingQueue()
+        for i, journal_idx in enumerate([5, 6, 7, 2, 3, 9]):
+            queue.add(bytes([i])*32, journal_idx)
+        self.assertEqual(queue.first_journal_idx(), 2)
+        self.assertEqual(list(queue.items())[3], (b'\x03'*32, 2))
+
+        removed = queue.remove_prefix(3)
+        self.assertEqual(removed.first_journal_idx(), 5)
+        self.assertEqual(queue.first_journal_idx(), 2)
+
+        queue.remove_prefix(1)
+        self.assertEqual(queue.first_journal_idx(), 3)
+        queue.add(b'\xff'*32, 1)
+        self.assertEqual(queue.first_journal_idx(), 1)
+        queue.remove_prefix(2)
+        self.assertEqual(queue.first_journal_idx(), 1)
+        queue.remove_prefix(1)
+        self.assertIsNone(queue.first_journal_idx())
+
+
+class Test_JournalCheckpoint(unittest.TestCase):
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as path:
+            checkpoint = JournalCheckpoint(path + '/journal.stamped')
+            self.assertEqual(checkpoint.read(), 0)
+
+            checkpoint.write(1234)
+            checkpoint.write(5678)
+            self.assertEqual(JournalCheckpoint(path + '/journal.stamped').read(), 5678)
+            self.assertEqual(os.listdir(path), ['journal.stamped'])
+
+
+class Test_KnownBlocks(unittest.TestCase):
+    def test_update_from_proxy(self):
+        bitcoind = FakeBitcoind()
+        threading.Thread(target=bitcoind.serve_forever, daemon=True).start()
+        self.addCleanup(bitcoind.server_close)
+        self.addCleanup(bitcoind.shutdown)
+        client = BitcoindClient({'service_url': bitcoind.service_url})
+
+        known_blocks = KnownBlocks()
+        self.assertEqual(known_blocks.update_from_proxy(client), [(9, bitcoind.chain[9])])
+        self.assertEqual(known_blocks.update_from_proxy(client), [])
+
+        # However many new blocks there are: the tip, the reorg check of our
+        # last block, the new blocks, then the tip again
+        bitcoind.chain.extend(bitcoind.make_block_hash(height) for height in range(10, 15))
+        n_requests = len(bitcoind.requests)
+        self.assertEqual(known_blocks.update_from_proxy(client),
+                         [(height, bitcoind.chain[height]) for height in range(10, 15)])
+        self.assertEqual(len(bitcoind.requests) - n_requests, 4)
+
+        # Reorg, replacing the last two blocks with three others
+        bitcoind.chain[13:] = [bitcoind.make_block_hash(height, b'fork') for height in range(13, 16)]
+        self.assertEqual(known_blocks.update_from_proxy(client),
+                         [(height, bitcoind.chain[height]) for height in range(13, 16)])
+        self.assertEqual(known_blocks.best_block_height(), 15)
+
+
+class Test_make_timestamp_from_block_tx(unittest.TestCase):
+    def test_same_as_whole_tree(self):
+        """Only building our tx's branch makes the same timestamp as building the whole tree"""
+        for n_txs in range(1, 12):
+            txs = [CTransaction([CTxIn(COutPoint(bytes([i])*32, 0))],
+                                [CTxOut(0, CScript([OP_RETURN, hashlib.sha256(bytes([i])).digest()]))])
+                   for i in range(n_txs)]
+            block = CBlock(vtx=txs)
+            block = CBlock(hashMerkleRoot=block.calc_merkle_root(), vtx=txs)
+
+            for i, tx in enumerate(txs):
+                digest = hashlib.sha256(bytes([i])).digest()
+                confirmed_tx = UnconfirmedTimestampTx(tx, Timestamp(digest), 1)
+
+                serialized_tx = tx.serialize()
+                j = serialized_tx.index(digest)
+                expected = Timestamp(digest)
+                txid_stamp = cat_sha256d(expected.ops.add(OpPrepend(serialized_tx[0:j])), serialized_tx[j + 32:])
+                block_txid_stamps = [Timestamp(other.GetTxid()) for other in txs]
+                block_txid_stamps[i] = txid_stamp
+                make_btc_block_merkle_tree(block_txid_stamps).attestations.add(BitcoinBlockHeaderAttestation(42))
+
+                self.assertEqual(make_timestamp_from_block_tx(confirmed_tx, block, 42), expected)
+                self.assertEqual(make_timestamp_from_block_tx(confirmed_tx, block, 42,
+                                                              [other.GetTxid() for other in txs]),
+                                 expected)
+
+
+class Test_TimestampTx(unittest.TestCase):
+    def test_make_commitment_timestamps(self):
+        commitments = [bytes([i])*36 for i in range(5)]
+        tree = MerkleTree(b''.join(hashlib.sha256(c).digest() for c in commitments))
+
+        block_timestamp = Timestamp(tree.root)
+        block_timestamp.attestations.add(BitcoinBlockHeaderAttestation(500000))
+        ttx = TimestampTx(None, commitments, tree, block_timestamp)
+
+        expected = [Timestamp(c) for c in commitments]
+        make_merkle_tree([stamp.ops.add(OpSHA256()) for stamp in expected]).attestations.add(BitcoinBlockHeaderAttestation(500000))
+
+        self.assertEqual(list(ttx.make_commitment_timestamps(5)), [expected])
+        for chunk_size in (1, 2, 3):
+            chunks = list(ttx.make_commitment_timestamps(chunk_size))
+            self.assertTrue(all(len(chunk) <= chunk_size for chunk in chunks))
+            self.assertEqual(sum(chunks, []), expected)
+
+
+class FakeStamperBitcoind:
+    """In-process stand-in for the bitcoind calls the Stamper makes
+
+    The wallet has a single, never spent, output. Txs sent are held in the
+    mempool, each replacing the last, until mine() puts them in a block.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = []
+        self.mempool = []
+        self.add_block([])
+
+    def add_block(self, txs, fork=b''):
+        coinbase = CTransaction([CTxIn(COutPoint(), CScript([len(self.blocks), fork]))], [CTxOut(0, CScript())])
+        txs = [coinbase] + txs
+        prev_hash = self.blocks[-1].GetHash() if self.blocks else b'\x00'*32
+        block = CBlock(hashPrevBlock=prev_hash, vtx=txs)
+        self.blocks.append(CBlock(hashPrevBlock=prev_hash, hashMerkleRoot=block.calc_merkle_root(), vtx=txs))
+
+    def mine(self):
+        with self.lock:
+            self.add_block(self.mempool)
+            self.mempool = []
+
+    def reorg(self, n):
+        """Replace the last n blocks with n + 1 empty ones"""
+        with self.lock:
+            del self.blocks[-n:]
+            for i in range(n + 1):
+                self.add_block([], fork=b'fork')
+
+    def batch(self, calls):
+        assert [call[0] for call in calls] == ['getbestblockhash', 'getblockcount']
+        with self.lock:
+            return [b2lx(self.blocks[-1].GetHash()), len(self.blocks) - 1]
+
+    def getblockcount(self):
+        with self.lock:
+            return len(self.blocks) - 1
+
+    def getblockhash(self, height):
+        with self.lock:
+            if not 0 <= height < len(self.blocks):
+                raise IndexError(height)
+            return self.blocks[height].GetHash()
+
+    def getblockhashes(self, heights):
+        return [self.getblockhash(height) for height in heights]
+
+    def getblock(self, block_hash):
+        with self.lock:
+            for block in self.blocks:
+                if block.GetHash() == block_hash:
+                    return block
+        raise KeyError(block_hash)
+
+    def listunspent(self, minconf=1, maxconf=9999999):
+        return [{'outpoint': COutPoint(b'\xff'*32, 0), 'amount': COIN, 'spendable': True}]
+
+    def getnewaddress(self):
+        return P2PKHBitcoinAddress.from_bytes(b'\x00'*20)
+
+    def gettxouts(self, outpoints, includemempool=True):
+        return [{'txout': CTxOut(COIN, CScript())} for outpoint in outpoints]
+
+    def signrawtransaction(self, tx):
+        return {'complete': True, 'tx': tx}
+
+    def sendrawtransaction(self, tx):
+        with self.lock:
+            self.mempool = [tx]
+
+
+class Test_Stamper(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.calendar = make_calendar(tmpdir.name)
+        self.bitcoind = FakeStamperBitcoind()
+
+    def start_stamper(self, min_confirmations=3):
+        exit_event = threading.Event()
+        stamper = Stamper(self.calendar, exit_event, 1, min_confirmations, 0, COIN, 1000, bitcoind=self.bitcoind)
+        self.addCleanup(stamper.thread.join)
+        self.addCleanup(exit_event.set)
+
+        # Heights of the blocks the stamper has finished processing
+        stamper.processed = []
+        stamper.new_block_callbacks.append(lambda: stamper.processed.append(stamper.known_blocks.best_block_height()))
+        return stamper
+
+    def submit(self, n):
+        commitments = [os.urandom(44) for i in range(n)]
+        for commitment in commitments:
+            self.calendar.journal.submit(commitment)
+        return commitments
+
+    def wait_for(self, condition):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertLess(time.time(), deadline, "timed out")
+            time.sleep(0.01)
+
+    def mine(self, stamper, n=1):
+        """Mine n blocks, waiting for the stamper to process each"""
+        for i in range(n):
+            self.bitcoind.mine()
+            stamper.notify_new_block()
+            height = len(self.bitcoind.blocks) - 1
+            self.wait_for(lambda: height in stamper.processed)
+
+    def test_is_pending(self):
+        """Commitments are pending from the journal until they're confirmed, across reorgs"""
+        commitments = self.submit(3)
+        stamper = self.start_stamper()
+
+        self.wait_for(lambda: self.bitcoind.mempool)
+        for commitment in commitments:
+            self.assertEqual(stamper.is_pending(commitment), "Pending confirmation in Bitcoin blockchain")
+        self.assertFalse(stamper.is_pending(b'\x00'*44))
+
+        # Mined, and waiting for confirmations
+        tx = self.bitcoind.mempool[0]
+        self.mine(stamper)
+        self.assertEqual(len(stamper.pending_commitments), 0)
+        for commitment in commitments:
+            self.assertEqual(stamper.is_pending(commitment),
+                             "Timestamped by transaction %s; waiting for 2 confirmations" % b2lx(tx.GetTxid()))
+
+        # Reorged out, so pending again, and sent in a new tx
+        self.bitcoind.reorg(1)
+        stamper.notify_new_block()
+        self.wait_for(lambda: self.bitcoind.mempool)
+        self.assertEqual(stamper.txs_waiting_for_confirmation, {})
+        for commitment in commitments:
+            self.assertEqual(stamper.is_pending(commitment), "Pending confirmation in Bitcoin blockchain")
+            self.assertNotIn(commitment, self.calendar)
+
+        # Mined again, then confirmed
+        tx = self.bitcoind.mempool[0]
+        self.mine(stamper)
+        for commitment in commitments:
+            self.assertTrue(stamper.is_pending(commitment).startswith("Timestamped by transaction %s" %
+                                                                      b2lx(tx.GetTxid())))
+        self.mine(stamper, 2)
+        for commitment in commitments:
+            self.assertFalse(stamper.is_pending(commitment))
+            msg, attestation = list(self.calendar[commitment].all_attestations())[0]
+            self.assertEqual(attestation, BitcoinBlockHeaderAttestation(len(self.bitcoind.blocks) - 3))
+        self.assertEqual(stamper.txs_waiting_for_confirmation, {})
+
+    def test_journal_checkpoint(self):
+        """The journal checkpoint is the first entry not stamped, even with reorged commitments"""
+        # idx 0-2 mined at height 1
+        commitments = self.submit(3)
+        stamper = self.start_stamper(min_confirmations=4)
+        self.wait_for(lambda: self.bitcoind.mempool)
+        self.mine(stamper)
+
+        # idx 3-4 mined at height 3, leaving idx 5-6 pending
+        commitments += self.submit(2)
+        self.wait_for(lambda: len(stamper.pending_commitments) == 2)
+        self.mine(stamper)
+        self.wait_for(lambda: self.bitcoind.mempool)
+        commitments += self.submit(2)
+        self.wait_for(lambda: len(stamper.pending_commitments) == 4)
+        self.mine(stamper)
+        self.assertEqual(stamper.journal_checkpoint.read(), 0)
+
+        # Reorging height 3 out puts idx 3-4 back behind idx 5-6, then height 4
+        # confirms idx 0-2
+        self.bitcoind.reorg(1)
+        stamper.notify_new_block()
+        self.wait_for(lambda: 4 in stamper.processed)
+        self.assertEqual(list(stamper.pending_commitments), commitments[5:7] + commitments[3:5])
+        self.assertEqual(stamper.journal_checkpoint.read(), 3)
+
+        stamper.exit_event.set()
+        stamper.thread.join()
+
+        # On restart only the entries from the checkpoint on are checked
+        checked = []
+        contains_many = self.calendar.contains_many
+        def record_contains_many(commitments):
+            checked.extend(commitments)
+            return contains_many(commitments)
+        self.calendar.contains_many = record_contains_many
+
+        stamper = self.start_stamper(min_confirmations=4)
+        self.wait_for(lambda: len(stamper.pending_commitments) == 4)
+        self.assertEqual(checked, commitments[3:])
+        self.assertEqual(list(stamper.pending_commitments), commitments[3:])
@@ -0,0 +1,131 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import tempfile
+import threading
+import unittest
+
+from opentimestamps.core.op import OpAppend
+from opentimestamps.core.timestamp import Timestamp, make_merkle_tree
+
+from otsserver.calendar import DbCalendar
+from otsserver.storage import *
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+
+class StoreTests:
+    """Tests every backend must pass"""
+    backend = None
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = open_store(self.backend, self.tempdir.name + '/db')
+
+    def tearDown(self):
+        self.store.close()
+        self.tempdir.cleanup()
+
+    def test_get(self):
+        self.assertNotIn(b'foo', self.store)
+        with self.assertRaises(KeyError):
+            self.store.get(b'foo')
+
+        self.store.write_batch([(b'foo', b'bar'), (b'baz', b'')])
+        self.assertIn(b'foo', self.store)
+        self.assertEqual(self.store.get(b'foo'), b'bar')
+        self.assertEqual(self.store.get(b'baz'), b'')
+
+        self.store.write_batch([(b'foo', b'qux')], sync=False)
+        self.assertEqual(self.store.get(b'foo'), b'qux')
+
+    def test_long_keys(self):
+        key = b'\x01'*4096
+        self.store.write_batch([(key, b'long')])
+        self.assertIn(key, self.store)
+        self.assertNotIn(key[:-1], self.store)
+        self.assertEqual(self.store.get(key), b'long')
+        self.assertEqual(list(self.store.range()), [(key, b'long')])
+
+    def test_contains_many(self):
+        keys = [i.to_bytes(2, 'big')*16 for i in range(1000)] + [b'\x01'*4096]
+        self.store.write_batch((key, b'') for key in keys[::2])
+
+        self.assertEqual(self.store.contains_many(keys + keys[0:10]), set(keys[::2]))
+        self.assertEqual(self.store.contains_many(iter(keys[1::2])), set())
+        self.assertEqual(self.store.contains_many([]), set())
+
+    def test_range(self):
+        keys = [bytes([i, j]) for i in range(16) for j in range(200)]
+        keys.append(b'\x05' + b'\x00'*1000)
+        self.store.write_batch((key, key[::-1]) for key in reversed(keys))
+        keys.sort()
+
+        self.assertEqual(list(self.store.range()), [(key, key[::-1]) for key in keys])
+        self.assertEqual([key for key, value in self.store.range(b'\x05', b'\x06')],
+                         [key for key in keys if key.startswith(b'\x05')])
+        self.assertEqual([key for key, value in self.store.range(b'\x0f\x10')],
+                         [key for key in keys if key >= b'\x0f\x10'])
+        self.assertEqual(list(self.store.range(b'\x20')), [])
+
+    def test_calendar(self):
+        cal = DbCalendar(self.store, cache_size=0, batch_size=10)
+
+        roots = [Timestamp(bytes([i])) for i in range(64)]
+        merkle_tip = make_merkle_tree(roots)
+        merkle_tip.ops.add(OpAppend(b'\x00'*1000))
+        cal.add_timestamps(roots)
+
+        for root in roots:
+            self.assertEqual(cal[root.msg], root)
+
+
+class Test_LevelDbStore(StoreTests, unittest.TestCase):
+    backend = 'leveldb'
+
+@unittest.skipIf(lmdb is None, 'lmdb not installed')
+class Test_LmdbStore(StoreTests, unittest.TestCase):
+    backend = 'lmdb'
+
+class Test_SqliteStore(StoreTests, unittest.TestCase):
+    backend = 'sqlite'
+
+    def test_reader_pool(self):
+        """Reader connections are reused, and only max_idle_readers are kept open"""
+        self.store.write_batch([(b'foo', b'bar')])
+        for i in range(10):
+            self.assertEqual(self.store.get(b'foo'), b'bar')
+        self.assertEqual(self.store.n_readers, 1)
+
+        # Threads come and go without leaving their connections open
+        def read():
+            for i in range(100):
+                self.store.get(b'foo')
+        threads = [threading.Thread(target=read) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(self.store.n_readers, self.store.max_idle_readers)
+
+    def test_write_batch_rollback(self):
+        def items():
+            yield (b'foo', b'bar')
+            raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            self.store.write_batch(items())
+        self.assertNotIn(b'foo', self.store)
+
+        self.store.write_batch([(b'foo', b'baz')])
+        self.assertEqual(self.store.get(b'foo'), b'baz')
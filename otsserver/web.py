@@ -0,0 +1,617 @@
+# Copyright (C) 2018 The OpenTimestamps developers
+#
+# This file is part of the OpenTimestamps Server.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of the OpenTimestamps Server, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""HTTP serving
+
+Endpoints are implemented once, as a Service mapping Requests to Responses,
+and can then be served either by a thread-per-connection server built on the
+standard library's HTTPServer, or by an asyncio server. Both put the same
+bytes on the wire, and both speak HTTP/1.1, keeping connections open between
+requests until they've been idle for IDLE_TIMEOUT seconds.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import email.utils
+import html
+import http.client
+import http.server
+import io
+import logging
+import queue
+import selectors
+import socket
+import socketserver
+import threading
+import time
+
+Request = collections.namedtuple('Request', ['method', 'path', 'headers', 'content_length', 'body', 'client_address'])
+
+Response = collections.namedtuple('Response', ['status', 'headers', 'body'])
+
+# A response that can only be made once future is done; finish() makes it
+PendingResponse = collections.namedtuple('PendingResponse', ['future', 'finish'])
+
+SERVER_VERSION = http.server.BaseHTTPRequestHandler.server_version + ' ' + http.server.BaseHTTPRequestHandler.sys_version
+
+PROTOCOL_VERSION = 'HTTP/1.1'
+
+IDLE_TIMEOUT = 30
+"""Seconds a connection may sit idle, or take over a request, before it's closed"""
+
+REFUSED_DRAIN_TIMEOUT = 1
+"""Seconds a connection refused with a 503 is read from before it's closed
+
+Closing a socket with unread data resets the connection, which can lose the
+503 before the client has read it, so refused connections are half-closed and
+whatever the client sends is discarded until it closes its end.
+"""
+
+
+def response_headers(request, response):
+    """Get the headers to send with a response, including framing headers
+
+    Every response has a Content-Length, so the connection can be reused. If
+    the request's body was left unread the connection can't be, so it's closed.
+    """
+    headers = list(response.headers)
+    if response.status not in (204, 304):
+        headers.append(('Content-Length', str(len(response.body or b''))))
+    if request.body is None and (request.content_length or 'Transfer-Encoding' in request.headers):
+        headers.append(('Connection', 'close'))
+    return headers
+
+
+def format_response_head(response, protocol_version=PROTOCOL_VERSION, phrase=None):
+    """Format the status line and headers of a response
+
+    Byte for byte what BaseHTTPRequestHandler sends.
+    """
+    if phrase is None:
+        phrase = http.server.BaseHTTPRequestHandler.responses.get(response.status, ('',))[0]
+    head = '%s %d %s\r\n' % (protocol_version, response.status, phrase)
+    head += 'Server: %s\r\n' % SERVER_VERSION
+    head += 'Date: %s\r\n' % email.utils.formatdate(usegmt=True)
+    for name, value in response.headers:
+        head += '%s: %s\r\n' % (name, value)
+    head += '\r\n'
+    return head.encode('latin-1', 'strict')
+
+
+class HTTPError(Exception):
+    """A request that's answered with an error, as BaseHTTPRequestHandler.send_error() does
+
+    Without head, only the body is sent, as send_error() does when it doesn't
+    know the request's version; without body, as for HEAD requests, only the
+    head is.
+    """
+    def __init__(self, status, message=None, explain=None, head=True, body=True):
+        super().__init__(status, message, explain)
+        self.status = status
+        self.message = message
+        self.explain = explain
+        self.head = head
+        self.body = body
+
+    def format(self):
+        """Format the error response, byte for byte what send_error() sends"""
+        handler = http.server.BaseHTTPRequestHandler
+        message, explain = handler.responses.get(self.status, ('???', '???'))
+        if self.message is not None:
+            message = self.message
+        if self.explain is not None:
+            explain = self.explain
+
+        body = (handler.error_message_format % {'code': self.status,
+                                                'message': html.escape(message, quote=False),
+                                                'explain': html.escape(explain, quote=False)}).encode('UTF-8', 'replace')
+        if not self.head:
+            return body
+
+        headers = [('Connection', 'close'),
+                   ('Content-Type', handler.error_content_type),
+                   ('Content-Length', str(len(body)))]
+        return format_response_head(Response(self.status, headers, None), phrase=message) + \
+            (body if self.body else b'')
+
+
+class Service:
+    """A set of HTTP endpoints, independent of the server serving them"""
+
+    MAX_BODY_SIZE = 0
+    """Largest request body that's read
+
+    A request with a larger body, or without a Content-Length, has its body set
+    to None, and the body is left unread.
+    """
+
+    server = None
+    """The server serving this service; set by the server"""
+
+    def handle(self, request):
+        """Handle a request
+
+        Returns a Response, or a PendingResponse for responses that have to
+        wait for something. May block, e.g. on database reads.
+        """
+        raise NotImplementedError
+
+    def respond(self, request):
+        """Handle a request, waiting for the response if it's pending"""
+        response = self.handle(request)
+        if isinstance(response, PendingResponse):
+            concurrent.futures.wait([response.future])
+            response = response.finish()
+        return response
+
+
+class ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler serving a Service"""
+
+    service = None
+
+    protocol_version = PROTOCOL_VERSION
+
+    timeout = IDLE_TIMEOUT
+
+    def read_request(self):
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            content_length = None
+        if content_length is not None and content_length < 0:
+            content_length = None
+
+        body = None
+        if content_length is not None and content_length <= self.service.MAX_BODY_SIZE:
+            body = self.rfile.read(content_length)
+
+        return Request(self.command, self.path, self.headers, content_length, body, self.client_address)
+
+    def parse_request(self):
+        self.server.connection_busy(self.connection)
+        return super().parse_request()
+
+    def handle_one_request(self):
+        super().handle_one_request()
+
+        # Until the next request line has been read, a kept-alive connection
+        # is idle
+        self.server.connection_idle(self.connection)
+
+    def __handle(self):
+        request = self.read_request()
+        response = self.service.respond(request)
+
+        self.send_response(response.status)
+        for name, value in response_headers(request, response):
+            self.send_header(name, value)
+        self.end_headers()
+
+        if response.body:
+            self.wfile.write(response.body)
+
+    do_GET = __handle
+    do_POST = __handle
+
+
+class BoundedThreadingMixIn(socketserver.ThreadingMixIn):
+    """ThreadingMixIn with a limit on the number of request threads
+
+    Each connection has its own thread for as long as it's kept open. When a
+    connection comes in while max_threads are open, the connection that's been
+    idle between requests the longest is closed to make room for it; if none
+    are idle, the new connection is refused with a 503 straight away, without
+    reading the request.
+    """
+
+    BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                     b'Content-type: text/plain\r\n'
+                     b'Retry-After: 1\r\n'
+                     b'Content-Length: 11\r\n'
+                     b'Connection: close\r\n'
+                     b'\r\n'
+                     b'server busy')
+
+    def init_thread_limit(self, max_threads):
+        self.max_threads = max_threads
+        self.active_threads = 0
+        self.rejected_connections = 0
+        self.closed_idle_connections = 0
+        self.__threads_lock = threading.Lock()
+
+        self.__idle = {}
+        """Idle connections, longest idle first"""
+
+        self.__evicted = set()
+        """Idle connections closed, whose threads have handed their slot over"""
+
+        self.__refused = queue.Queue()
+        self.__drain_thread = None
+
+    def connection_idle(self, request):
+        with self.__threads_lock:
+            self.__idle[request] = None
+
+    def connection_busy(self, request):
+        with self.__threads_lock:
+            self.__idle.pop(request, None)
+
+    def process_request(self, request, client_address):
+        evicted = None
+        with self.__threads_lock:
+            busy = self.max_threads is not None and self.active_threads >= self.max_threads
+            if busy and self.__idle:
+                # The idle connection's slot goes to the new one
+                evicted = next(iter(self.__idle))
+                del self.__idle[evicted]
+                self.__evicted.add(evicted)
+                self.closed_idle_connections += 1
+                busy = False
+            elif busy:
+                self.rejected_connections += 1
+            else:
+                self.active_threads += 1
+
+        if evicted is not None:
+            # Wakes its thread up, which then closes it
+            try:
+                evicted.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        if busy:
+            self.__refuse(request)
+            return
+
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.__threads_lock:
+                self.__idle.pop(request, None)
+                if request in self.__evicted:
+                    self.__evicted.remove(request)
+                else:
+                    self.active_threads -= 1
+
+    def __refuse(self, request):
+        try:
+            request.sendall(self.BUSY_RESPONSE)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.shutdown_request(request)
+            return
+
+        request.setblocking(False)
+        self.__refused.put((request, time.monotonic() + REFUSED_DRAIN_TIMEOUT))
+        with self.__threads_lock:
+            if self.__drain_thread is None:
+                self.__drain_thread = threading.Thread(target=self.__drain_refused, daemon=True)
+                self.__drain_thread.start()
+
+    def __drain_refused(self):
+        """Discard what refused clients send, closing each once it's done or timed out
+
+        A single thread for every refused connection, so refusing connections
+        doesn't itself take up threads.
+        """
+        selector = selectors.DefaultSelector()
+        deadlines = {}
+        while True:
+            try:
+                while True:
+                    # With nothing to drain, wait for the next refusal
+                    request, deadline = self.__refused.get(block=not deadlines)
+                    deadlines[request] = deadline
+                    selector.register(request, selectors.EVENT_READ)
+            except queue.Empty:
+                pass
+
+            for key, events in selector.select(0.1):
+                try:
+                    done = not key.fileobj.recv(65536)
+                except BlockingIOError:
+                    done = False
+                except OSError:
+                    done = True
+                if done:
+                    deadlines[key.fileobj] = 0
+
+            now = time.monotonic()
+            for request, deadline in list(deadlines.items()):
+                if deadline <= now:
+                    del deadlines[request]
+                    selector.unregister(request)
+                    request.close()
+
+    def stats(self):
+        return {'max_threads': self.max_threads,
+                'active_threads': self.active_threads,
+                'idle_connections': len(self.__idle),
+                'closed_idle_connections': self.closed_idle_connections,
+                'rejected_connections': self.rejected_connections}
+
+
+class ThreadedServer(BoundedThreadingMixIn, http.server.HTTPServer):
+    """Serves a Service with a thread per connection
+
+    With reuse_port, any number of processes can listen on the same port, and
+    the kernel balances connections between them.
+    """
+
+    # Don't wait for idle keep-alive connections when closing the server
+    daemon_threads = True
+
+    def __init__(self, server_address, service, reuse_port=False, max_threads=None):
+        class request_handler(ServiceRequestHandler):
+            pass
+        request_handler.service = service
+        service.server = self
+
+        self.service = service
+        self.reuse_port = reuse_port
+        self.init_thread_limit(max_threads)
+        super().__init__(server_address, request_handler)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class AsyncServer:
+    """Serves a Service with asyncio
+
+    Connections are coroutines rather than threads, so idle keep-alive
+    connections, and connections waiting on pending responses, cost little
+    more than their socket. Pipelined requests are answered in order.
+    Service.handle() may block, so it's run in a bounded pool of worker
+    threads; waiting for pending responses doesn't take up a worker.
+    """
+
+    DEFAULT_MAX_WORKERS = 16
+
+    MAX_LINE_SIZE = 65536
+    """Longest request line or header line that's accepted, as BaseHTTPRequestHandler"""
+
+    MAX_HEADERS = 100
+    """Most header lines that are accepted, as BaseHTTPRequestHandler"""
+
+    BUSY_RESPONSE = BoundedThreadingMixIn.BUSY_RESPONSE
+
+    def __init__(self, server_address, service, reuse_port=False,
+                 max_workers=DEFAULT_MAX_WORKERS, max_connections=None):
+        self.service = service
+        service.server = self
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.server_port = self.server_address[1]
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        self.active_connections = 0
+        self.rejected_connections = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.__stopped = self.loop.create_future()
+        self.__is_shut_down = threading.Event()
+
+    def stats(self):
+        return {'max_workers': self.max_workers,
+                'max_connections': self.max_connections,
+                'active_connections': self.active_connections,
+                'rejected_connections': self.rejected_connections}
+
+    @staticmethod
+    def __parse_request_line(request_line):
+        """Parse the request line, as BaseHTTPRequestHandler.parse_request() does
+
+        Returns a (method, path, version, keep_alive) tuple, or None if the
+        request line is blank, in which case the connection is just closed.
+        keep_alive is what the version implies, before any Connection header.
+        """
+        request_line = str(request_line, 'iso-8859-1').rstrip('\r\n')
+        words = request_line.split()
+        if not words:
+            return None
+
+        version = 'HTTP/0.9'
+        keep_alive = False
+        if len(words) >= 3:
+            try:
+                if not words[-1].startswith('HTTP/'):
+                    raise ValueError
+                base_version_number = words[-1].split('/', 1)[1]
+                version_number = base_version_number.split('.')
+                if len(version_number) != 2 or \
+                        any(not n.isdigit() or len(n) > 10 for n in version_number):
+                    raise ValueError
+                version_number = (int(version_number[0]), int(version_number[1]))
+            except ValueError:
+                raise HTTPError(400, 'Bad request version (%r)' % words[-1], head=False)
+
+            keep_alive = version_number >= (1, 1)
+            if version_number >= (2, 0):
+                raise HTTPError(505, 'Invalid HTTP version (%s)' % base_version_number, head=False)
+            version = words[-1]
+
+        if not 2 <= len(words) <= 3:
+            raise HTTPError(400, 'Bad request syntax (%r)' % request_line, head=version != 'HTTP/0.9')
+        method, path = words[:2]
+        if len(words) == 2:
+            keep_alive = False
+            if method != 'GET':
+                raise HTTPError(400, 'Bad HTTP/0.9 request type (%r)' % method, head=False)
+
+        if path.startswith('//'):
+            path = '/' + path.lstrip('/')
+
+        return (method, path, version, keep_alive)
+
+    async def __read_request(self, reader, writer, client_address):
+        """Read a request
+
+        Returns a (request, version, keep_alive) tuple, or None if the
+        connection was closed first. Requests that are answered with an error
+        raise HTTPError.
+        """
+        try:
+            request_line = await reader.readline()
+        except ValueError:
+            raise HTTPError(414)
+        if not request_line:
+            return None
+
+        request_line = self.__parse_request_line(request_line)
+        if request_line is None:
+            return None
+        method, path, version, keep_alive = request_line
+        head = version != 'HTTP/0.9'
+
+        lines = []
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise HTTPError(431, 'Line too long', 'header line', head=head)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            lines.append(line)
+            if len(lines) > self.MAX_HEADERS:
+                raise HTTPError(431, 'Too many headers', 'got more than %d headers' % self.MAX_HEADERS, head=head)
+        headers = http.client.parse_headers(io.BytesIO(b''.join(lines) + b'\r\n'))
+
+        connection = headers.get('Connection', '').lower()
+        if connection == 'close':
+            keep_alive = False
+        elif connection == 'keep-alive':
+            keep_alive = True
+
+        if headers.get('Expect', '').lower() == '100-continue' and version >= 'HTTP/1.1':
+            writer.write(('%s 100 Continue\r\n\r\n' % PROTOCOL_VERSION).encode('latin-1'))
+
+        if method not in ('GET', 'POST'):
+            raise HTTPError(501, 'Unsupported method (%r)' % method, head=head, body=method != 'HEAD')
+
+        try:
+            content_length = int(headers['Content-Length'])
+        except (TypeError, ValueError):
+            content_length = None
+        if content_length is not None and content_length < 0:
+            content_length = None
+
+        body = None
+        if content_length is not None and content_length <= self.service.MAX_BODY_SIZE:
+            body = await reader.readexactly(content_length)
+
+        return (Request(method, path, headers, content_length, body, client_address), version, keep_alive)
+
+    async def __respond(self, request):
+        response = await self.loop.run_in_executor(self.executor, self.service.handle, request)
+        if isinstance(response, PendingResponse):
+            await asyncio.wait([asyncio.wrap_future(response.future)])
+            response = response.finish()
+        return response
+
+    @staticmethod
+    async def __drain(reader):
+        while await reader.read(65536):
+            pass
+
+    async def __handle_connection(self, reader, writer):
+        if self.max_connections is not None and self.active_connections >= self.max_connections:
+            self.rejected_connections += 1
+            writer.write(self.BUSY_RESPONSE)
+
+            # Half-closed and drained, as BoundedThreadingMixIn does
+            try:
+                writer.write_eof()
+                await asyncio.wait_for(self.__drain(reader), REFUSED_DRAIN_TIMEOUT)
+            except (asyncio.TimeoutError, ConnectionError, OSError):
+                pass
+            writer.close()
+            return
+
+        self.active_connections += 1
+        try:
+            client_address = writer.get_extra_info('peername')
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.__read_request(reader, writer, client_address),
+                                                     IDLE_TIMEOUT)
+                except HTTPError as exp:
+                    logging.debug("Bad request from %r: %d %s" % (client_address, exp.status, exp.message))
+                    writer.write(exp.format())
+                    await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+                    return
+                except asyncio.IncompleteReadError:
+                    return
+                if request is None:
+                    return
+                request, version, keep_alive = request
+
+                response = await self.__respond(request)
+                headers = response_headers(request, response)
+                if ('Connection', 'close') in headers:
+                    keep_alive = False
+
+                # HTTP/0.9 responses are just the body
+                if version != 'HTTP/0.9':
+                    writer.write(format_response_head(response._replace(headers=headers)))
+                if response.body:
+                    writer.write(response.body)
+                await asyncio.wait_for(writer.drain(), IDLE_TIMEOUT)
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+        except Exception as exp:
+            logging.exception("Error handling request: %r" % exp)
+
+        finally:
+            self.active_connections -= 1
+            writer.close()
+
+    async def __serve(self):
+        server = await asyncio.start_server(self.__handle_connection, sock=self.socket, limit=self.MAX_LINE_SIZE)
+        async with server:
+            await self.__stopped
+
+    def serve_forever(self):
+        try:
+            self.loop.run_until_complete(self.__serve())
+        finally:
+            self.__is_shut_down.set()
+
+    def shutdown(self):
+        """Stop serve_forever() and wait for it to return
+
+        Like socketserver's, must be called from another thread.
+        """
+        self.loop.call_soon_threadsafe(lambda: self.__stopped.done() or self.__stopped.set_result(None))
+        self.__is_shut_down.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False)